@@ -2,17 +2,22 @@ from __future__ import absolute_import
 
 from shardmonster.api import (
     activate_caching, connect_to_controller, configure_controller,
-    ensure_realm_exists, make_collection_shard_aware, set_shard_at_rest,
-    where_is)
-from shardmonster.connection import ensure_cluster_exists
+    ensure_realm_exists, ensure_realms_exist, get_metadata_stats,
+    make_collection_shard_aware, set_realm_cache_policy,
+    set_realm_exclusion_mode, set_shard_at_rest, set_shards_at_rest,
+    where_are, where_is)
+from shardmonster.connection import (
+    ensure_cluster_exists, ensure_clusters_exist)
 from shardmonster.metadata import wipe_metadata
 from shardmonster.sharder import do_migration
 
 __all__ = [
     'activate_caching', 'connect_to_controller', 'configure_controller',
-    'do_migration', 'ensure_cluster_exists', 'ensure_realm_exists',
-    'make_collection_shard_aware', 'set_shard_at_rest',
-    'where_is', 'wipe_metadata', 'VERSION',
+    'do_migration', 'ensure_cluster_exists', 'ensure_clusters_exist',
+    'ensure_realm_exists', 'ensure_realms_exist', 'get_metadata_stats',
+    'make_collection_shard_aware', 'set_realm_cache_policy',
+    'set_realm_exclusion_mode', 'set_shard_at_rest', 'set_shards_at_rest',
+    'where_are', 'where_is', 'wipe_metadata', 'VERSION',
 ]
 
 VERSION = (0, 10, 4)
@@ -0,0 +1,290 @@
+"""Splits aggregation pipelines so that they can be run across several
+locations at once.
+
+A pipeline is split into a part that is run in every location and a part that
+is run here on the combined results:
+
+ - Leading $match, $project, $unwind and $addFields stages only look at one
+   document at a time so are run in every location.
+ - A $group is run in every location to produce partial results. The partial
+   results are then grouped again here. $sum, $min, $max, $count and $avg
+   (as a sum and a count) are supported.
+ - Any trailing $sort, $skip and $limit stages are applied here. Without a
+   $group the $sort and a $limit (covering any $skip) are also run in every
+   location so that less comes back.
+"""
+from __future__ import absolute_import
+
+import datetime
+import decimal
+import re
+
+import six
+from bson.binary import Binary
+from bson.decimal128 import Decimal128
+from bson.max_key import MaxKey
+from bson.min_key import MinKey
+from bson.objectid import ObjectId
+from bson.regex import Regex
+from bson.timestamp import Timestamp
+
+SHARD_LOCAL_STAGES = ('$match', '$project', '$unwind', '$addFields')
+MERGE_STAGES = ('$sort', '$skip', '$limit')
+GROUP_ACCUMULATORS = ('$sum', '$min', '$max', '$count', '$avg')
+
+# Prefix for the partial sums and counts of an $avg
+_AVG_PREFIX = '__shardmonster_avg_'
+_NUMERIC_TYPES = ['double', 'int', 'long', 'decimal']
+
+_RE_TYPE = type(re.compile(''))
+
+
+def _stage_name(stage):
+    if len(stage) != 1:
+        raise Exception('Aggregation stages must have exactly one key')
+    return next(iter(stage))
+
+
+class SplitPipeline(object):
+    """A pipeline split into shard_pipeline, to be run in every location,
+    group, the accumulators of any $group that must be finished here, and
+    merge_stages, the $sort/$skip/$limit stages applied to the result.
+    """
+    def __init__(self, shard_pipeline, group, merge_stages):
+        self.shard_pipeline = shard_pipeline
+        self.group = group
+        self.merge_stages = merge_stages
+
+    def merge(self, results_per_location):
+        """Combines the results from each location into the final results.
+        """
+        results = []
+        for location_results in results_per_location:
+            results.extend(location_results)
+        if self.group is not None:
+            results = _merge_groups(self.group, results)
+        return apply_merge_stages(results, self.merge_stages)
+
+
+def split_pipeline(pipeline):
+    """Splits the pipeline. Raises an exception if the pipeline contains
+    stages that can't be run across several locations.
+    """
+    shard_pipeline = []
+    stages = list(pipeline)
+    while stages and _stage_name(stages[0]) in SHARD_LOCAL_STAGES:
+        shard_pipeline.append(stages.pop(0))
+
+    group = None
+    if stages and _stage_name(stages[0]) == '$group':
+        group = stages.pop(0)['$group']
+        shard_pipeline.append({'$group': _partial_group(group)})
+
+    for stage in stages:
+        name = _stage_name(stage)
+        if name not in MERGE_STAGES:
+            raise Exception(
+                'Cannot run %s at this point of an aggregation across '
+                'several shards' % name)
+
+    if group is None:
+        shard_pipeline.extend(_push_down(stages))
+    return SplitPipeline(shard_pipeline, group, stages)
+
+
+def _partial_group(group):
+    partial = {'_id': group['_id']}
+    for field, accumulator in six.iteritems(group):
+        if field == '_id':
+            continue
+        operator, expression = _get_accumulator(field, accumulator)
+        if operator == '$avg':
+            partial[_AVG_PREFIX + field + '_sum'] = {'$sum': expression}
+            # $avg ignores anything that isn't a number, as does $sum
+            partial[_AVG_PREFIX + field + '_count'] = {'$sum': {'$cond': [
+                {'$in': [{'$type': expression}, _NUMERIC_TYPES]}, 1, 0]}}
+        elif operator == '$count':
+            partial[field] = {'$sum': 1}
+        else:
+            partial[field] = {operator: expression}
+    return partial
+
+
+def _get_accumulator(field, accumulator):
+    if not isinstance(accumulator, dict) or len(accumulator) != 1:
+        raise Exception('Invalid accumulator for %s' % field)
+    operator, expression = next(iter(six.iteritems(accumulator)))
+    if operator not in GROUP_ACCUMULATORS:
+        raise Exception(
+            'Cannot use %s in a $group across several shards' % operator)
+    return operator, expression
+
+
+def _push_down(stages):
+    """Works out the $sort and $limit that can be run in every location for
+    the given trailing stages.
+    """
+    pushed = []
+    skip = 0
+    for i, stage in enumerate(stages):
+        name = _stage_name(stage)
+        if name == '$sort' and i == 0:
+            pushed.append(stage)
+        elif name == '$skip':
+            skip += stage['$skip']
+        elif name == '$limit':
+            # Each location may need to provide every skipped document
+            pushed.append({'$limit': stage['$limit'] + skip})
+            break
+        else:
+            break
+    return pushed
+
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(
+            (key, _hashable(item)) for key, item in six.iteritems(value))
+    if isinstance(value, list):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def _merge_groups(group, partials):
+    merged = {}
+    order = []
+    for partial in partials:
+        key = _hashable(partial.get('_id'))
+        if key not in merged:
+            merged[key] = {'_id': partial.get('_id')}
+            order.append(key)
+        doc = merged[key]
+        for field, accumulator in six.iteritems(group):
+            if field == '_id':
+                continue
+            operator, _ = _get_accumulator(field, accumulator)
+            if operator == '$avg':
+                for suffix in ('_sum', '_count'):
+                    name = _AVG_PREFIX + field + suffix
+                    doc[name] = _add(doc.get(name, 0), partial.get(name))
+            elif operator in ('$sum', '$count'):
+                doc[field] = _add(doc.get(field, 0), partial.get(field))
+            else:
+                doc[field] = _pick(
+                    operator, doc.get(field), partial.get(field))
+
+    results = []
+    for key in order:
+        doc = merged[key]
+        for field, accumulator in six.iteritems(group):
+            if field == '_id':
+                continue
+            operator, _ = _get_accumulator(field, accumulator)
+            if operator == '$avg':
+                total = doc.pop(_AVG_PREFIX + field + '_sum')
+                count = doc.pop(_AVG_PREFIX + field + '_count')
+                if not count:
+                    doc[field] = None
+                elif isinstance(total, Decimal128):
+                    # As on the server, the average of decimals is a decimal
+                    doc[field] = Decimal128(total.to_decimal() / count)
+                else:
+                    doc[field] = float(total) / count
+        results.append(doc)
+    return results
+
+
+def _add(total, value):
+    # Decimal128 doesn't support arithmetic so decimals are added as Decimals.
+    # As on the server, a sum with any decimal in it is a decimal.
+    if not value:
+        return total
+    if isinstance(total, Decimal128) or isinstance(value, Decimal128):
+        return Decimal128(_to_decimal(total) + _to_decimal(value))
+    return total + value
+
+
+def _to_decimal(value):
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    if isinstance(value, float):
+        # Going through repr keeps floats as short as they are written
+        return decimal.Decimal(repr(value))
+    return decimal.Decimal(value)
+
+
+def _pick(operator, current, new):
+    # $min and $max ignore missing values
+    if current is None:
+        return new
+    if new is None:
+        return current
+    if operator == '$min':
+        return new if _sort_key(new) < _sort_key(current) else current
+    return new if _sort_key(new) > _sort_key(current) else current
+
+
+def _sort_key(value):
+    # Follows Mongo's comparison order for BSON types so that mixed types can
+    # be compared in Python 3 and values compare as they would on the server
+    if isinstance(value, MinKey):
+        return (0, 0)
+    if value is None:
+        return (1, 0)
+    if isinstance(value, bool):
+        return (8, value)
+    if isinstance(value, six.integer_types + (float,)):
+        return (2, value)
+    if isinstance(value, Decimal128):
+        return (2, value.to_decimal())
+    if isinstance(value, Binary):
+        return (6, len(value), value.subtype, bytes(value))
+    if isinstance(value, six.string_types):
+        return (3, value)
+    if isinstance(value, bytes):
+        return (6, len(value), 0, value)
+    if isinstance(value, dict):
+        return (4, tuple(
+            (_sort_key(item)[0], key, _sort_key(item))
+            for key, item in six.iteritems(value)))
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(_sort_key(item) for item in value))
+    if isinstance(value, ObjectId):
+        return (7, value.binary)
+    if isinstance(value, datetime.datetime):
+        return (9, value)
+    if isinstance(value, Timestamp):
+        return (10, value.time, value.inc)
+    if isinstance(value, Regex):
+        return (11, value.pattern, value.flags)
+    if isinstance(value, _RE_TYPE):
+        return (11, value.pattern, value.flags)
+    if isinstance(value, MaxKey):
+        return (12, 0)
+    return (3, repr(value))
+
+
+def _get_field(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def apply_merge_stages(results, stages):
+    for stage in stages:
+        name = _stage_name(stage)
+        if name == '$sort':
+            # Python's sort is stable so sort by the least significant key
+            # first
+            for key, direction in reversed(list(six.iteritems(stage[name]))):
+                results = sorted(
+                    results,
+                    key=lambda doc: _sort_key(_get_field(doc, key)),
+                    reverse=direction < 0)
+        elif name == '$skip':
+            results = results[stage[name]:]
+        elif name == '$limit':
+            results = results[:stage[name]]
+    return results
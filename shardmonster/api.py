@@ -1,20 +1,52 @@
 from __future__ import absolute_import
 
+import time
+
+import six
+from pymongo.operations import InsertOne, UpdateOne
+
+from shardmonster.coalescing import (
+    activate_read_coalescing, activate_write_coalescing,
+    deactivate_read_coalescing, deactivate_write_coalescing,
+    get_read_coalescing_stats, get_write_coalescing_stats)
+from shardmonster.document_cache import (
+    activate_document_cache, cached_find_one, deactivate_document_cache,
+    get_document_cache_stats, invalidate_for_bulk_write,
+    invalidate_for_documents, invalidate_for_query)
 from shardmonster.connection import (
     add_cluster, connect_to_controller, configure_controller,
     _get_cluster_coll, get_cluster_uri, parse_location)
 from shardmonster.metadata import (
-    _get_location_for_shard, _get_realm_coll, _get_realm_by_name,
-    _get_realm_for_collection, _get_shards_coll, ShardStatus, activate_caching,
-    get_caching_duration, realm_changed)
-from shardmonster import operations
+    _get_location_for_shard, _get_locations_for_shards, _get_realm_coll,
+    _get_realm_by_name, _get_realm_for_collection, _get_shards_coll,
+    ShardStatus, REFRESH_MODES, activate_caching, get_cache_sizes,
+    get_caching_duration, get_in_flux_caching_duration,
+    get_longest_caching_duration, realm_changed, realm_policy_changed)
+from shardmonster import operations, stats
+from shardmonster.routing import analyse_query
+from shardmonster.secondary_indexes import (
+    check_secondary_index, create_secondary_index, drop_secondary_index,
+    find_index_route, finishing_index_updates, index_documents,
+    prepare_index_update)
 
 __all__ = [
     "activate_caching", "connect_to_controller", "configure_controller",
-    "get_caching_duration", "add_cluster", "set_shard_at_rest",
-    "set_untargetted_query_callback"]
-
-_collection_cache = {}
+    "get_caching_duration", "get_in_flux_caching_duration",
+    "get_longest_caching_duration", "add_cluster",
+    "set_shard_at_rest", "set_realm_cache_policy",
+    "set_untargetted_query_callback", "get_metadata_stats",
+    "reset_metadata_stats", "activate_write_coalescing",
+    "deactivate_write_coalescing", "get_write_coalescing_stats",
+    "activate_read_coalescing", "deactivate_read_coalescing",
+    "get_read_coalescing_stats", "route_explain",
+    "set_realm_exclusion_mode", "activate_document_cache",
+    "deactivate_document_cache", "get_document_cache_stats",
+    "create_secondary_index", "drop_secondary_index",
+    "check_secondary_index", "set_shards_at_rest",
+    "get_index_build_progress"]
+
+# The number of shards that set_shards_at_rest checks or writes at once
+PLACEMENT_BATCH_SIZE = 1000
 
 
 def create_indices():
@@ -54,32 +86,130 @@ def ensure_realm_exists(name, shard_field, collection_name, default_dest):
         explicitly sharded to a specific location.
     :return: None
     """
+    ensure_realms_exist([(name, shard_field, collection_name, default_dest)])
+
+
+def ensure_realms_exist(realms):
+    """As ensure_realm_exists but for many realms at once. The existing
+    realms are looked up with a single query and any missing ones are created
+    together. Nothing is created if any realm conflicts with an existing one.
+
+    :param realms: An iterable of (name, shard_field, collection_name,
+        default_dest) tuples, as would be passed to ensure_realm_exists.
+    :return: None
+    """
+    realms = list(realms)
     coll = _get_realm_coll()
+    by_name = {}
+    by_collection = {}
+    for existing in coll.find({'$or': [
+            {'name': {'$in': [realm[0] for realm in realms]}},
+            {'collection': {'$in': [realm[2] for realm in realms]}}]}):
+        by_name[existing['name']] = existing
+        by_collection[existing['collection']] = existing
+
+    missing = []
+    for name, shard_field, collection_name, default_dest in realms:
+        existing = by_name.get(name)
+        if existing is not None:
+            if (existing['shard_field'] != shard_field or
+                    existing['collection'] != collection_name or
+                    existing['default_dest'] != default_dest):
+                raise Exception('Cannot change realm')
+            continue
+
+        existing = by_collection.get(collection_name)
+        if existing is not None:
+            if (existing['shard_field'] != shard_field or
+                    existing['name'] != name or
+                    existing['default_dest'] != default_dest):
+                raise Exception(
+                    'Realm for collection %s already exists' % collection_name)
+            continue
+
+        realm = {
+            'name': name,
+            'shard_field': shard_field,
+            'collection': collection_name,
+            'default_dest': default_dest}
+        by_name[name] = by_collection[collection_name] = realm
+        missing.append(realm)
+
+    if missing:
+        coll.insert(missing)
+
+
+def set_realm_cache_policy(
+        name, timeout=None, in_flux_timeout=None, refresh_mode=None):
+    """Sets how metadata for the given realm is cached. Anything not given
+    falls back to the values passed to activate_caching. Calling this with
+    only a name removes the realm's policy altogether.
+
+    Only the caches for this realm are flushed in this process. Other processes
+    pick up the new policy once their cached copy of the realm expires.
 
-    cursor = coll.find({'name': name})
-    if cursor.count():
-        # realm with this name already exists
-        existing = cursor[0]
-        if (existing['shard_field'] != shard_field or
-                existing['collection'] != collection_name or
-                existing['default_dest'] != default_dest):
-            raise Exception('Cannot change realm')
-        else:
-            return
-
-    cursor = coll.find({'collection': collection_name})
-    if cursor.count():
-        # realm for this collection already exists
-        existing = cursor[0]
-        if (existing['shard_field'] != shard_field or
-                existing['name'] != name or
-                existing['default_dest'] != default_dest):
-            raise Exception(
-                'Realm for collection %s already exists' % collection_name)
-        else:
-            return
-
-    create_realm(name, shard_field, collection_name, default_dest)
+    :param str name: The name of the realm
+    :param float timeout: Number of seconds to cache metadata for.
+    :param float in_flux_timeout: Number of seconds to cache metadata for
+        shards that are in the middle of a migration.
+    :param str refresh_mode: Either "per-shard" (refresh only the shard being
+        looked up) or "full" (refresh every shard in the realm at once).
+    :return: None
+    """
+    if refresh_mode is not None and refresh_mode not in REFRESH_MODES:
+        raise Exception('Unknown refresh mode %s' % refresh_mode)
+
+    policy = {}
+    if timeout is not None:
+        policy['timeout'] = timeout
+    if in_flux_timeout is not None:
+        policy['in_flux_timeout'] = in_flux_timeout
+    if refresh_mode is not None:
+        policy['refresh_mode'] = refresh_mode
+
+    # Other processes keep the old policy until their copy of the realm
+    # expires and keep entries cached under it for up to the old timeout
+    # after that. Migrations wait on the old timeout until then.
+    now = time.time()
+    previous_timeout = get_longest_caching_duration(
+        _get_realm_by_name(name), now)
+    update = {'$set': {'previous_cache_timeout': {
+        'timeout': previous_timeout,
+        'until': now + 2 * previous_timeout,
+    }}}
+    if policy:
+        update['$set']['cache_policy'] = policy
+    else:
+        update['$unset'] = {'cache_policy': 1}
+    coll = _get_realm_coll()
+    coll.update({'name': name}, update)
+    realm_policy_changed(_get_realm_by_name(name))
+
+
+def set_realm_exclusion_mode(name, mode):
+    """Sets how untargetted finds against the given realm leave out the
+    documents of shards that a location is not the source of truth for (such
+    as the stale copy of a shard mid-migration).
+
+    In "server" mode (the default) the query sent to the location excludes
+    them. This changes the shape of the query, which can change the plan
+    the server picks for it. In "client" mode the query is sent as is and the
+    documents are dropped as they come back. "auto" only drops them on the
+    client when the query has no condition on the shard field and only a few
+    shards are excluded from the location.
+
+    Counts, updates and removes always exclude shards on the server.
+
+    :param str name: The name of the realm
+    :param str mode: One of "server", "client" or "auto"
+    :return: None
+    """
+    if mode not in operations.EXCLUSION_MODES:
+        raise Exception('Unknown exclusion mode %s' % mode)
+
+    coll = _get_realm_coll()
+    coll.update({'name': name}, {'$set': {'exclusion_mode': mode}})
+    realm_policy_changed(_get_realm_by_name(name))
 
 
 def _assert_valid_location(location):
@@ -129,6 +259,62 @@ def set_shard_at_rest(realm, shard_key, location, force=False):
     realm_changed(realm)
 
 
+def set_shards_at_rest(realm, placements, force=False):
+    """Marks many shards as being at rest in the given locations, such as
+    when first placing the shards of a realm or re-homing them en masse.
+
+    Each location is only checked once, the placements are written with bulk
+    writes and the realm's metadata is only flushed once they have all been
+    written. Unless force is True this will raise an exception, before
+    anything is written, if any of the shards has already been placed.
+
+    :param str realm: The name of the realm for the shards
+    :param placements: A dictionary mapping each shard key onto the location
+        that it is at, or an iterable of (shard_key, location) pairs.
+    :param bool force: Force the shards to be placed at rest in the given
+        locations even if they have already been placed somewhere.
+    :return: None
+    """
+    if isinstance(placements, dict):
+        placements = six.iteritems(placements)
+    placements = list(placements)
+    for location in set(location for _, location in placements):
+        _assert_valid_location(location)
+
+    shards_coll = _get_shards_coll()
+    batches = [
+        placements[i:i + PLACEMENT_BATCH_SIZE]
+        for i in range(0, len(placements), PLACEMENT_BATCH_SIZE)]
+    if not force:
+        for batch in batches:
+            placed = shards_coll.find_one({
+                'realm': realm,
+                'shard_key': {'$in': [shard_key for shard_key, _ in batch]},
+            })
+            if placed:
+                raise Exception(
+                    'Shard with key %s has already been placed. Use '
+                    'force=true if you really want to do this'
+                    % placed['shard_key'])
+
+    for batch in batches:
+        shards_coll.bulk_write([
+            UpdateOne(
+                {'realm': realm, 'shard_key': shard_key},
+                {
+                    '$set': {
+                        'location': location,
+                        'status': ShardStatus.AT_REST,
+                    },
+                    '$unset': {
+                        'new_location': 1,
+                    },
+                },
+                upsert=True)
+            for shard_key, location in batch], ordered=False)
+    realm_changed(_get_realm_by_name(realm))
+
+
 def set_shard_to_migration_status(realm, shard_key, status):
     """Marks a shard as being at a specific migration status.
     """
@@ -176,29 +362,79 @@ class ShardAwareCollectionProxy(object):
             with_options=self._with_options, *args, **kwargs)
 
     def find_one(self, *args, **kwargs):
-        return operations.multishard_find_one(
+        return cached_find_one(
             self.collection_name,
             with_options=self._with_options, *args, **kwargs)
 
-    def update(self, *args, **kwargs):
-        return operations.multishard_update(
+    def update(self, query, update, *args, **kwargs):
+        reindex = prepare_index_update(
+            self.collection_name, query, update, kwargs.get('upsert', False))
+        try:
+            with finishing_index_updates([reindex]):
+                return operations.multishard_update(
+                    self.collection_name, query, update,
+                    with_options=self._with_options, *args, **kwargs)
+        finally:
+            invalidate_for_query(
+                self.collection_name, query,
+                update if kwargs.get('upsert') else None)
+
+    def insert(self, doc_or_docs, *args, **kwargs):
+        index_documents(self.collection_name, doc_or_docs)
+        try:
+            return operations.multishard_insert(
+                self.collection_name, doc_or_docs,
+                with_options=self._with_options, *args, **kwargs)
+        finally:
+            invalidate_for_documents(self.collection_name, doc_or_docs)
+
+    def remove(self, query, *args, **kwargs):
+        try:
+            return operations.multishard_remove(
+                self.collection_name, query,
+                with_options=self._with_options, *args, **kwargs)
+        finally:
+            invalidate_for_query(self.collection_name, query)
+
+    def count_documents(self, *args, **kwargs):
+        return operations.multishard_count_documents(
             self.collection_name,
             with_options=self._with_options, *args, **kwargs)
 
-    def insert(self, *args, **kwargs):
-        return operations.multishard_insert(
-            self.collection_name,
-            with_options=self._with_options, *args, **kwargs)
+    def estimated_document_count(self, **kwargs):
+        return operations.multishard_estimated_document_count(
+            self.collection_name, with_options=self._with_options, **kwargs)
 
-    def remove(self, *args, **kwargs):
-        return operations.multishard_remove(
+    def distinct(self, *args, **kwargs):
+        return operations.multishard_distinct(
             self.collection_name,
             with_options=self._with_options, *args, **kwargs)
 
-    def save(self, *args, **kwargs):
-        return operations.multishard_save(
-            self.collection_name,
-            with_options=self._with_options, *args, **kwargs)
+    def save(self, doc, *args, **kwargs):
+        index_documents(self.collection_name, doc)
+        try:
+            return operations.multishard_save(
+                self.collection_name, doc,
+                with_options=self._with_options, *args, **kwargs)
+        finally:
+            invalidate_for_documents(self.collection_name, doc)
+
+    def bulk_write(self, requests, *args, **kwargs):
+        reindexes = []
+        for request in requests:
+            if isinstance(request, InsertOne):
+                index_documents(self.collection_name, request._doc)
+            elif hasattr(request, '_doc'):
+                reindexes.append(prepare_index_update(
+                    self.collection_name, request._filter, request._doc,
+                    getattr(request, '_upsert', False)))
+        try:
+            with finishing_index_updates(reindexes):
+                return operations.multishard_bulk_write(
+                    self.collection_name, requests,
+                    with_options=self._with_options, *args, **kwargs)
+        finally:
+            invalidate_for_bulk_write(self.collection_name, requests)
 
     def with_options(self, **kwargs):
         new_collection = ShardAwareCollectionProxy(self.collection_name)
@@ -220,14 +456,29 @@ class ShardAwareCollectionProxy(object):
             self.collection_name,
             with_options=self._with_options, *args, **kwargs)
 
-    def find_and_modify(self, *args, **kwargs):
+    def find_and_modify(self, query, update, *args, **kwargs):
         # !!!! find_and_modify deprecated
-        return operations.multishard_find_and_modify(
-            self.collection_name, *args, **kwargs)
-
-    def find_one_and_update(self, *args, **kwargs):
-        return operations.multishard_find_one_and_update(
-            self.collection_name, *args, **kwargs)
+        reindex = prepare_index_update(
+            self.collection_name, query, update, kwargs.get('upsert', False))
+        try:
+            with finishing_index_updates([reindex]):
+                return operations.multishard_find_and_modify(
+                    self.collection_name, query, update, *args, **kwargs)
+        finally:
+            invalidate_for_query(self.collection_name, query)
+
+    def find_one_and_update(self, query, update, *args, **kwargs):
+        reindex = prepare_index_update(
+            self.collection_name, query, update, kwargs.get('upsert', False))
+        try:
+            with finishing_index_updates([reindex]):
+                return operations.multishard_find_one_and_update(
+                    self.collection_name, query, update, *args, **kwargs)
+        finally:
+            invalidate_for_query(self.collection_name, query)
+
+    def route_explain(self, query):
+        return route_explain(self.collection_name, query)
 
 def make_collection_shard_aware(collection_name):
     """Returns a new object that proxies the given collection and makes it
@@ -248,9 +499,123 @@ def where_is(collection_name, shard_key):
     return location.location
 
 
+def where_are(collection_name, shard_keys):
+    """Returns a dictionary of the form {location: [shard_key, ...]} that
+    says where each of the given shards of data resides. This is much quicker
+    than calling where_is for each shard key as the realm's metadata is only
+    looked at once.
+
+    :param collection_name: The collection name for the shards
+    :param shard_keys: An iterable of the shard keys to look for
+    """
+    realm = _get_realm_for_collection(collection_name)
+    return _get_locations_for_shards(realm, shard_keys)
+
+
+def route_explain(collection_name, query):
+    """Explains how a query would be routed without running it. The result
+    is of the form:
+
+        {
+            'shard_keys': [...] or None,
+            'reasons': [...],
+            'index': field or None,
+            'locations': {location: query sent to that location},
+        }
+
+    shard_keys is None if the query can match documents in any shard.
+    reasons say how the shard keys were worked out from the query. index is
+    the field of the secondary index used to find the shard keys when the
+    query has no usable condition on the shard field.
+
+    :param str collection_name: The collection the query is for
+    :param dict query: The query to explain
+    """
+    realm = _get_realm_for_collection(collection_name)
+    plan = analyse_query(realm['shard_field'], query)
+    shard_keys = plan.shard_keys
+    reasons = list(plan.reasons)
+    index = None
+    if shard_keys is None:
+        index, index_shard_keys = find_index_route(realm, query)
+        if index is not None:
+            shard_keys = index_shard_keys
+            reasons.append(
+                'secondary index on %s lists %d shard keys' % (
+                    index, len(shard_keys)))
+    collection_iterator = operations._create_collection_iterator(
+        collection_name, query, log_untargetted_queries=False)
+    return {
+        'shard_keys': shard_keys,
+        'reasons': reasons,
+        'index': index,
+        'locations': {
+            location: targetted_query
+            for _, targetted_query, location in collection_iterator
+        },
+    }
+
+
+def get_index_build_progress(collection_name):
+    """Returns the index builds that are in progress for the collection in
+    each of its locations, as reported by currentOp. The result is of the
+    form:
+
+        {location: [{'msg': ..., 'progress': {'done': ..., 'total': ...},
+                     'secs_running': ..., 'command': ...}, ...]}
+
+    Indexes are built in every location at once by create_index on a shard
+    aware collection (use max_concurrency_per_cluster to limit the number of
+    builds run against each cluster at a time).
+
+    :param str collection_name: The collection that indexes are being built on
+    """
+    return operations.multishard_index_build_progress(collection_name)
+
+
 def set_untargetted_query_callback(callback):
     """Sets the callback function for when an untargetted query occurs. The
     function should take two arguments: collection_name, query. The return value
     of the function will be ignored.
     """
     operations.untargetted_query_callback = callback
+
+
+def get_metadata_stats():
+    """Returns statistics about the metadata caches and the round trips made
+    to the controller. The result is of the form:
+
+        {
+            'round_trips': {
+                call_site: {
+                    'count': ..., 'total_time': ...,
+                    'buckets': [(upper_bound, cumulative_count), ...],
+                },
+            },
+            'caches': {
+                cache_name: {
+                    key: {'hits': ..., 'misses': ..., 'hit_ratio': ...},
+                },
+            },
+            'entries': {
+                realm_name: {'entries': ..., 'memory': ..., 'evictions': ...},
+            },
+        }
+
+    Call sites are single-shard-refresh, full-refresh, realm-lookup,
+    pause-check, cluster-uri and secondary-index-lookup. The shard_metadata
+    cache is keyed by realm, the realm cache by collection, the cluster_uri
+    cache by cluster and the route_plan cache by shard field.
+    """
+    return {
+        'round_trips': stats.get_round_trip_stats(),
+        'caches': stats.get_cache_stats(),
+        'entries': get_cache_sizes(),
+    }
+
+
+def reset_metadata_stats():
+    """Resets all counters returned by get_metadata_stats. Cached entries are
+    left alone.
+    """
+    stats.reset_stats()
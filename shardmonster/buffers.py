@@ -0,0 +1,143 @@
+"""Buffers for results that have to be held on to by the client, such as
+untargetted queries that are sorted here rather than by the server.
+
+Documents are kept in memory until a memory budget is used up. At that point
+they are sorted and spilled to a temporary file as a run of BSON. Once all of
+the documents have been added the runs are merged, reading each one back a
+document at a time.
+"""
+from __future__ import absolute_import
+
+import heapq
+import tempfile
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+# The default number of bytes (of BSON) a sort buffer can hold in memory
+DEFAULT_SORT_MEMORY_BUDGET = 64 * 1024 * 1024
+
+# Only one in this many documents is encoded to measure its size. The rest
+# are assumed to be the average size of those measured.
+SIZE_SAMPLE_INTERVAL = 32
+
+_MISSING = object()
+_DONE = object()
+
+
+class BufferedResults(object):
+    """An iterator over buffered results that is truthy while it still has
+    results to give. Any temporary files are closed once it is exhausted.
+    """
+    def __init__(self, iterator, files=()):
+        self._iterator = iter(iterator)
+        self._files = list(files)
+        self._next = _MISSING
+
+    def _peek(self):
+        if self._next is _MISSING:
+            try:
+                self._next = next(self._iterator)
+            except StopIteration:
+                self._next = _DONE
+                self.close()
+        return self._next
+
+    def __bool__(self):
+        return self._peek() is not _DONE
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        result = self._peek()
+        if result is _DONE:
+            raise StopIteration
+        self._next = _MISSING
+        return result
+
+    next = __next__
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._files = []
+        self._iterator = iter(())
+        self._next = _DONE
+
+
+class SortBuffer(object):
+    """Sorts documents using at most (roughly) memory_budget bytes of memory.
+    sort_key is a key function as used by sorted. Spilled documents are read
+    back with the given codec_options, so RawBSONDocuments stay raw.
+
+    The size of a RawBSONDocument is known. Other documents are estimated
+    from a sample of them, so only documents that are spilled are encoded.
+    """
+    def __init__(self, sort_key, memory_budget=None, codec_options=None):
+        self.sort_key = sort_key
+        self.memory_budget = memory_budget or DEFAULT_SORT_MEMORY_BUDGET
+        self.codec_options = codec_options or bson.DEFAULT_CODEC_OPTIONS
+        self.runs_spilled = 0
+        self._in_memory = []
+        self._in_memory_bytes = 0
+        self._runs = []
+        self._added = 0
+        self._sampled = 0
+        self._sampled_bytes = 0
+
+    def add(self, doc):
+        self._in_memory.append(doc)
+        self._in_memory_bytes += self._estimate_size(doc)
+        if self._in_memory_bytes > self.memory_budget:
+            self._spill()
+
+    def _estimate_size(self, doc):
+        if isinstance(doc, RawBSONDocument):
+            return len(doc.raw)
+        if self._added % SIZE_SAMPLE_INTERVAL == 0:
+            self._sampled += 1
+            self._sampled_bytes += len(bson.BSON.encode(doc))
+        self._added += 1
+        return float(self._sampled_bytes) / self._sampled
+
+    def _spill(self):
+        run = tempfile.TemporaryFile()
+        for doc in sorted(self._in_memory, key=self.sort_key):
+            if isinstance(doc, RawBSONDocument):
+                run.write(doc.raw)
+            else:
+                run.write(bson.BSON.encode(doc))
+        run.seek(0)
+        self._runs.append(run)
+        self.runs_spilled += 1
+        self._in_memory = []
+        self._in_memory_bytes = 0
+
+    def results(self):
+        """Returns the sorted documents as BufferedResults. No more documents
+        can be added afterwards.
+        """
+        in_memory = sorted(self._in_memory, key=self.sort_key)
+        self._in_memory = []
+        if not self._runs:
+            return BufferedResults(in_memory)
+
+        runs = [
+            bson.decode_file_iter(run, self.codec_options)
+            for run in self._runs]
+        runs.append(iter(in_memory))
+        # Ties are broken by the order the documents were added in, which
+        # keeps the sort stable and stops documents being compared
+        decorated = [
+            self._decorate(run, run_index) for run_index, run in
+            enumerate(runs)]
+        merged = (item[-1] for item in heapq.merge(*decorated))
+        files, self._runs = self._runs, []
+        return BufferedResults(merged, files)
+
+    def _decorate(self, docs, run_index):
+        for position, doc in enumerate(docs):
+            yield self.sort_key(doc), run_index, position, doc
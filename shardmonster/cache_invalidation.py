@@ -0,0 +1,145 @@
+"""Keeps document caches (see shardmonster.document_cache) in step with writes
+made by other processes by tailing the oplog of every location that a
+collection's realm uses.
+
+Inserts and updates invalidate the shard key of the document changed, as they
+can change which documents a cached query (or cached miss) would find. Deletes
+invalidate the _id of the document removed. Anything else that touches the
+collection (such as dropping it) or losing our place in the oplog clears the
+whole cache.
+"""
+from __future__ import absolute_import
+
+import sys
+import threading
+
+from shardmonster import document_cache, metadata
+from shardmonster.connection import (
+    close_thread_connections, get_connection, parse_location)
+from shardmonster.sharder import tail_oplog_for_collection
+
+# Number of seconds to wait between reading the oplogs
+DEFAULT_POLL_INTERVAL = 0.1
+
+
+def _get_latest_oplog_pos(collection):
+    oplog = collection.database.client['local']['oplog.rs']
+    return oplog.find({}, sort=[('$natural', -1)])[0]['ts']
+
+
+_UNKNOWN = object()
+
+
+def _get_updated_shard_key(shard_field, entry, collection):
+    """Returns the shard key of the document changed by an update oplog
+    entry, or _UNKNOWN if it can't be found. The document is looked up if
+    the entry doesn't say.
+    """
+    for doc in (entry['o2'], entry['o']):
+        if shard_field in doc:
+            return doc[shard_field]
+    if collection is None:
+        return _UNKNOWN
+    doc = collection.find_one(
+        {'_id': entry['o2']['_id']}, {shard_field: 1})
+    if doc is None or shard_field not in doc:
+        # It has gone since. Any cached copy is invalidated by its _id.
+        return None
+    return doc[shard_field]
+
+
+class DocumentCacheInvalidator(threading.Thread):
+    """Tails the oplogs for a collection and invalidates its document cache.
+    Call stop() to finish.
+    """
+    def __init__(self, collection_name, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.collection_name = collection_name
+        self.poll_interval = poll_interval
+        self.exception = None
+        self._positions = {}
+        self._stopped = threading.Event()
+        super(DocumentCacheInvalidator, self).__init__()
+        self.daemon = True
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def run(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self._read_oplogs()
+                except Exception:
+                    # Writes might have been missed
+                    self.exception = sys.exc_info()
+                    self._positions = {}
+                    self._clear()
+                self._stopped.wait(self.poll_interval)
+        finally:
+            close_thread_connections(threading.current_thread())
+
+    def _read_oplogs(self):
+        realm = metadata._get_realm_for_collection(self.collection_name)
+        for location in metadata._get_all_locations_for_realm(realm):
+            cluster_name, database_name = parse_location(location)
+            collection = get_connection(cluster_name)[database_name][
+                self.collection_name]
+            if location not in self._positions:
+                # Anything written before now is either already invalidated
+                # or was read after being written
+                self._positions[location] = _get_latest_oplog_pos(collection)
+                continue
+
+            cursor = tail_oplog_for_collection(
+                collection, self._positions[location])
+            try:
+                for entry in cursor:
+                    self.invalidate_for_entry(
+                        realm['shard_field'], entry, collection)
+                    self._positions[location] = entry['ts']
+            finally:
+                cursor.close()
+
+    def invalidate_for_entry(self, shard_field, entry, collection=None):
+        """Invalidates the cache for an oplog entry. The collection the entry
+        is from is used to find the shard key of updated documents.
+        """
+        cache = document_cache.get_document_cache(self.collection_name)
+        if cache is None:
+            return
+        op = entry['op']
+        if op == 'i':
+            doc = entry['o']
+            if shard_field in doc:
+                cache.invalidate(shard_keys=[doc[shard_field]])
+            else:
+                cache.clear()
+        elif op == 'u':
+            doc_id = entry['o2']['_id']
+            shard_key = _get_updated_shard_key(
+                shard_field, entry, collection)
+            if shard_key is _UNKNOWN:
+                cache.clear()
+            else:
+                cache.invalidate(shard_keys=[shard_key], doc_ids=[doc_id])
+        elif op == 'd':
+            cache.invalidate(doc_ids=[entry['o']['_id']])
+        elif op != 'n':
+            cache.clear()
+
+    def _clear(self):
+        cache = document_cache.get_document_cache(self.collection_name)
+        if cache is not None:
+            cache.clear()
+
+
+def start_document_cache_invalidation(
+        collection_name, poll_interval=DEFAULT_POLL_INTERVAL):
+    """Starts a thread that invalidates the collection's document cache for
+    writes made by any process. The oplog of each location is read every
+    poll_interval seconds. Returns the thread, call stop() on it to finish.
+    """
+    invalidator = DocumentCacheInvalidator(collection_name, poll_interval)
+    invalidator.start()
+    return invalidator
@@ -0,0 +1,358 @@
+"""Coalescing of concurrent requests against the same location.
+
+Writes: when write coalescing is active, single document inserts made by
+concurrent threads against the same location are collected for a short window
+and sent as one unordered bulk write. Each caller still gets back its own _id
+or error. Updates and upserts are not coalesced as a bulk write only reports
+how many documents were modified in total, not by which of its updates.
+
+The first writer to arrive at an empty coalescer becomes the leader. It waits
+for the window to pass (or for the batch to fill up), performs the bulk write
+and hands the results out to everyone in the batch.
+
+Reads: when read coalescing is active, identical targetted reads that are in
+flight at the same time share a single round trip (single flight). The first
+reader does the query and everyone who asked for the same thing while it was
+running gets a copy of the results.
+"""
+from __future__ import absolute_import
+
+import copy
+import sys
+import threading
+import time
+
+import six
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+
+from shardmonster.connection import get_connection, parse_location
+
+# How long (in seconds) the leader waits for other writes to arrive
+DEFAULT_WINDOW = 0.002
+# The longest window allowed. A write held for the window goes to the location
+# its shard was at when it was submitted, so the window has to be well inside
+# the pause a migration makes for writes that are under way (0.1s).
+MAX_WINDOW = 0.05
+# A batch is sent as soon as it reaches this many writes
+DEFAULT_MAX_BATCH_SIZE = 500
+
+_DUPLICATE_KEY_ERROR_CODES = {11000, 11001, 12582}
+
+_config = None
+_coalescers = {}
+_coalescers_lock = threading.Lock()
+
+_read_coalescing_active = False
+_reads_in_flight = {}
+_read_counts = {}
+_reads_lock = threading.Lock()
+
+
+class _PendingWrite(object):
+    def __init__(self, request):
+        self.request = request
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class WriteCoalescer(object):
+    """Coalesces single document writes against one collection in one
+    location.
+    """
+    def __init__(self, location, collection_name, with_options=None,
+                 window=DEFAULT_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+        self.location = location
+        self.collection_name = collection_name
+        self.with_options = with_options or {}
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.writes = 0
+        self._condition = threading.Condition()
+        self._pending = []
+
+    def _get_collection(self):
+        # Resolved by the leader each time so that the connection used always
+        # belongs to the thread doing the write.
+        cluster_name, database_name = parse_location(self.location)
+        collection = get_connection(cluster_name)[database_name][
+            self.collection_name]
+        if self.with_options:
+            collection = collection.with_options(**self.with_options)
+        return collection
+
+    def submit(self, request):
+        """Submits an InsertOne and blocks until it has been written. Returns
+        the _id of the inserted document.
+        """
+        pending = _PendingWrite(request)
+        with self._condition:
+            self._pending.append(pending)
+            is_leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch_size:
+                self._condition.notify_all()
+
+        if is_leader:
+            self._lead()
+
+        pending.done.wait()
+        if pending.exc_info:
+            six.reraise(*pending.exc_info)
+        return pending.result
+
+    def _lead(self):
+        deadline = time.time() + self.window
+        with self._condition:
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = self._pending
+            self._pending = []
+            self.batches += 1
+            self.writes += len(batch)
+        self._flush(batch)
+
+    def _flush(self, batch):
+        try:
+            try:
+                result = self._get_collection().bulk_write(
+                    [pending.request for pending in batch], ordered=False)
+                details = result.bulk_api_result
+            except BulkWriteError as e:
+                details = e.details
+            self._distribute(batch, details)
+        except Exception:
+            exc_info = sys.exc_info()
+            for pending in batch:
+                if not pending.done.is_set():
+                    pending.exc_info = exc_info
+        finally:
+            for pending in batch:
+                pending.done.set()
+
+    def _distribute(self, batch, details):
+        errors = {
+            error['index']: error for error in details.get('writeErrors', [])}
+        write_concern_errors = details.get('writeConcernErrors', [])
+        for index, pending in enumerate(batch):
+            if index in errors:
+                pending.exc_info = _exc_info_for_write_error(errors[index])
+            elif write_concern_errors:
+                pending.exc_info = _exc_info_for_write_error(
+                    write_concern_errors[0])
+            else:
+                pending.result = pending.request._doc['_id']
+            pending.done.set()
+
+
+def _exc_info_for_write_error(error):
+    code = error.get('code')
+    if code in _DUPLICATE_KEY_ERROR_CODES:
+        error_class = DuplicateKeyError
+    else:
+        error_class = WriteError
+    try:
+        raise error_class(error.get('errmsg'), code, error)
+    except error_class:
+        return sys.exc_info()
+
+
+def activate_write_coalescing(
+        window=DEFAULT_WINDOW, max_batch_size=DEFAULT_MAX_BATCH_SIZE):
+    """Activates coalescing of single document inserts made through shard
+    aware collections.
+
+    :param float window: Number of seconds to wait for other writes to the
+        same location before sending a batch. At most MAX_WINDOW.
+    :param int max_batch_size: Send a batch as soon as it has this many
+        writes in it.
+    """
+    global _config
+    if window > MAX_WINDOW:
+        raise Exception(
+            'The write coalescing window cannot be longer than %ss'
+            % MAX_WINDOW)
+    with _coalescers_lock:
+        _config = {'window': window, 'max_batch_size': max_batch_size}
+        _coalescers.clear()
+
+
+def deactivate_write_coalescing():
+    global _config
+    with _coalescers_lock:
+        _config = None
+        _coalescers.clear()
+
+
+def is_write_coalescing_active():
+    return _config is not None
+
+
+def options_key(with_options):
+    """Returns a hashable key for the options given to with_options."""
+    with_options = with_options or {}
+    return tuple(sorted(
+        ((key, repr(value)) for key, value in six.iteritems(with_options)),
+        key=lambda item: item[0]))
+
+
+def get_write_coalescer(location, collection_name, with_options=None):
+    """Gets the coalescer for the given location and collection. Returns None
+    if write coalescing is not active.
+    """
+    if _config is None:
+        return None
+    key = (location, collection_name, options_key(with_options))
+    with _coalescers_lock:
+        if _config is None:
+            return None
+        if key not in _coalescers:
+            _coalescers[key] = WriteCoalescer(
+                location, collection_name, with_options, **_config)
+        return _coalescers[key]
+
+
+def get_write_coalescing_stats():
+    """Returns the number of batches sent and writes coalesced into them for
+    each location and collection.
+    """
+    with _coalescers_lock:
+        coalescers = list(_coalescers.values())
+    stats = {}
+    for coalescer in coalescers:
+        key = (coalescer.location, coalescer.collection_name)
+        batches, writes = stats.get(key, (0, 0))
+        stats[key] = (batches + coalescer.batches, writes + coalescer.writes)
+    return {
+        key: {'batches': batches, 'writes': writes}
+        for key, (batches, writes) in six.iteritems(stats)
+    }
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.exc_info = None
+
+
+def activate_read_coalescing():
+    """Activates single flight for targetted reads. Identical finds (same
+    collection, query, projection and options) that are in flight at the same
+    time are sent to Mongo once. Note that coalesced finds are read into memory
+    in full rather than being streamed.
+    """
+    global _read_coalescing_active
+    _read_coalescing_active = True
+
+
+def deactivate_read_coalescing():
+    global _read_coalescing_active
+    _read_coalescing_active = False
+
+
+def is_read_coalescing_active():
+    return _read_coalescing_active
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return ('doc', tuple(
+            (key, _freeze(item)) for key, item in six.iteritems(value)))
+    if isinstance(value, (list, tuple)):
+        return ('list', tuple(_freeze(item) for item in value))
+    return (type(value).__name__, repr(value))
+
+
+def _normalise_clause(key, value):
+    if key in ('$and', '$or', '$nor') and isinstance(value, list):
+        return ('list', tuple(_normalise_query(query) for query in value))
+    if (isinstance(value, dict) and value and
+            all(k.startswith('$') for k in value)):
+        return ('ops', _normalise_items(value))
+    # Embedded documents are matched exactly (including their key order) so
+    # are left alone
+    return _freeze(value)
+
+
+def _normalise_items(d):
+    return tuple(sorted(
+        ((key, _normalise_clause(key, value))
+         for key, value in six.iteritems(d)),
+        key=lambda item: item[0]))
+
+
+def _normalise_query(query):
+    """Turns a query into something hashable. Queries that only differ in the
+    order of their fields or operators normalise to the same thing.
+    """
+    return ('query', _normalise_items(query or {}))
+
+
+def make_read_key(collection_name, location, query, args, kwargs,
+                  with_options):
+    return (
+        collection_name, location, _normalise_query(query), _freeze(args),
+        tuple(sorted(
+            ((key, _freeze(value)) for key, value in six.iteritems(kwargs)),
+            key=lambda item: item[0])),
+        options_key(with_options))
+
+
+def single_flight(collection_name, key, fn):
+    """Returns fn() unless an identical request (one with the same key) is
+    already in flight, in which case that request's result is shared. Every
+    caller gets its own copy of the result if it was shared.
+    """
+    with _reads_lock:
+        counts = _read_counts.setdefault(collection_name, [0, 0])
+        counts[0] += 1
+        flight = _reads_in_flight.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _reads_in_flight[key] = _Flight()
+        else:
+            flight.followers += 1
+            counts[1] += 1
+
+    if is_leader:
+        try:
+            flight.result = fn()
+        except Exception:
+            flight.exc_info = sys.exc_info()
+        finally:
+            with _reads_lock:
+                del _reads_in_flight[key]
+            flight.done.set()
+    else:
+        flight.done.wait()
+
+    if flight.exc_info:
+        six.reraise(*flight.exc_info)
+    if is_leader and not flight.followers:
+        # Nobody else can join once the flight has landed
+        return flight.result
+    return copy.deepcopy(flight.result)
+
+
+def get_read_coalescing_stats():
+    """Returns the number of targetted reads and how many of them were served
+    by sharing another read's result, per collection:
+
+        {collection_name: {'requests': ..., 'coalesced': ...}}
+    """
+    with _reads_lock:
+        return {
+            collection_name: {'requests': requests, 'coalesced': coalesced}
+            for collection_name, (requests, coalesced)
+            in six.iteritems(_read_counts)
+        }
+
+
+def reset_read_coalescing_stats():
+    with _reads_lock:
+        _read_counts.clear()
@@ -7,6 +7,8 @@ import time
 
 import six
 
+from shardmonster import stats
+
 logger = logging.getLogger("shardmonster")
 CLUSTER_CACHE_LENGTH = 10 * 60  # Cache URI lookups for 10 minutes
 
@@ -15,6 +17,7 @@ _cluster_uri_cache = {}
 _controlling_db = None
 _controlling_db_config = None
 _post_connect_callbacks = []
+_thread_close_callbacks = []
 
 
 def _connect_to_mongo(uri):
@@ -26,6 +29,21 @@ def register_post_connect(fn):
     return fn
 
 
+def register_thread_close(fn):
+    """Registers fn(thread) to be called when a thread's connections are
+    closed, so that anything holding on to them can let go.
+    """
+    _thread_close_callbacks.append(fn)
+    return fn
+
+
+def thread_key(thread):
+    """Returns the key that things cached per thread (such as connections)
+    are kept under for the given thread.
+    """
+    return str(thread)
+
+
 def connect_to_controller(uri, db_name):
     """Connects to the controlling database. This contains information about
     the realms, shards and clusters.
@@ -72,7 +90,7 @@ def get_controlling_db():
 
 def get_connection(cluster_name):
     global _connection_cache
-    key = '%s:%s' % (threading.current_thread(), cluster_name)
+    key = '%s:%s' % (thread_key(threading.current_thread()), cluster_name)
     if key not in _connection_cache:
         connection = _make_connection(cluster_name)
         _connection_cache[key] = connection
@@ -88,8 +106,10 @@ def close_thread_connections(thread):
     global _connection_cache
     to_remove = set()
     for key in six.iterkeys(_connection_cache):
-        if key.startswith('%s:' % thread):
+        if key.startswith('%s:' % thread_key(thread)):
             to_remove.add(key)
+    for fn in _thread_close_callbacks:
+        fn(thread)
     for key in to_remove:
         _connection_cache[key].close()
         del _connection_cache[key]
@@ -116,17 +136,31 @@ def ensure_cluster_exists(name, uri):
     :param str name: The name of the cluster
     :param str uri: The URI to use for the cluster
     """
+    ensure_clusters_exist({name: uri})
+
+
+def ensure_clusters_exist(clusters):
+    """As ensure_cluster_exists but for many clusters at once. The existing
+    clusters are looked up with a single query and any missing ones are added
+    together.
+
+    :param dict clusters: Maps the name of each cluster onto its URI
+    """
     coll = _get_cluster_coll()
-    cursor = coll.find({'name': name})
-    if not cursor.count():
-        add_cluster(name, uri)
-    else:
-        existing = cursor[0]
-        if existing['uri'] != uri:
+    existing = {
+        cluster['name']: cluster
+        for cluster in coll.find({'name': {'$in': list(clusters)}})}
+    missing = []
+    for name, uri in six.iteritems(clusters):
+        if name not in existing:
+            missing.append({'name': name, 'uri': uri})
+        elif existing[name]['uri'] != uri:
             logger.warn(
                 "Cluster in database does not match cluster being configured. "
                 "This is normally OK if clusters are being moved about."
             )
+    if missing:
+        coll.insert(missing)
 
 
 def get_cluster_uri(name):
@@ -137,13 +171,17 @@ def get_cluster_uri(name):
     global _cluster_uri_cache
     now = time.time()
     if name not in _cluster_uri_cache or _cluster_uri_cache[name][1] <= now:
+        stats.record_cache_miss(stats.CLUSTER_URI_CACHE, name)
         coll = _get_cluster_coll()
-        cluster = coll.find_one({'name': name})
+        with stats.timed_round_trip(stats.CLUSTER_URI):
+            cluster = coll.find_one({'name': name})
         if not cluster:
             raise Exception('Cluster %s has not been configured' % name)
         uri = cluster['uri']
         expiry = now + CLUSTER_CACHE_LENGTH
         _cluster_uri_cache[name] = (uri, expiry)
+    else:
+        stats.record_cache_hit(stats.CLUSTER_URI_CACHE, name)
 
     return _cluster_uri_cache[name][0]
 
@@ -0,0 +1,282 @@
+"""An opt-in read-through cache for targetted find_one calls made through
+shard aware collections.
+
+Entries are keyed by the normalised query along with any projection and
+options, so {'x': 1, 'y': 2} and {'y': 2, 'x': 1} share an entry. Each entry
+also remembers the shard key that the query targetted and the _id of the
+document found so that it can be invalidated by either.
+
+Writes made through shard aware collections invalidate the shard keys that
+they touch (or the whole cache if they aren't targetted). Writes made by
+other processes can be picked up by tailing the oplog of each location, see
+shardmonster.cache_invalidation.
+
+A cache is bounded both by the number of entries and by the (BSON) size of
+the documents held. The least recently used entries are evicted first and
+every entry expires after a TTL regardless.
+"""
+from __future__ import absolute_import
+
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import bson
+
+from shardmonster import operations
+from shardmonster.coalescing import make_read_key
+from shardmonster.metadata import _get_realm_for_collection
+from shardmonster.routing import analyse_query
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+# Number of seconds an entry is used for
+DEFAULT_TTL = 60
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class _Entry(object):
+    def __init__(self, expiry, shard_key, doc_id, doc, size):
+        self.expiry = expiry
+        self.shard_key = shard_key
+        self.doc_id = doc_id
+        self.doc = doc
+        self.size = size
+
+
+class DocumentCache(object):
+    """The cached documents for one collection."""
+    def __init__(self, collection_name, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.collection_name = collection_name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.memory_usage = 0
+        self._entries = OrderedDict()
+        self._by_shard_key = {}
+        self._by_id = {}
+        # Changes whenever anything is invalidated. A read that started
+        # before an invalidation mustn't put what it read into the cache.
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (True, document) if there is an entry for the key and
+        (False, None) otherwise. The document is a copy.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expiry <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+        return True, copy.deepcopy(entry.doc)
+
+    def put(self, key, shard_key, doc, generation):
+        """Caches the document found by a read that began at the given
+        generation. Nothing is cached if anything has been invalidated since.
+        """
+        size = len(bson.BSON.encode(doc)) if doc else 0
+        if size > self.max_bytes:
+            return
+        entry = _Entry(
+            time.time() + self.ttl, shard_key,
+            doc.get('_id') if doc else None, copy.deepcopy(doc), size)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._by_shard_key.setdefault(shard_key, set()).add(key)
+            if entry.doc_id is not None:
+                self._by_id.setdefault(entry.doc_id, set()).add(key)
+            self.memory_usage += size
+            while (len(self._entries) > self.max_entries or
+                   self.memory_usage > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.memory_usage -= entry.size
+        for index, value in (
+                (self._by_shard_key, entry.shard_key),
+                (self._by_id, entry.doc_id)):
+            keys = index.get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+
+    def invalidate(self, shard_keys=(), doc_ids=()):
+        """Drops every entry for the given shard keys and document ids."""
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            keys = set()
+            for shard_key in shard_keys:
+                keys |= self._by_shard_key.get(shard_key, set())
+            for doc_id in doc_ids:
+                keys |= self._by_id.get(doc_id, set())
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.invalidations += 1
+            self._entries.clear()
+            self._by_shard_key.clear()
+            self._by_id.clear()
+            self.memory_usage = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def activate_document_cache(
+        collection_name, max_entries=DEFAULT_MAX_ENTRIES,
+        max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+    """Caches the results of targetted find_one calls made against the given
+    collection through shard aware collections.
+
+    Writes made through shard aware collections in this process invalidate
+    the cache. Use shardmonster.cache_invalidation to pick up writes made
+    elsewhere, otherwise entries can be stale for up to ttl seconds.
+
+    :param str collection_name: The collection to cache documents for.
+    :param int max_entries: The maximum number of queries to cache results
+        for.
+    :param int max_bytes: The maximum total (BSON) size of the cached
+        documents.
+    :param float ttl: Number of seconds to cache each result for.
+    """
+    with _caches_lock:
+        _caches[collection_name] = DocumentCache(
+            collection_name, max_entries, max_bytes, ttl)
+
+
+def deactivate_document_cache(collection_name):
+    with _caches_lock:
+        _caches.pop(collection_name, None)
+
+
+def get_document_cache(collection_name):
+    """Returns the DocumentCache for the collection or None if documents
+    aren't being cached for it.
+    """
+    return _caches.get(collection_name)
+
+
+def get_document_cache_stats():
+    """Returns statistics for each collection that is being cached:
+
+        {collection_name: {
+            'hits': ..., 'misses': ..., 'hit_ratio': ..., 'entries': ...,
+            'memory': ..., 'evictions': ..., 'invalidations': ...}}
+    """
+    with _caches_lock:
+        caches = list(_caches.values())
+    results = {}
+    for cache in caches:
+        lookups = cache.hits + cache.misses
+        results[cache.collection_name] = {
+            'hits': cache.hits,
+            'misses': cache.misses,
+            'hit_ratio': float(cache.hits) / lookups if lookups else 0.0,
+            'entries': len(cache),
+            'memory': cache.memory_usage,
+            'evictions': cache.evictions,
+            'invalidations': cache.invalidations,
+        }
+    return results
+
+
+def cached_find_one(collection_name, query, with_options={}, **kwargs):
+    """As operations.multishard_find_one but reads through the collection's
+    document cache when the query targets a single shard.
+    """
+    cache = get_document_cache(collection_name)
+    shard_key = None
+    if (cache is not None and isinstance(query, dict) and
+            'deadline' not in kwargs):
+        shard_key = operations._get_query_target(collection_name, query)
+    if shard_key is None:
+        return operations.multishard_find_one(
+            collection_name, query, with_options=with_options, **kwargs)
+
+    key = make_read_key(collection_name, None, query, (), kwargs, with_options)
+    found, doc = cache.get(key)
+    if found:
+        return doc
+    generation = cache.generation
+    doc = operations.multishard_find_one(
+        collection_name, query, with_options=with_options, **kwargs)
+    cache.put(key, shard_key, doc, generation)
+    return doc
+
+
+def invalidate_for_query(collection_name, query, update=None):
+    """Invalidates the cached documents that a write with the given query
+    (and update, for upserts) could have changed.
+    """
+    cache = get_document_cache(collection_name)
+    if cache is None:
+        return
+    realm = _get_realm_for_collection(collection_name)
+    shard_keys = analyse_query(realm['shard_field'], query).shard_keys
+    if shard_keys is None:
+        cache.clear()
+        return
+    shard_keys = list(shard_keys)
+    if update is not None:
+        upsert_target = operations._get_upsert_target(realm, update)
+        if upsert_target is not None:
+            shard_keys.append(upsert_target)
+    cache.invalidate(shard_keys=shard_keys)
+
+
+def invalidate_for_documents(collection_name, docs):
+    """Invalidates the cached documents for the shards of the given
+    documents, such as those that have just been inserted.
+    """
+    cache = get_document_cache(collection_name)
+    if cache is None:
+        return
+    if isinstance(docs, dict):
+        docs = [docs]
+    shard_field = _get_realm_for_collection(collection_name)['shard_field']
+    shard_keys = set()
+    for doc in docs:
+        if shard_field not in doc:
+            cache.clear()
+            return
+        shard_keys.add(doc[shard_field])
+    cache.invalidate(shard_keys=shard_keys)
+
+
+def invalidate_for_bulk_write(collection_name, requests):
+    cache = get_document_cache(collection_name)
+    if cache is None:
+        return
+    for request in requests:
+        if hasattr(request, '_filter'):
+            update = getattr(request, '_doc', None)
+            invalidate_for_query(
+                collection_name, request._filter,
+                update if getattr(request, '_upsert', False) else None)
+        else:
+            invalidate_for_documents(collection_name, request._doc)
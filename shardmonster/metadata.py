@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 
+import itertools
+import sys
+import threading
 import time
+from collections import OrderedDict
 
 import six
 
+from shardmonster import stats
 from shardmonster.connection import (
     _cluster_uri_cache, _get_cluster_coll, get_controlling_db)
 
@@ -38,9 +43,31 @@ POST_MIGRATION_PHASES = {
     ShardStatus.POST_MIGRATION_DELETE,
 }
 
+# Shards in a short cache phase are still cached for a few milliseconds. This
+# bounded staleness is accounted for by the sharder when pausing writes.
+IN_FLUX_CACHE_LENGTH = 0.01
+
+# The maximum number of shards per realm that are cached from single shard
+# lookups. Shards loaded by a full refresh do not count towards this.
+MAX_CACHED_SHARDS = 10000
+
+# The most shard keys that are looked up in a single query when fetching the
+# metadata for several shards at once
+MAX_SHARD_KEYS_PER_QUERY = 1000
+
+# How a realm's shard metadata is refreshed. Per shard refreshes only the shard
+# being looked up. Full refreshes every shard in the realm at once, which suits
+# small realms where every shard is looked up anyway.
+REFRESH_PER_SHARD = 'per-shard'
+REFRESH_FULL = 'full'
+REFRESH_MODES = {REFRESH_PER_SHARD, REFRESH_FULL}
+
 _caching_timeout = 0
+_in_flux_caching_timeout = IN_FLUX_CACHE_LENGTH
+_max_cached_shards = MAX_CACHED_SHARDS
 _metadata_stores = {}
 _realm_cache = {}
+_versions = itertools.count(1)
 
 
 def _get_realm_coll():
@@ -53,91 +80,292 @@ def _get_shards_coll():
 
 class ShardMetadataStore(object):
     """A store of all the shard metadata for a particular realm.
-    This is NOT thread safe.
+
+    Changes to the cache are made under a lock as the store is shared by
+    every thread (including the workers that fan queries out). Round trips
+    to the controller are made outside of it.
 
     We want to cache as many lookups as possible
     We have generic shard information
      - This should be cached for as long as possible
-     - If a single shard is being moved then this part needs to be refreshed
+     - If shards are being moved then those parts need to be refreshed
     We also have specific queries for specific shards
      - These should be cached unless they are actively migrating
+     - These are evicted least recently used first once there are more than
+       max_entries of them. Shards loaded by a full refresh are never evicted
+       as the realm's locations are built from them.
     """
-    def __init__(self, collection_name):
+    def __init__(self, collection_name, max_entries=None):
         self._cache = {}
         self.collection_name = collection_name
+        self.max_entries = max_entries
+        # The realm document, if known. This carries the realm's cache policy.
+        self.realm = None
+        self.evictions = 0
+        # Changes whenever the cached location or status of a shard changes
+        # (or the cache is flushed) so that anything derived from it (such as
+        # routed collections) knows to look again. Versions are unique across
+        # stores.
+        self.version = next(_versions)
         self._global_timeout = 0
-        self._in_flux = None
+        # Each shard that is in a short cache phase is tracked separately so
+        # that several shards in the realm can be migrated at once
+        self._in_flux = set()
+        self._from_full_refresh = set()
+        # The shard keys that can be evicted, least recently used first
+        self._evictable = OrderedDict()
+        self._lock = threading.RLock()
 
     def metadata_changed(self):
         """Call this when metadata is changed. This will flush the cache.
         """
-        self._cache = {}
-        self._global_timeout = 0
+        with self._lock:
+            self._cache = {}
+            self.version = next(_versions)
+            self._global_timeout = 0
+            self._in_flux = set()
+            self._from_full_refresh = set()
+            self._evictable = OrderedDict()
+
+    def _touch(self, shard_key):
+        """Returns the cached metadata for the shard, marking it as most
+        recently used, or None if it isn't cached or has expired.
+        """
+        with self._lock:
+            entry = self._cache.get(shard_key)
+            if entry is None or entry[1] <= time.time():
+                return None
+            if shard_key in self._evictable:
+                del self._evictable[shard_key]
+                self._evictable[shard_key] = None
+            return entry[0]
 
     def get_single_shard_metadata(self, shard_key):
-        if not self._cache_entry_is_valid(shard_key):
-            self._refresh_single_shard_metadata(shard_key)
-        return self._cache[shard_key][0]
+        shard = self._touch(shard_key)
+        if shard is not None:
+            stats.record_cache_hit(
+                stats.SHARD_METADATA_CACHE, self.collection_name)
+            return shard
+
+        stats.record_cache_miss(
+            stats.SHARD_METADATA_CACHE, self.collection_name)
+        if (self._refresh_mode() == REFRESH_FULL and
+                self._global_timeout < time.time()):
+            self._refresh_all_shard_metadata()
+            shard = self._touch(shard_key)
+            if shard is not None:
+                return shard
+        return self._refresh_single_shard_metadata(shard_key)
+
+    def get_many_shard_metadata(self, shard_keys):
+        """Returns {shard_key: metadata} for the given shard keys. Any that
+        aren't cached are fetched together with a single query.
+        """
+        results = {}
+        missing = []
+        for shard_key in shard_keys:
+            if shard_key in results or shard_key in missing:
+                continue
+            shard = self._touch(shard_key)
+            if shard is not None:
+                stats.record_cache_hit(
+                    stats.SHARD_METADATA_CACHE, self.collection_name)
+                results[shard_key] = shard
+            else:
+                stats.record_cache_miss(
+                    stats.SHARD_METADATA_CACHE, self.collection_name)
+                missing.append(shard_key)
+        if not missing:
+            return results
+
+        if (self._refresh_mode() == REFRESH_FULL and
+                self._global_timeout < time.time()):
+            self._refresh_all_shard_metadata()
+            still_missing = []
+            for shard_key in missing:
+                shard = self._touch(shard_key)
+                if shard is not None:
+                    results[shard_key] = shard
+                else:
+                    still_missing.append(shard_key)
+            missing = still_missing
+        if missing:
+            results.update(self._refresh_shards_metadata(missing))
+        return results
+
+    def get_entry_expiry(self, shard_key):
+        """Returns when the cached metadata for the shard expires or 0 if it
+        isn't cached.
+        """
+        return self._cache.get(shard_key, (None, 0))[1]
+
+    def entry_count(self):
+        return len(self._cache)
+
+    def memory_usage(self):
+        """Returns an estimate of the number of bytes used by the cache.
+        """
+        with self._lock:
+            entries = list(six.iteritems(self._cache))
+        total = sys.getsizeof(self._cache)
+        for shard_key, (shard, _) in entries:
+            total += sys.getsizeof(shard_key) + sys.getsizeof(shard)
+            for key, value in six.iteritems(shard):
+                total += sys.getsizeof(key) + sys.getsizeof(value)
+        return total
+
+    def _refresh_mode(self):
+        policy = (self.realm or {}).get('cache_policy') or {}
+        return policy.get('refresh_mode', REFRESH_PER_SHARD)
+
+    def _get_realm(self):
+        if self.realm is None:
+            return _get_realm_by_name(self.collection_name)
+        return self.realm
+
+    def _add_single_shard_entry(self, shard_key, shard, expiry):
+        with self._lock:
+            if self._routing_changed(shard_key, shard):
+                self.version = next(_versions)
+            self._cache[shard_key] = (shard, expiry)
+            if shard_key not in self._from_full_refresh:
+                self._evictable.pop(shard_key, None)
+                self._evictable[shard_key] = None
+            self._evict()
+
+    def _evict(self):
+        if self.max_entries is None:
+            return
+        while len(self._evictable) > self.max_entries:
+            shard_key, _ = self._evictable.popitem(last=False)
+            del self._cache[shard_key]
+            self._in_flux.discard(shard_key)
+            self.evictions += 1
 
     def _cache_entry_is_valid(self, shard_key):
-        now = time.time()
-        return (self._in_flux != shard_key and
-                shard_key in self._cache and
-                self._cache[shard_key][1] > now)
+        entry = self._cache.get(shard_key)
+        return entry is not None and entry[1] > time.time()
 
     def get_all_shard_metadata(self):
         now = time.time()
         if self._global_timeout < now:
             self._refresh_all_shard_metadata()
-        elif self._in_flux:
-            self._refresh_single_shard_metadata(self._in_flux)
-
-        return {
-            shard_key: metadata for
-            shard_key, (metadata, _) in six.iteritems(self._cache)
-        }
-
-    def _refresh_single_shard_metadata(self, shard_key):
-        global _caching_timeout
-        shards = list(self._query_shards_collection(shard_key))
-
-        generic_expiry = time.time() + _caching_timeout
-        if shards:
-            shard, = shards
-            if shard['status'] in SHORT_CACHE_PHASES:
-                self._in_flux = shard['shard_key']
-                expiry = 0
-            else:
-                expiry = generic_expiry
-
-            self._cache[shard['shard_key']] = (shard, expiry)
         else:
-            shard = {
-                'location': _get_realm_by_name(self.collection_name)['default_dest'],  # noqa
-                'status': ShardStatus.AT_REST,
-                'realm': _get_realm_by_name(self.collection_name)['name'],
+            with self._lock:
+                in_flux = list(self._in_flux)
+            for shard_key in in_flux:
+                if not self._cache_entry_is_valid(shard_key):
+                    self._refresh_single_shard_metadata(shard_key)
+
+        with self._lock:
+            return {
+                shard_key: metadata for
+                shard_key, (metadata, _) in six.iteritems(self._cache)
             }
-            self._cache[shard_key] = (shard, generic_expiry)
 
-    def _refresh_all_shard_metadata(self):
-        global _caching_timeout
-        cursor = self._query_shards_collection()
-        self._global_timeout = time.time() + _caching_timeout
-        self._in_flux = None
-
-        for shard in cursor:
-            if shard['status'] in SHORT_CACHE_PHASES:
-                assert not self._in_flux, "Multiple shards in motion"
-                self._in_flux = shard['shard_key']
-                expiry = 0
-            else:
-                expiry = self._global_timeout
+    def _refresh_single_shard_metadata(self, shard_key):
+        with stats.timed_round_trip(stats.SINGLE_SHARD_REFRESH):
+            shards = list(self._query_shards_collection(shard_key))
+        return self._add_refreshed_shards([shard_key], shards)[shard_key]
+
+    def _refresh_shards_metadata(self, shard_keys):
+        shards = []
+        with stats.timed_round_trip(stats.MULTI_SHARD_REFRESH):
+            for i in range(0, len(shard_keys), MAX_SHARD_KEYS_PER_QUERY):
+                shards.extend(_get_shards_coll().find({
+                    'realm': self._get_realm()['name'],
+                    'shard_key': {
+                        '$in': shard_keys[i:i + MAX_SHARD_KEYS_PER_QUERY]},
+                }))
+        return self._add_refreshed_shards(shard_keys, shards)
+
+    def _add_refreshed_shards(self, shard_keys, shards):
+        """Caches the shards found when looking up the given shard keys. Any
+        shard key without a shard is at rest in the realm's default location.
+        Returns {shard_key: metadata}.
+        """
+        # Looked up before taking the lock as it can be a round trip
+        found = set(shard['shard_key'] for shard in shards)
+        if any(shard_key not in found for shard_key in shard_keys):
+            realm = self._get_realm()
+        with self._lock:
+            now = time.time()
+            generic_expiry = now + get_caching_duration(self.realm)
+            results = {}
+            for shard in shards:
+                if shard['status'] in SHORT_CACHE_PHASES:
+                    self._in_flux.add(shard['shard_key'])
+                    expiry = now + get_in_flux_caching_duration(self.realm)
+                else:
+                    self._in_flux.discard(shard['shard_key'])
+                    expiry = generic_expiry
+
+                self._add_single_shard_entry(
+                    shard['shard_key'], shard, expiry)
+                results[shard['shard_key']] = shard
+
+            for shard_key in shard_keys:
+                if shard_key in results:
+                    continue
+                shard = {
+                    'location': realm['default_dest'],
+                    'status': ShardStatus.AT_REST,
+                    'realm': realm['name'],
+                }
+                self._in_flux.discard(shard_key)
+                self._from_full_refresh.discard(shard_key)
+                self._add_single_shard_entry(shard_key, shard, generic_expiry)
+                results[shard_key] = shard
+            return results
+
+    def _routing_changed(self, shard_key, shard):
+        """Returns True if the cached metadata for the shard (if any) routes
+        differently to the given metadata.
+        """
+        cached = self._cache.get(shard_key)
+        if cached is None:
+            return False
+        return any(
+            cached[0].get(field) != shard.get(field)
+            for field in ('location', 'new_location', 'status'))
 
-            self._cache[shard['shard_key']] = (shard, expiry)
+    def _refresh_all_shard_metadata(self):
+        with stats.timed_round_trip(stats.FULL_REFRESH):
+            cursor = list(self._query_shards_collection())
+        with self._lock:
+            now = time.time()
+            self._global_timeout = now + get_caching_duration(self.realm)
+            in_flux_expiry = now + get_in_flux_caching_duration(self.realm)
+            self._in_flux = set()
+            previous_full_refresh = self._from_full_refresh
+            self._from_full_refresh = set()
+
+            changed = False
+            for shard in cursor:
+                if shard['status'] in SHORT_CACHE_PHASES:
+                    self._in_flux.add(shard['shard_key'])
+                    expiry = in_flux_expiry
+                else:
+                    expiry = self._global_timeout
+
+                changed = changed or self._routing_changed(
+                    shard['shard_key'], shard)
+                self._from_full_refresh.add(shard['shard_key'])
+                self._evictable.pop(shard['shard_key'], None)
+                self._cache[shard['shard_key']] = (shard, expiry)
+            # Shards that have been removed altogether
+            removed = previous_full_refresh - self._from_full_refresh
+            if removed:
+                changed = True
+                for shard_key in removed:
+                    self._evictable[shard_key] = None
+            if changed:
+                self.version = next(_versions)
+            self._evict()
 
     def _query_shards_collection(self, shard_key=None):
         shards_coll = _get_shards_coll()
-        query = {'realm': _get_realm_by_name(self.collection_name)['name']}
+        query = {'realm': self._get_realm()['name']}
         if shard_key:
             query['shard_key'] = shard_key
         return shards_coll.find(query)
@@ -163,28 +391,67 @@ def realm_changed(realm):
     _get_metadata_store(realm).metadata_changed()
 
 
+def realm_policy_changed(realm):
+    """Call this when the cache policy of a realm changes. Only the caches for
+    that realm are flushed.
+    """
+    _realm_cache.pop(realm['collection'], None)
+    store = _get_metadata_store(realm)
+    store.metadata_changed()
+    store.realm = realm
+
+
+def _get_location_name(shard):
+    """Returns the location that reads for the given shard metadata go to."""
+    if shard['status'] in POST_MIGRATION_PHASES:
+        return shard['new_location']
+    return shard['location']
+
+
 def _get_location_for_shard(realm, shard_key):
     """Gets the locations for the given shard. The result will be a single
     LocationMetadata object.
     """
     shard = _get_metadata_for_shard(realm, shard_key)
-
-    status = shard['status']
-    if status in POST_MIGRATION_PHASES:
-        location = LocationMetadata(shard['new_location'])
-        location.contains.append(shard_key)
-    else:
-        location = LocationMetadata(shard['location'])
-        location.contains.append(shard_key)
+    location = LocationMetadata(_get_location_name(shard))
+    location.contains.append(shard_key)
     return location
 
 
+def _get_locations_for_shards(realm, shard_keys):
+    """Groups the given shard keys by the location that reads for them go to.
+    The result will be of the form:
+
+        { location: [shard_key, ...] }
+
+    The metadata for the whole realm is fetched (or taken from the cache)
+    once rather than for each shard key.
+    """
+    shards = _get_shard_metadata_for_realm(realm)
+    shard_locations = {
+        shard_key: _get_location_name(shard)
+        for shard_key, shard in six.iteritems(shards)}
+
+    default_location = realm['default_dest']
+    locations = {}
+    for shard_key in shard_keys:
+        location = shard_locations.get(shard_key, default_location)
+        keys = locations.get(location)
+        if keys is None:
+            keys = locations[location] = []
+        keys.append(shard_key)
+    return locations
+
+
 def _get_metadata_store(realm):
     global _metadata_stores
     realm_name = realm['name']
     if realm_name not in _metadata_stores:
-        _metadata_stores[realm_name] = ShardMetadataStore(realm_name)
-    return _metadata_stores[realm_name]
+        _metadata_stores[realm_name] = ShardMetadataStore(
+            realm_name, max_entries=_max_cached_shards)
+    store = _metadata_stores[realm_name]
+    store.realm = realm
+    return store
 
 
 def _get_shard_metadata_for_realm(realm):
@@ -195,6 +462,10 @@ def _get_metadata_for_shard(realm, shard_key):
     return _get_metadata_store(realm).get_single_shard_metadata(shard_key)
 
 
+def _get_metadata_for_shards(realm, shard_keys):
+    return _get_metadata_store(realm).get_many_shard_metadata(shard_keys)
+
+
 def _get_all_locations_for_realm(realm):
     """Gets all the locations for the given realm. The results will be of the
     form:
@@ -238,41 +509,101 @@ def _get_realm_for_collection(collection_name):
     now = time.time()
     realm, expiry = _realm_cache.get(collection_name, (None, 0))
     if expiry <= now:
+        stats.record_cache_miss(stats.REALM_CACHE, collection_name)
         realms_coll = _get_realm_coll()
         try:
-            realm = realms_coll.find({'collection': collection_name})[0]
+            with stats.timed_round_trip(stats.REALM_LOOKUP):
+                realm = realms_coll.find({'collection': collection_name})[0]
         except IndexError:
             raise Exception(
                 'Realm for collection %s does not exist' % collection_name)
-        expiry = now + _caching_timeout
+        expiry = now + get_caching_duration(realm)
         _realm_cache[collection_name] = realm, expiry
+    else:
+        stats.record_cache_hit(stats.REALM_CACHE, collection_name)
     return _realm_cache[collection_name][0]
 
 
 def _get_realm_by_name(realm_name):
     realms_coll = _get_realm_coll()
     try:
-        return realms_coll.find({'name': realm_name})[0]
+        with stats.timed_round_trip(stats.REALM_LOOKUP):
+            return realms_coll.find({'name': realm_name})[0]
     except IndexError:
         raise Exception(
             'Realm named %s does not exist' % realm_name)
 
 
-def get_caching_duration():
-    return _caching_timeout
+def get_cache_sizes():
+    """Returns the number of shard metadata entries cached, an estimate of the
+    memory they use and how many have been evicted for each realm.
+    """
+    return {
+        realm_name: {
+            'entries': store.entry_count(),
+            'memory': store.memory_usage(),
+            'evictions': store.evictions,
+        }
+        for realm_name, store in six.iteritems(_metadata_stores)
+    }
+
+
+def _get_cache_policy(realm):
+    if realm is None:
+        return {}
+    return realm.get('cache_policy') or {}
 
 
-def activate_caching(timeout):
+def get_caching_duration(realm=None):
+    """Returns how long metadata is cached for. If a realm document is given
+    then that realm's cache policy is taken into account.
+    """
+    return _get_cache_policy(realm).get('timeout', _caching_timeout)
+
+
+def get_longest_caching_duration(realm=None, now=None):
+    """Returns the longest time that metadata for the realm may still be
+    cached for in any process. Just after the realm's timeout is lowered
+    other processes may hold entries cached under the previous timeout, so
+    that is used until they have all expired.
+    """
+    duration = get_caching_duration(realm)
+    previous = (realm or {}).get('previous_cache_timeout') or {}
+    if previous.get('until', 0) > (now or time.time()):
+        duration = max(duration, previous['timeout'])
+    return duration
+
+
+def get_in_flux_caching_duration(realm=None):
+    """Returns how long metadata for a shard in a short cache phase may be
+    cached for. This is never longer than the general caching duration.
+    """
+    in_flux_timeout = _get_cache_policy(realm).get(
+        'in_flux_timeout', _in_flux_caching_timeout)
+    return min(in_flux_timeout, get_caching_duration(realm))
+
+
+def activate_caching(timeout, in_flux_timeout=IN_FLUX_CACHE_LENGTH,
+                     max_entries=MAX_CACHED_SHARDS):
     """Activates caching of metadata.
 
     :param int timeout: Number of seconds to cache metadata for.
+    :param float in_flux_timeout: Number of seconds to cache metadata for
+        shards that are in the middle of a migration. This should be tiny
+        (5-20ms) as it is added to the pause during a migration.
+    :param int max_entries: The maximum number of shards per realm to cache
+        from single shard lookups. The least recently used are evicted first.
+        None means no limit.
 
     Caching is generally a good thing. However, during a migration there will be
     a pause equal to whatever the caching timeout. This is to avoid stale reads
     and writes when the source of truth for a shard changes location.
     """
-    global _caching_timeout, _metadata_stores, _realm_cache
+    global _caching_timeout, _in_flux_caching_timeout, _max_cached_shards, \
+        _metadata_stores, _realm_cache
     _caching_timeout = timeout
+    _in_flux_caching_timeout = in_flux_timeout
+    _max_cached_shards = max_entries
 
     # Blank out the metadata stores as changing the timeout will really mess
     # up everything in them
@@ -294,8 +625,11 @@ def wipe_metadata():
     _metadata_stores.clear()
 
 
-def are_migrations_happening():
+def are_migrations_happening(realm_name=None, shard_key=None):
     """Returns True if any migrations are happening. Otherwise, False.
+
+    The check can be narrowed to a single realm and, within that realm, to a
+    single shard.
     """
     coll = _get_shards_coll()
     states = [
@@ -305,4 +639,9 @@ def are_migrations_happening():
         ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION,
         ShardStatus.POST_MIGRATION_DELETE,
     ]
-    return coll.find({'status': {'$in': states}}).count() > 0
+    query = {'status': {'$in': states}}
+    if realm_name is not None:
+        query['realm'] = realm_name
+        if shard_key is not None:
+            query['shard_key'] = shard_key
+    return coll.find(query).count() > 0
@@ -4,27 +4,133 @@ clusters.
 from __future__ import absolute_import
 
 import bson
-import numbers
+import copy
+import itertools
+import threading
 import time
+from collections import OrderedDict, deque
 from functools import cmp_to_key
 
 import six
-
-from shardmonster.connection import get_connection, parse_location
+from bson.raw_bson import RawBSONDocument
+from pymongo.errors import BulkWriteError, ExecutionTimeout
+from pymongo.operations import (
+    DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne)
+from pymongo.results import BulkWriteResult
+from pymongo.write_concern import WriteConcern
+
+from shardmonster import stats
+from shardmonster.aggregation import split_pipeline
+from shardmonster.buffers import BufferedResults, SortBuffer
+from shardmonster.coalescing import (
+    get_write_coalescer, is_read_coalescing_active, make_read_key,
+    options_key, single_flight)
+from shardmonster.connection import (
+    get_connection, parse_location, register_thread_close, thread_key)
 from shardmonster.metadata import (
     _get_shards_coll, ShardStatus, _get_realm_for_collection,
-    _get_location_for_shard, _get_all_locations_for_realm,
-    _get_metadata_for_shard)
+    _get_location_name, _get_all_locations_for_realm, _get_metadata_for_shard,
+    _get_metadata_for_shards, _get_metadata_store)
+from shardmonster.parallel import (
+    raise_first_failure, run_in_dedicated_threads, run_in_parallel)
+from shardmonster.raw_documents import (
+    get_raw_value, remove_raw_field, uses_raw_documents)
+from shardmonster.routing import (
+    _is_valid_type_for_sharding, analyse_query, get_single_target)
+from shardmonster.secondary_indexes import find_index_target
 
 # When an untargetted query happens this function will be called:
 #   untargetted_query_callback(collection_name, query)
 # This allows for an application to instrument untargetted queries and fix them
 untargetted_query_callback = None
 
+# Inserts of a list of documents are sent to each location in batches of at
+# most this many documents or (BSON encoded) bytes
+MAX_INSERT_BATCH_DOCS = 1000
+MAX_INSERT_BATCH_BYTES = 8 * 1024 * 1024
+
+# The number of locations an untargetted update or remove is sent to at once
+# when run in parallel
+PARALLEL_WRITE_CONCURRENCY = 8
+
+# The number of results read from each location straight away when the
+# locations of an untargetted query with a deadline are opened together
+PREFETCH_DOCS = 101
+
+# The maximum number of routed collections kept in _collection_cache
+MAX_ROUTE_CACHE_ENTRIES = 10000
+
+# How untargetted finds leave out the shards that a location is not the source
+# of truth for (see api.set_realm_exclusion_mode)
+EXCLUDE_ON_SERVER = 'server'
+EXCLUDE_ON_CLIENT = 'client'
+EXCLUDE_AUTO = 'auto'
+EXCLUSION_MODES = (EXCLUDE_ON_SERVER, EXCLUDE_ON_CLIENT, EXCLUDE_AUTO)
+
+# In auto mode shards are only excluded on the client when a location has at
+# most this many to exclude, as their documents are sent back to be dropped
+MAX_CLIENT_SIDE_EXCLUDES = 5
+
+# Arguments that are handled by MultishardCursor rather than pymongo
+_CURSOR_KWARGS = ('_hint', 'sort_memory_budget', 'deadline', 'partial_results')
+
+# Legacy write concern arguments that are turned into a WriteConcern
+_WRITE_CONCERN_KWARGS = ('w', 'wtimeout', 'j', 'fsync')
+
+# Maps (thread, collection name, shard key, options) onto the collection that
+# targetted operations for that shard key should use. See
+# _get_routed_collection.
+_collection_cache = OrderedDict()
+_collection_cache_lock = threading.Lock()
+
+
+class MultishardWriteError(Exception):
+    """Raised when a write sent to several locations in parallel failed in
+    some of them. succeeded maps each location that was written to onto its
+    result and failed maps each location that failed onto its exception.
+    """
+    def __init__(self, succeeded, failed):
+        self.succeeded = succeeded
+        self.failed = failed
+        super(MultishardWriteError, self).__init__(
+            'Write failed in %s (succeeded in %s)' % (
+                ', '.join(sorted(failed)), ', '.join(sorted(succeeded))))
+
+
+class MultishardIndexError(Exception):
+    """Raised when an index build failed in some locations. succeeded lists
+    the locations that have the index and failed maps each location that
+    does not onto its exception.
+    """
+    def __init__(self, succeeded, failed):
+        self.succeeded = succeeded
+        self.failed = failed
+        super(MultishardIndexError, self).__init__(
+            'Index build failed in %s (the index exists in %s)' % (
+                ', '.join(sorted(failed)), ', '.join(sorted(succeeded))))
+
+
+class MultishardInsertError(Exception):
+    """Raised when some documents in a multi-document insert failed.
+
+    inserted_ids is in the same order as the documents given to the insert and
+    contains None for any document that failed. errors maps the position of
+    each failed document to the error reported by Mongo.
+    """
+    def __init__(self, inserted_ids, errors):
+        self.inserted_ids = inserted_ids
+        self.errors = errors
+        super(MultishardInsertError, self).__init__(
+            '%d of %d documents failed to insert' % (
+                len(errors), len(inserted_ids)))
+
 
 def _get_value_by_key(d, key):
     """Gets a value from the given dictionary using nesting if appropriate.
+    Only the value itself is decoded from a RawBSONDocument.
     """
+    if isinstance(d, RawBSONDocument):
+        return get_raw_value(d.raw, key)
     key = key.split('.')
     result = d
     for part in key:
@@ -44,34 +150,292 @@ def _create_collection_iterator(collection_name, query, with_options={},
     This does all the hardwork of figuring out what collections to query and how
     to adjust the query to account for any shards that are currently moving.
     """
+    targets = _create_query_targets(
+        collection_name, query, with_options, log_untargetted_queries)
+    for collection, location_query, location, _ in targets:
+        yield collection, location_query, location
+
+
+def _create_query_targets(collection_name, query, with_options={},
+                          log_untargetted_queries=True,
+                          allow_client_exclusion=False):
+    """As _create_collection_iterator but yields a fourth item, the shard keys
+    that must be dropped from the results on the client or None.
+
+    Shards are only excluded on the client if allow_client_exclusion is set
+    and the realm's exclusion mode picks it for the location. Otherwise the
+    query sent to the location excludes them.
+    """
     realm = _get_realm_for_collection(collection_name)
     shard_field = realm['shard_field']
 
-    shard_key = _get_query_target(collection_name, query)
-    if shard_key:
-        location = _get_location_for_shard(realm, shard_key)
-        locations = {location.location: location}
-    else:
-        locations = _get_all_locations_for_realm(realm)
-        global untargetted_query_callback
-        if untargetted_query_callback and log_untargetted_queries:
-            untargetted_query_callback(collection_name, query)
-
+    shard_keys = analyse_query(shard_field, query).shard_keys
+    if shard_keys is None:
+        # A global secondary index can narrow the query down to the shards
+        # of the documents it can match
+        shard_keys = find_index_target(realm, query)
+    if shard_keys is not None and len(shard_keys) <= 1:
+        # The location a shard is routed to never excludes that shard so the
+        # query can be used as is. A query that can't match any shard key is
+        # sent to the default destination (where it will match nothing).
+        if shard_keys:
+            collection, location = _get_routed_collection(
+                realm, collection_name, shard_keys[0], with_options)
+        else:
+            location = realm['default_dest']
+            collection = _get_collection_for_location(
+                location, collection_name, with_options)
+        yield collection, query, location, None
+        return
+
+    if shard_keys:
+        # Each location is only asked for the shard keys that it is the
+        # source of truth for
+        routes = _route_shard_keys(
+            realm, collection_name, shard_keys, with_options)
+        for location, (collection, location_keys) in six.iteritems(routes):
+            yield collection, _restrict_to_shards(
+                query, shard_field, location_keys), location, None
+        return
+
+    locations = _get_all_locations_for_realm(realm)
+    global untargetted_query_callback
+    if untargetted_query_callback and log_untargetted_queries:
+        untargetted_query_callback(collection_name, query)
+
+    mode = EXCLUDE_ON_SERVER
+    if allow_client_exclusion:
+        mode = realm.get('exclusion_mode') or EXCLUDE_ON_SERVER
     for location, location_meta in six.iteritems(locations):
         cluster_name, database_name = parse_location(location)
         connection = get_connection(cluster_name)
         collection = connection[database_name][collection_name]
         if with_options:
             collection = collection.with_options(**with_options)
-        if location_meta.excludes:
-            if len(location_meta.excludes) == 1:
-                query = {'$and': [
-                    query, {shard_field: {'$ne': location_meta.excludes[0]}}]}
-            else:
-                raise Exception('Multiple shards in transit. Aborting')
-        yield collection, query, location
-        if location_meta.excludes:
-            query = query['$and'][0]
+        excludes = location_meta.excludes
+        if excludes and _should_exclude_on_client(
+                mode, shard_field, query, excludes):
+            yield collection, query, location, list(excludes)
+        else:
+            yield collection, _exclude_shards(
+                query, shard_field, excludes), location, None
+
+
+def _should_exclude_on_client(mode, shard_field, query, excludes):
+    if mode == EXCLUDE_AUTO:
+        # Adding an exclusion to a query that has no other condition on the
+        # shard field is what can change the plan the server picks
+        return (len(excludes) <= MAX_CLIENT_SIDE_EXCLUDES and
+                not _has_condition_on(query, shard_field))
+    return mode == EXCLUDE_ON_CLIENT
+
+
+def _has_condition_on(query, field):
+    for key, value in six.iteritems(query or {}):
+        if key == field:
+            return True
+        if key in ('$and', '$or', '$nor') and isinstance(value, list):
+            if any(_has_condition_on(subquery, field) for subquery in value
+                   if isinstance(subquery, dict)):
+                return True
+    return False
+
+
+def _include_field_in_projection(args, kwargs, field):
+    """Makes sure that the projection given to find (either as the second
+    positional argument or as projection/fields) returns the given field.
+    Returns the adjusted args and kwargs and whether the field has to be
+    removed from the results again.
+    """
+    if args:
+        projection = args[0]
+    else:
+        projection = kwargs.get('projection', kwargs.get('fields'))
+    if not projection:
+        return args, kwargs, False
+
+    if isinstance(projection, dict):
+        # Operators such as $slice and $elemMatch can go in either style of
+        # projection so only plain values say that it is an inclusion. _id
+        # only decides it when it is the only field given.
+        others = [
+            value for key, value in six.iteritems(projection) if key != '_id']
+        if others:
+            included = any(_is_inclusion(value) for value in others)
+        else:
+            included = _is_inclusion(projection.get('_id'))
+        if included:
+            if field in projection:
+                return args, kwargs, False
+            adjusted = dict(projection)
+            adjusted[field] = 1
+        else:
+            if field not in projection:
+                return args, kwargs, False
+            adjusted = dict(projection)
+            del adjusted[field]
+            # An empty projection would only return _id
+            adjusted = adjusted or None
+    else:
+        if field in projection:
+            return args, kwargs, False
+        adjusted = list(projection) + [field]
+
+    if args:
+        return (adjusted,) + tuple(args[1:]), kwargs, True
+    kwargs = dict(kwargs)
+    kwargs['projection' if 'projection' in kwargs else 'fields'] = adjusted
+    return args, kwargs, True
+
+
+def _is_inclusion(value):
+    return (isinstance(value, (bool, float) + six.integer_types) and
+            bool(value))
+
+
+def _get_routed_collection(realm, collection_name, shard_key, with_options={},
+                           shard=None):
+    """Returns the collection (and its location) that targetted operations
+    on the given shard key should use. Pass the shard's metadata if it has
+    already been fetched.
+
+    Resolved collections are cached per thread, as connections are, until the
+    metadata for the shard expires or the realm's metadata store is refreshed.
+    """
+    store = _get_metadata_store(realm)
+    key = _route_cache_key(collection_name, shard_key, with_options)
+    cached = _get_cached_route(store, key)
+    if cached:
+        return cached
+
+    if shard is None:
+        shard = _get_metadata_for_shard(realm, shard_key)
+    location = _get_location_name(shard)
+    collection = _get_collection_for_location(
+        location, collection_name, with_options)
+    with _collection_cache_lock:
+        _collection_cache.pop(key, None)
+        _collection_cache[key] = (
+            store.version, store.get_entry_expiry(shard_key), collection,
+            location)
+        while len(_collection_cache) > MAX_ROUTE_CACHE_ENTRIES:
+            _collection_cache.popitem(last=False)
+    return collection, location
+
+
+def _route_cache_key(collection_name, shard_key, with_options):
+    # Keyed as connections are, so that a thread never gets a collection
+    # using another thread's (or a closed) connection
+    return (
+        thread_key(threading.current_thread()), collection_name, shard_key,
+        options_key(with_options))
+
+
+@register_thread_close
+def _forget_thread_routes(thread):
+    key = thread_key(thread)
+    with _collection_cache_lock:
+        for cache_key in [
+                cache_key for cache_key in _collection_cache
+                if cache_key[0] == key]:
+            del _collection_cache[cache_key]
+
+
+def _get_cached_route(store, key):
+    cached = _collection_cache.get(key)
+    if cached:
+        version, expiry, collection, location = cached
+        if version == store.version and expiry > time.time():
+            return collection, location
+    return None
+
+
+def _route_shard_keys(realm, collection_name, shard_keys, with_options={}):
+    """Groups the given shard keys by the location they are routed to.
+    Returns an OrderedDict of location -> (collection, shard keys).
+
+    The metadata for any shard keys that aren't already routed is fetched
+    at once rather than one shard key at a time.
+    """
+    store = _get_metadata_store(realm)
+    unique_keys = []
+    seen = set()
+    for shard_key in shard_keys:
+        if shard_key not in seen:
+            seen.add(shard_key)
+            unique_keys.append(shard_key)
+    unrouted = [
+        shard_key for shard_key in unique_keys
+        if not _get_cached_route(
+            store, _route_cache_key(collection_name, shard_key, with_options))]
+    shards = {}
+    if unrouted:
+        shards = _get_metadata_for_shards(realm, unrouted)
+
+    routes = OrderedDict()
+    for shard_key in unique_keys:
+        collection, location = _get_routed_collection(
+            realm, collection_name, shard_key, with_options,
+            shards.get(shard_key))
+        routes.setdefault(location, (collection, []))[1].append(shard_key)
+    return routes
+
+
+def _restrict_to_shards(query, shard_field, shard_keys):
+    """Adjusts the query so that it only matches the given shard keys."""
+    value = query.get(shard_field)
+    if isinstance(value, dict) and list(value) == ['$in']:
+        restricted = dict(query)
+        restricted[shard_field] = {'$in': shard_keys}
+        return restricted
+    return {'$and': [query, {shard_field: {'$in': shard_keys}}]}
+
+
+def _exclude_shards(query, shard_field, excludes):
+    """Adjusts the query so that it will not match any of the excluded shard
+    keys. Shards are excluded from a location when the location is not the
+    source of truth for them mid-migration.
+    """
+    if not excludes:
+        return query
+    if len(excludes) == 1:
+        exclusion = {shard_field: {'$ne': excludes[0]}}
+    else:
+        exclusion = {shard_field: {'$nin': list(excludes)}}
+    return {'$and': [query, exclusion]}
+
+
+def _find(collection, query, args, kwargs, hint):
+    cursor = collection.find(query, *args, **kwargs)
+    if hint:
+        cursor = cursor.hint(hint)
+    return cursor
+
+
+def _explainer(collection, query, args, kwargs, hint):
+    # Explaining runs a fresh query so that the cursors used for the results
+    # aren't kept around after they are finished with
+    def _explain():
+        return _find(collection, query, args, kwargs, hint).explain()
+    return _explain
+
+
+def _compare_sort_values(sort, values1, values2):
+    for (key, sort_order), v1, v2 in zip(sort, values1, values2):
+        if v1 < v2:
+            return -sort_order
+        elif v1 > v2:
+            return sort_order
+    return 0
+
+
+def _make_sort_key(sort):
+    # The values sorted on are looked up once per document rather than on
+    # every comparison, which matters for RawBSONDocuments
+    compare = cmp_to_key(
+        lambda values1, values2: _compare_sort_values(sort, values1, values2))
+    return lambda doc: compare(
+        [_get_value_by_key(doc, key) for key, _ in sort])
 
 
 class MultishardCursor(object):
@@ -83,14 +447,30 @@ class MultishardCursor(object):
         self.kwargs = kwargs
         self._hint = kwargs.pop('_hint', None)
         self.with_options = kwargs.pop('with_options', {})
+        self._sort_memory_budget = kwargs.pop('sort_memory_budget', None)
+        self._deadline = kwargs.pop('deadline', None)
+        self._partial_results = kwargs.pop('partial_results', False)
+        self._codec_options = self.with_options.get('codec_options')
+        # RawBSONDocuments are passed through without being decoded
+        self._raw = uses_raw_documents(self.with_options)
+        # Locations that were not (fully) read as the deadline passed
+        self.skipped_locations = []
         self._prepared = False
+        self._closed = False
         self._skip = 0
         self._explains = []
+        # Cursors opened against the locations that may still be alive
+        self._open_cursors = []
 
     def _create_collection_iterator(self):
         return _create_collection_iterator(
             self.collection_name, self.query, self.with_options)
 
+    def _create_query_targets(self):
+        return _create_query_targets(
+            self.collection_name, self.query, self.with_options,
+            allow_client_exclusion=True)
+
     def _prepare_for_iteration(self):
         # The multishard cursor has to keep track of a surprising amount of
         # state. When we want to evaluate a multishard cursor the list of
@@ -98,16 +478,56 @@ class MultishardCursor(object):
         # created. This is then used as a basis of iteration and the fact that
         # cursors are changed during iterations is largely not obvious to the
         # end user of this MultishardCursor.
-        self._queries_pending = list(self._create_collection_iterator())
+        self._queries_pending = list(self._create_query_targets())
+        self._shard_field = None
+        if any(target[3] for target in self._queries_pending):
+            self._shard_field = _get_realm_for_collection(
+                self.collection_name)['shard_field']
         self._targetted = len(self._queries_pending) == 1
         self._cached_results = None
+        if self._deadline is not None and not self._targetted:
+            self._open_all_queries()
         self._next_cursor()
         self._prepared = True
         self._skipped = 0
         self._loading_into_memory = False
 
-    def _next_cursor(self):
-        collection, query, location = self._queries_pending.pop(0)
+    def _open_all_queries(self):
+        # Every location is queried at once so that a slow location doesn't
+        # use up the deadline of the others. The first results from each are
+        # read straight away and can still be returned once it has passed.
+        outcomes = run_in_parallel(
+            self._open_and_prefetch, self._queries_pending)
+        opened = []
+        failures = []
+        for outcome in outcomes:
+            if not outcome.failed:
+                opened.append(outcome.result)
+            elif (self._partial_results and
+                    isinstance(outcome.error, ExecutionTimeout)):
+                self.skipped_locations.append(outcome.item[2])
+            else:
+                failures.append(outcome)
+        self._queries_pending = opened
+        for opened_query in opened:
+            self._open_cursors.append(opened_query.cursor)
+            self._explains.append(
+                (opened_query.location, opened_query.explain))
+        if failures:
+            self._stop_cursors()
+            raise_first_failure(failures)
+
+    def _open_and_prefetch(self, target):
+        opened_query = self._open_query(target)
+        opened_query.cursor = _PrefetchedCursor(
+            opened_query.cursor, PREFETCH_DOCS)
+        return opened_query
+
+    def _open_query(self, target):
+        """Opens a cursor for a (collection, query, location, client_excludes)
+        target. Nothing is read from it.
+        """
+        collection, query, location, client_excludes = target
         # On an untargetted query, skip is implemented by getting results back
         # and then applying the skip. In this situation the limit must be
         # increased before doing the query
@@ -120,11 +540,74 @@ class MultishardCursor(object):
                 query_kwargs['limit'] = query_kwargs['limit'] + self._skip
             else:
                 query_kwargs = self.kwargs
-        cursor = collection.find(query, *self.args, **query_kwargs)
-        if self._hint:
-            cursor = cursor.hint(self._hint)
-        self._explains.append((location, cursor.explain))
-        self._current_cursor = cursor
+        if self._deadline is not None:
+            # Each location gets whatever is left of the deadline
+            remaining = self._deadline - time.time()
+            if remaining <= 0:
+                raise ExecutionTimeout(
+                    'Deadline passed before querying %s' % location)
+            remaining_ms = max(1, int(remaining * 1000))
+            query_kwargs = dict(query_kwargs, max_time_ms=min(
+                remaining_ms, query_kwargs.get('max_time_ms') or remaining_ms))
+        if client_excludes and self._targetted:
+            # Only one location is being read so the server has to apply any
+            # limit and skip
+            query = _exclude_shards(query, self._shard_field, client_excludes)
+            client_excludes = None
+        args = self.args
+        strip_shard_field = False
+        if client_excludes:
+            # The shard field is needed to drop the excluded shards. Any limit
+            # is applied once they have been dropped.
+            args, query_kwargs, strip_shard_field = \
+                _include_field_in_projection(
+                    args, query_kwargs, self._shard_field)
+            query_kwargs = dict(query_kwargs)
+            query_kwargs.pop('limit', None)
+        cursor = _find(collection, query, args, query_kwargs, self._hint)
+        if self._targetted and is_read_coalescing_active():
+            cursor = self._coalesce(cursor, query, location, query_kwargs)
+        return _OpenedQuery(
+            cursor, location, set(client_excludes or ()), strip_shard_field,
+            _explainer(collection, query, args, query_kwargs, self._hint))
+
+    def _next_cursor(self):
+        if not self._queries_pending:
+            # Every location was skipped as the deadline passed
+            self._use_query(_OpenedQuery(_ListCursor([]), None, set(), False))
+            return
+        opened_query = self._queries_pending.pop(0)
+        if not isinstance(opened_query, _OpenedQuery):
+            try:
+                opened_query = self._open_query(opened_query)
+            except ExecutionTimeout:
+                if not self._partial_results:
+                    raise
+                self.skipped_locations.append(opened_query[2])
+                opened_query = _OpenedQuery(
+                    _ListCursor([]), None, set(), False)
+            else:
+                if not isinstance(opened_query.cursor, _ListCursor):
+                    self._open_cursors = [
+                        open_cursor for open_cursor in self._open_cursors
+                        if open_cursor.alive]
+                    self._open_cursors.append(opened_query.cursor)
+                self._explains.append(
+                    (opened_query.location, opened_query.explain))
+        self._use_query(opened_query)
+
+    def _use_query(self, opened_query):
+        self._current_cursor = opened_query.cursor
+        self._current_location = opened_query.location
+        self._client_excludes = opened_query.client_excludes
+        self._strip_shard_field = opened_query.strip_shard_field
+
+    def _coalesce(self, cursor, query, location, query_kwargs):
+        key = make_read_key(
+            self.collection_name, location, query, self.args,
+            dict(query_kwargs, _hint=self._hint), self.with_options)
+        docs = single_flight(self.collection_name, key, lambda: list(cursor))
+        return _ListCursor(docs)
 
     def __iter__(self):
         return self
@@ -140,6 +623,8 @@ class MultishardCursor(object):
         return self.__next__()
 
     def _next(self):
+        if self._closed:
+            raise StopIteration
         if not self._prepared:
             self.evaluate()
         safe_skip = self._skip or 0
@@ -155,10 +640,10 @@ class MultishardCursor(object):
         """
         while True:
             if self._cached_results:
-                return self._cached_results.pop(0)
+                return next(self._cached_results)
 
             try:
-                return self._current_cursor.next()
+                return self._next_from_current_cursor()
             except StopIteration:
                 # This cursor is exchausted, move on to the next cursor
                 if self._queries_pending:
@@ -169,10 +654,70 @@ class MultishardCursor(object):
                 else:
                     raise
 
+    def _next_from_current_cursor(self):
+        while True:
+            result = self._read_current_cursor()
+            if not self._client_excludes:
+                return result
+            try:
+                shard_key = _get_value_by_key(result, self._shard_field)
+                if shard_key in self._client_excludes:
+                    continue
+            except (KeyError, TypeError):
+                # Without its shard key there is no telling whether the
+                # document is a stale copy so it is left out
+                continue
+            if self._strip_shard_field:
+                if self._raw:
+                    result = remove_raw_field(
+                        result, self._shard_field, self._codec_options)
+                else:
+                    result.pop(self._shard_field, None)
+            return result
+
+    def _read_current_cursor(self):
+        if self._deadline is None:
+            return self._current_cursor.next()
+
+        try:
+            # Results that were read ahead in time are still returned
+            prefetched = (
+                isinstance(self._current_cursor, _PrefetchedCursor) and
+                self._current_cursor.prefetched)
+            if (time.time() >= self._deadline and not prefetched and
+                    self._current_cursor.alive):
+                raise ExecutionTimeout(
+                    'Deadline passed while reading from %s'
+                    % self._current_location)
+            return self._current_cursor.next()
+        except ExecutionTimeout:
+            # Nothing more is read from this location once the deadline has
+            # passed. In partial results mode it is reported as skipped and
+            # the other locations give whatever they have already fetched.
+            if not self._partial_results:
+                self._stop_cursors()
+                raise
+            self.skipped_locations.append(self._current_location)
+            self._current_cursor.close()
+            self._current_cursor = _ListCursor([])
+            raise StopIteration
+
     def limit(self, limit):
         self.kwargs['limit'] = limit
         return self
 
+    def set_deadline(self, deadline, partial_results=False):
+        """Sets a deadline (as a time.time() timestamp) for reading the
+        results. Each location is queried with a maxTimeMS of whatever is
+        left of the deadline. Once it passes, the cursors are closed and
+        ExecutionTimeout is raised. In partial results mode iteration stops
+        instead and the locations that were not fully read are listed in
+        skipped_locations.
+        """
+        self._deadline = deadline
+        self._partial_results = partial_results
+        return self
+
     def skip(self, skip):
         self._skip = skip
         return self
@@ -184,12 +729,23 @@ class MultishardCursor(object):
             self.kwargs['sort'] = key_or_list
         return self
 
+    def sort_memory_budget(self, memory_budget):
+        """Sets the number of bytes of results that can be held in memory
+        when sorting here rather than on the server. Beyond that, sorted runs
+        are spilled to temporary files.
+        """
+        self._sort_memory_budget = memory_budget
+        return self
+
     def clone(self):
         return MultishardCursor(
             self.collection_name,
             self.query,
             _hint=self._hint,
             with_options=self.with_options,
+            sort_memory_budget=self._sort_memory_budget,
+            deadline=self._deadline,
+            partial_results=self._partial_results,
             *self.args,
             **self.kwargs
         )
@@ -215,7 +771,7 @@ class MultishardCursor(object):
 
     def evaluate(self):
         self._prepare_for_iteration()
-        if len(self._queries_pending) == 0:
+        if self._targetted:
             # By the time this code is reached the first query will have been
             # popped off to create the first cursor. Therefore, 0 pending
             # queries implies this is being run against a single server.
@@ -225,50 +781,83 @@ class MultishardCursor(object):
             return
 
         if 'sort' in self.kwargs:
-            # Note: This is quite inefficient. In an ideal world this would pass
-            # the sort through to each cluster and do the sort at that end and
-            # then do a merge sort to save on memory. However, that is more
-            # complex and I'd rather this was 100% correct and bloated
-            # in memory.
+            # Every result has to be seen before the first can be returned.
+            # The buffer keeps to the memory budget by spilling sorted runs to
+            # disk and merging them.
             self._loading_into_memory = True
-            all_results = list(self)
+            # The key mustn't refer back to the cursor, otherwise the cursor
+            # and any spilled results would form a reference cycle
+            buffer = SortBuffer(
+                _make_sort_key(self.kwargs['sort']),
+                self._sort_memory_budget, self._codec_options)
+            for result in self:
+                buffer.add(result)
             self._loading_into_memory = False
+            self._cached_results = buffer.results()
 
-            def comparator(d1, d2):
-                for key, sort_order in self.kwargs['sort']:
-                    v1 = _get_value_by_key(d1, key)
-                    v2 = _get_value_by_key(d2, key)
-                    if v1 < v2:
-                        return -sort_order
-                    elif v1 > v2:
-                        return sort_order
-                return 0
+        if self.kwargs.get('limit'):
+            limited = list(itertools.islice(self, self.kwargs['limit']))
+            self._stop_cursors()
+            self._cached_results = BufferedResults(limited)
+
+    def _stop_cursors(self, parallel=True):
+        # Nothing more is needed from the locations
+        if self._cached_results:
+            self._cached_results.close()
+        self._queries_pending = []
+        self._current_cursor = _ListCursor([])
+        cursors, self._open_cursors = self._open_cursors, []
+        if parallel and len(cursors) > 1:
+            raise_first_failure(
+                run_in_parallel(lambda cursor: cursor.close(), cursors))
+        else:
+            for cursor in cursors:
+                cursor.close()
 
-            self._cached_results = list(
-                sorted(all_results, key=cmp_to_key(comparator)))
+    def close(self):
+        """Closes the cursors on every location this cursor has been reading
+        from. No more results are returned until the cursor is rewound.
+        """
+        if self._prepared:
+            self._stop_cursors()
+        self._closed = True
 
-        if self.kwargs.get('limit'):
-            # Note: This is also inefficient. This gets back all the results and
-            # then applies the limit. Again, correctness over efficiency.
-            self._cached_results = list(self)[:self.kwargs['limit']]
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # The cursors are closed one at a time as the garbage collector could
+        # be running in a worker of the shared pool
+        if getattr(self, '_prepared', False):
+            self._stop_cursors(parallel=False)
 
     def count(self, **count_kwargs):
-        total = 0
-        for collection, query, _ in self._create_collection_iterator():
-            cursor = collection.find(query, *self.args, **self.kwargs)
-            if self._hint:
-                cursor = cursor.hint(self._hint)
-            total += cursor.count(**count_kwargs)
+        def _count(target):
+            collection, query, _ = target
+            cursor = _find(
+                collection, query, self.args, self.kwargs, self._hint)
+            return cursor.count(**count_kwargs)
+
+        outcomes = run_in_parallel(
+            _count, list(self._create_collection_iterator()))
+        raise_first_failure(outcomes)
+        total = sum(outcome.result for outcome in outcomes)
         if self.kwargs.get('limit'):
             return min(self.kwargs['limit'], total)
         else:
             return total
 
     def rewind(self):
+        if self._prepared:
+            self._stop_cursors()
         self._cached_results = None
         self._current_cursor = None
         self._queries_pending = None
         self._prepared = False
+        self._closed = False
 
     def hint(self, index):
         self._hint = index
@@ -284,6 +873,8 @@ class MultishardCursor(object):
         # current user is not alive then there is a chance that the next cursor
         # could be alive and so we must move onto the next cursor and do
         # the check again.
+        if self._closed:
+            return False
         if not self._prepared:
             self.evaluate()
         current_alive = self._current_cursor.alive or self._cached_results
@@ -294,6 +885,72 @@ class MultishardCursor(object):
         return current_alive
 
 
+class _OpenedQuery(object):
+    """A cursor opened against one location along with how its results are
+    filtered.
+    """
+    def __init__(self, cursor, location, client_excludes, strip_shard_field,
+                 explain=None):
+        self.cursor = cursor
+        self.location = location
+        self.client_excludes = client_excludes
+        self.strip_shard_field = strip_shard_field
+        self.explain = explain
+
+
+class _PrefetchedCursor(object):
+    """Wraps a pymongo cursor whose first results have already been read."""
+    def __init__(self, cursor, count):
+        self.cursor = cursor
+        self._docs = deque(itertools.islice(cursor, count))
+
+    @property
+    def prefetched(self):
+        return len(self._docs)
+
+    def next(self):
+        if self._docs:
+            return self._docs.popleft()
+        return self.cursor.next()
+
+    __next__ = next
+
+    @property
+    def alive(self):
+        return bool(self._docs) or self.cursor.alive
+
+    def close(self):
+        self._docs.clear()
+        self.cursor.close()
+
+
+class _ListCursor(object):
+    """Stands in for a pymongo cursor whose results are already in memory,
+    such as those fetched by a coalesced read.
+    """
+    def __init__(self, docs):
+        self._docs = docs
+        self._position = 0
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._position >= len(self._docs):
+            raise StopIteration
+        self._position += 1
+        return self._docs[self._position - 1]
+
+    __next__ = next
+
+    @property
+    def alive(self):
+        return self._position < len(self._docs)
+
+    def close(self):
+        self._position = len(self._docs)
+
+
 def _create_multishard_iterator(collection_name, query, *args, **kwargs):
     return MultishardCursor(collection_name, query, *args, **kwargs)
 
@@ -303,6 +960,17 @@ def multishard_find(collection_name, query, *args, **kwargs):
 
 
 def multishard_find_one(collection_name, query, **kwargs):
+    realm = _get_realm_for_collection(collection_name)
+    shard_key = _get_query_target(collection_name, query, realm)
+    if (shard_key and not set(_CURSOR_KWARGS) & set(kwargs) and
+            not is_read_coalescing_active()):
+        # Targetted find_ones go straight to the shard's collection rather
+        # than through a MultishardCursor
+        collection, _ = _get_routed_collection(
+            realm, collection_name, shard_key,
+            kwargs.pop('with_options', {}))
+        return collection.find_one(query, **kwargs)
+
     kwargs['limit'] = 1
     cursor = _create_multishard_iterator(collection_name, query, **kwargs)
     try:
@@ -311,93 +979,252 @@ def multishard_find_one(collection_name, query, **kwargs):
         return None
 
 
+def multishard_count_documents(
+        collection_name, query, with_options={}, **kwargs):
+    """Counts the documents matching the query in every location
+    concurrently. skip and limit apply to the overall count.
+    """
+    skip = kwargs.pop('skip', 0)
+    limit = kwargs.pop('limit', 0)
+    if limit:
+        # No single location can contribute more than this to the result
+        kwargs['limit'] = limit + skip
+
+    outcomes = run_in_parallel(
+        lambda target: target[0].count_documents(target[1], **kwargs),
+        list(_create_collection_iterator(
+            collection_name, query, with_options)))
+    raise_first_failure(outcomes)
+    total = max(0, sum(outcome.result for outcome in outcomes) - skip)
+    if limit:
+        return min(limit, total)
+    return total
+
+
+def multishard_estimated_document_count(
+        collection_name, with_options={}, **kwargs):
+    """Estimates the number of documents from the collection statistics of
+    every location. Shards that are excluded from a location (as they are
+    partially copied there mid-migration) are counted and taken off that
+    location's estimate.
+    """
+    realm = _get_realm_for_collection(collection_name)
+    shard_field = realm['shard_field']
+
+    def _estimate(target):
+        location, location_meta = target
+        collection = _get_collection_for_location(
+            location, collection_name, with_options)
+        estimate = collection.estimated_document_count(**kwargs)
+        if location_meta.excludes:
+            estimate -= collection.count_documents(
+                {shard_field: {'$in': list(location_meta.excludes)}})
+        return max(0, estimate)
+
+    outcomes = run_in_parallel(
+        _estimate, list(six.iteritems(_get_all_locations_for_realm(realm))))
+    raise_first_failure(outcomes)
+    return sum(outcome.result for outcome in outcomes)
+
+
+def multishard_distinct(
+        collection_name, key, query=None, with_options={}, **kwargs):
+    """Gets the distinct values of key from every location concurrently and
+    merges them.
+    """
+    outcomes = run_in_parallel(
+        lambda target: target[0].distinct(key, target[1], **kwargs),
+        list(_create_collection_iterator(
+            collection_name, query or {}, with_options)))
+    raise_first_failure(outcomes)
+
+    values = []
+    seen = set()
+    for outcome in outcomes:
+        for value in outcome.result:
+            key = _distinct_key(value)
+            if key in seen:
+                continue
+            seen.add(key)
+            values.append(value)
+    return values
+
+
+def _distinct_key(value):
+    """Gets a key that is equal for two values only if they have the same BSON
+    type and value, so that True, 1 and 1.0 stay distinct as they do in mongo.
+    Works for unhashable values, such as embedded documents, too.
+    """
+    return bson.BSON.encode({'v': value})
+
+
+def _get_collection_for_location(location, collection_name, with_options={}):
+    cluster_name, database_name = parse_location(location)
+    connection = get_connection(cluster_name)
+    collection = connection[database_name][collection_name]
+    if with_options:
+        collection = collection.with_options(**with_options)
+    return collection
+
+
 def multishard_insert(
         collection_name, doc_or_docs, with_options={}, *args, **kwargs):
-    # TODO Remove this and use insert_one/insert_many to comply with new
-    # pymongo deprecations
-    is_multi_insert = isinstance(doc_or_docs, list)
-    if not is_multi_insert:
-        all_docs = [doc_or_docs]
-    else:
-        all_docs = doc_or_docs
+    if isinstance(doc_or_docs, list):
+        return _multishard_insert_many(
+            collection_name, doc_or_docs, with_options, *args, **kwargs)
 
-    _wait_for_pause_to_end(collection_name, doc_or_docs)
+    # TODO Remove this and use insert_one to comply with new pymongo
+    # deprecations
+    doc = doc_or_docs
+    _wait_for_pause_to_end(collection_name, doc)
     realm = _get_realm_for_collection(collection_name)
     shard_field = realm['shard_field']
-    for doc in all_docs:
-        if shard_field not in doc:
-            raise Exception(
-                'Cannot insert document without shard field (%s) present'
-                % shard_field)
+    if shard_field not in doc:
+        raise Exception(
+            'Cannot insert document without shard field (%s) present'
+            % shard_field)
 
     # Inserts can use our generic collection iterator with a specific query
     # that is guaranteed to return exactly one collection.
-    # TODO This makes a multi-insert into lots of small inserts. This could be
-    # optimised. For now, we'll see if this is OK.
-    result = []
-    for doc in all_docs:
-        simple_query = {shard_field: doc[shard_field]}
-        (collection, _, _), = _create_collection_iterator(
-            collection_name, simple_query, with_options)
-        result.append(collection.insert(doc, *args, **kwargs))
-    if not is_multi_insert:
-        return result[0]
-    return result
+    simple_query = {shard_field: doc[shard_field]}
+    (collection, _, location), = _create_collection_iterator(
+        collection_name, simple_query, with_options)
+    coalescer = get_write_coalescer(location, collection_name, with_options)
+    if coalescer and not args and not kwargs:
+        return coalescer.submit(InsertOne(doc))
+    return collection.insert(doc, *args, **kwargs)
 
 
-def _is_valid_type_for_sharding(value):
-    return isinstance(
-        value, six.string_types + (numbers.Integral, bson.ObjectId))
+def _multishard_insert_many(
+        collection_name, docs, with_options={}, *args, **kwargs):
+    """Inserts a list of documents by grouping them by location and then
+    doing batched, unordered insert_manys against each location in parallel.
 
+    Returns the _ids of the documents in the same order as docs.
+    """
+    if args:
+        raise Exception(
+            'Positional arguments are not supported when inserting a list of '
+            'documents')
 
-def _get_query_target(collection_name, query):
+    realm = _get_realm_for_collection(collection_name)
+    shard_field = realm['shard_field']
+    docs_by_shard_key = {}
+    for index, doc in enumerate(docs):
+        if shard_field not in doc:
+            raise Exception(
+                'Cannot insert document without shard field (%s) present'
+                % shard_field)
+        shard_key = doc[shard_field]
+        if not _is_valid_type_for_sharding(shard_key):
+            raise Exception(
+                'Cannot insert document with a shard key of type %s'
+                % type(shard_key).__name__)
+        docs_by_shard_key.setdefault(shard_key, []).append((index, doc))
+
+    # Work out the location of each shard once, no matter how many documents
+    # there are for it.
+    shard_locations = _wait_for_shard_locations(
+        realm, list(docs_by_shard_key))
+    docs_by_location = {}
+    for shard_key, indexed_docs in six.iteritems(docs_by_shard_key):
+        docs_by_location.setdefault(
+            shard_locations[shard_key], []).extend(indexed_docs)
+    for indexed_docs in six.itervalues(docs_by_location):
+        indexed_docs.sort(key=lambda indexed_doc: indexed_doc[0])
+
+    write_concern = {
+        key: kwargs.pop(key) for key in _WRITE_CONCERN_KWARGS if key in kwargs}
+    if write_concern:
+        with_options = dict(
+            with_options, write_concern=WriteConcern(**write_concern))
+    if 'continue_on_error' in kwargs:
+        kwargs.setdefault('ordered', not kwargs.pop('continue_on_error'))
+    kwargs.setdefault('ordered', False)
+
+    def _insert_into_location(location):
+        collection = _get_collection_for_location(
+            location, collection_name, with_options)
+        errors = {}
+        for batch in _batch_docs_by_size(docs_by_location[location]):
+            try:
+                collection.insert_many(
+                    [doc for _, doc in batch], **kwargs)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    errors[batch[error['index']][0]] = error
+                if kwargs['ordered']:
+                    # Everything after the first error in this location was
+                    # never attempted.
+                    failed_index = min(errors)
+                    for index, _ in docs_by_location[location]:
+                        if index > failed_index and index not in errors:
+                            errors[index] = {'errmsg': 'Not attempted'}
+                    break
+        return errors
+
+    outcomes = run_in_parallel(_insert_into_location, list(docs_by_location))
+    raise_first_failure(outcomes)
+
+    errors = {}
+    for outcome in outcomes:
+        errors.update(outcome.result)
+    inserted_ids = [
+        None if index in errors else doc['_id']
+        for index, doc in enumerate(docs)]
+    if errors:
+        raise MultishardInsertError(inserted_ids, errors)
+    return inserted_ids
+
+
+def _batch_docs_by_size(indexed_docs):
+    batch = []
+    batch_bytes = 0
+    for index, doc in indexed_docs:
+        doc_bytes = len(bson.BSON.encode(doc))
+        if batch and (len(batch) >= MAX_INSERT_BATCH_DOCS or
+                      batch_bytes + doc_bytes > MAX_INSERT_BATCH_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((index, doc))
+        batch_bytes += doc_bytes
+
+    if batch:
+        yield batch
+
+
+def _get_query_target(collection_name, query, realm=None):
     """Gets out the targetted shard key from the query if there is one.
     Otherwise, returns None.
     """
-    realm = _get_realm_for_collection(collection_name)
+    if realm is None:
+        realm = _get_realm_for_collection(collection_name)
     shard_field = realm['shard_field']
     return _get_targeted_shard_key_value(shard_field, query)
 
 
 def _get_targeted_shard_key_value(shard_field, query):
-    if shard_field in query and _is_valid_type_for_sharding(query[shard_field]):
-        return query[shard_field]
-
-    elif '$or' in query:
-        values = {
-            _get_targeted_shard_key_value(shard_field, subquery)
-            for subquery in query['$or']
-        }
-
-        # all must explicitly target the same shard key
-        if len(values) > 1:
-            raise Exception('Targeting more that one shard is not supported')
-        if None in values:
-            raise Exception('Query includes $or which does not target a shard')
-
-        return values.pop()
-
-    elif '$and' in query:
-        raise Exception('$and queries are not supported')
-
-    return None
+    return get_single_target(shard_field, query)
 
 
 def _should_pause_write(collection_name, query):
     realm = _get_realm_for_collection(collection_name)
 
-    shard_key = _get_query_target(collection_name, query)
-    if shard_key:
-        meta = _get_metadata_for_shard(realm, shard_key)
-        return \
-            meta['status'] == ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION
+    shard_keys = analyse_query(realm['shard_field'], query).shard_keys
+    if shard_keys is not None:
+        shards = _get_metadata_for_shards(realm, shard_keys)
+        return any(
+            shard['status'] == ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION
+            for shard in six.itervalues(shards))
     else:
         paused_query = {
             'realm': realm['name'],
             'status': ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION
         }
         shards_coll = _get_shards_coll()
-        return shards_coll.find(paused_query).count() > 0
+        with stats.timed_round_trip(stats.PAUSE_CHECK):
+            return shards_coll.find(paused_query).count() > 0
 
 
 def _wait_for_pause_to_end(collection_name, query):
@@ -405,110 +1232,288 @@ def _wait_for_pause_to_end(collection_name, query):
         time.sleep(0.05)
 
 
+def _wait_for_shard_locations(realm, shard_keys):
+    """Waits until none of the shards are paused and returns the location
+    that writes for each of them go to as {shard_key: location}. The metadata
+    for all of the shards is fetched together.
+    """
+    paused = ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION
+    while True:
+        shards = _get_metadata_for_shards(realm, shard_keys)
+        if not any(
+                shard['status'] == paused for shard in six.itervalues(shards)):
+            return {
+                shard_key: _get_location_name(shard)
+                for shard_key, shard in six.iteritems(shards)}
+        time.sleep(0.05)
+
+
+def _get_upsert_target(realm, update):
+    """Gets the shard key that an upsert targets from either the replacement
+    document or its $set. Returns None if the update doesn't target a shard.
+    """
+    shard_field = realm['shard_field']
+    shard_key = _get_targeted_shard_key_value(shard_field, update)
+    if not shard_key and '$set' in update:
+        shard_key = _get_targeted_shard_key_value(shard_field, update['$set'])
+    return shard_key
+
+
 def _get_collection_for_targetted_upsert(
         collection_name, query, update, with_options={}):
-    shard_key = _get_query_target(collection_name, update)
-    if not shard_key:
-        shard_key = _get_query_target(collection_name, update['$set'])
     realm = _get_realm_for_collection(collection_name)
-    location = _get_location_for_shard(realm, shard_key)
-
-    cluster_name, database_name = parse_location(location.location)
-    connection = get_connection(cluster_name)
-    collection = connection[database_name][collection_name]
-    if with_options:
-        collection = collection.with_options(with_options)
+    collection, _ = _get_routed_collection(
+        realm, collection_name, _get_upsert_target(realm, update),
+        with_options)
     return collection
 
 
+def _merge_write_results(results):
+    overall_result = None
+    for result in results:
+        if not overall_result:
+            overall_result = dict(result) if result else result
+        else:
+            overall_result['n'] += result['n']
+    return overall_result
+
+
+def _write_to_locations(collection_iterator, write_fn, parallel=False):
+    """Calls write_fn(collection, query) for everything in the collection
+    iterator and merges the results. In parallel mode the locations are written
+    to concurrently and a MultishardWriteError is raised if any of them fail.
+    """
+    if not parallel:
+        return _merge_write_results(
+            write_fn(collection, query)
+            for collection, query, _ in collection_iterator)
+
+    outcomes = run_in_parallel(
+        lambda target: write_fn(target[0], target[1]),
+        list(collection_iterator),
+        max_concurrency=PARALLEL_WRITE_CONCURRENCY)
+    succeeded = {}
+    failed = {}
+    for outcome in outcomes:
+        location = outcome.item[2]
+        if outcome.failed:
+            failed[location] = outcome.error
+        else:
+            succeeded[location] = outcome.result
+    if failed:
+        raise MultishardWriteError(succeeded, failed)
+    return _merge_write_results(outcome.result for outcome in outcomes)
+
+
 def multishard_update(collection_name, query, update,
-                      with_options={}, **kwargs):
+                      with_options={}, parallel=False, **kwargs):
     _wait_for_pause_to_end(collection_name, query)
-    overall_result = None
     # If this is an upsert then we check the update to see if it might contain
     # the shard key and use that for the collection iterator. Otherwise,
     # we can end up doing an upsert against all clusters... which results in
     # lots of documents all over the place.
-    collection_iterator = None
-    if (kwargs.get('upsert', False) and '$set' in update and
-            _get_query_target(collection_name, update['$set'])):
+    upsert_target = None
+    if kwargs.get('upsert', False):
+        realm = _get_realm_for_collection(collection_name)
+        upsert_target = _get_upsert_target(realm, update)
+
+    if upsert_target:
         # Can't use the normal collection iteration method as it would use the
         # wrong query. Instead, get a specific collection and turn it into the
         # right format.
-        collection = _get_collection_for_targetted_upsert(
-            collection_name, query, update, with_options)
-        collection_iterator = [(collection, query, None)]
-
-    if (kwargs.get('upsert', False) and
-            _get_query_target(collection_name, update)):
-        # As above, but the update is a replace so is not contained within the
-        # $set of the update
-        collection = _get_collection_for_targetted_upsert(
-            collection_name, query, update, with_options)
-        collection_iterator = [(collection, query, None)]
-
-    if not collection_iterator:
+        collection, location = _get_routed_collection(
+            realm, collection_name, upsert_target, with_options)
+        collection_iterator = [(collection, query, location)]
+    else:
         collection_iterator = _create_collection_iterator(
             collection_name, query, with_options)
 
-    for collection, targetted_query, _ in collection_iterator:
-        result = collection.update(targetted_query, update, **kwargs)
-        if not overall_result:
-            overall_result = result
-        else:
-            overall_result['n'] += result['n']
+    def _update(collection, targetted_query):
+        return collection.update(targetted_query, update, **kwargs)
 
-    return overall_result
+    return _write_to_locations(collection_iterator, _update, parallel)
 
 
-def multishard_remove(collection_name, query, with_options={}, **kwargs):
+def multishard_remove(collection_name, query, with_options={}, parallel=False,
+                      **kwargs):
     _wait_for_pause_to_end(collection_name, query)
-    overall_result = None
     collection_iterator = _create_collection_iterator(
         collection_name, query, with_options)
-    for collection, targetted_query, _ in collection_iterator:
-        result = collection.remove(targetted_query, **kwargs)
-        if not overall_result:
-            overall_result = result
-        else:
-            overall_result['n'] += result['n']
 
-    return overall_result
+    def _remove(collection, targetted_query):
+        return collection.remove(targetted_query, **kwargs)
 
+    return _write_to_locations(collection_iterator, _remove, parallel)
 
-def multishard_aggregate(
-        collection_name, pipeline, with_options={}, *args, **kwargs):
+
+def _get_bulk_write_target(collection_name, shard_field, request):
+    """Gets the shard key that a bulk write operation targets. Returns None
+    for operations that have to go to every location.
+    """
+    if isinstance(request, InsertOne):
+        if shard_field not in request._doc:
+            raise Exception(
+                'Cannot insert document without shard field (%s) present'
+                % shard_field)
+        return request._doc[shard_field]
+
+    shard_key = _get_targeted_shard_key_value(shard_field, request._filter)
+    if shard_key is None and getattr(request, '_upsert', False):
+        # As with multishard_update, an upsert can be targetted by the shard
+        # key it will write
+        if isinstance(request, ReplaceOne):
+            shard_key = _get_targeted_shard_key_value(
+                shard_field, request._doc)
+        elif '$set' in request._doc:
+            shard_key = _get_targeted_shard_key_value(
+                shard_field, request._doc['$set'])
+        if shard_key is None:
+            raise Exception(
+                'Cannot perform an untargetted upsert in a bulk write')
+
+    if shard_key is None and isinstance(
+            request, (UpdateOne, DeleteOne, ReplaceOne)):
+        raise Exception(
+            '%s in a bulk write must target a single shard'
+            % type(request).__name__)
+    return shard_key
+
+
+def _with_filter(request, query):
+    new_request = copy.copy(request)
+    new_request._filter = query
+    return new_request
+
+
+def multishard_bulk_write(
+        collection_name, requests, ordered=True, with_options={}, **kwargs):
+    """Performs a bulk write by routing each operation to the location of the
+    shard it targets. Operations are grouped by location and each location is
+    written to concurrently. Ordering is only preserved within a location.
+
+    UpdateMany and DeleteMany that do not target a shard are sent to every
+    location with exclusions for any shards that are moving.
+
+    Returns a pymongo BulkWriteResult that merges the results from each
+    location. Indexes in the result refer to positions in requests.
+    """
     realm = _get_realm_for_collection(collection_name)
     shard_field = realm['shard_field']
 
-    _ensure_aggregate_hits_shard_key(pipeline, shard_field)
+    requests = list(requests)
+    targets = []
+    for request in requests:
+        if not isinstance(request, (
+                InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany,
+                ReplaceOne)):
+            raise Exception(
+                'Unsupported bulk write operation %r' % (request,))
+        targets.append(_get_bulk_write_target(
+            collection_name, shard_field, request))
+
+    # The metadata for every targetted shard is fetched together
+    shard_locations = _wait_for_shard_locations(
+        realm, [shard_key for shard_key in targets if shard_key is not None])
+
+    requests_by_location = {}
+    for index, (request, shard_key) in enumerate(zip(requests, targets)):
+        if shard_key is not None:
+            requests_by_location.setdefault(
+                shard_locations[shard_key], []).append((index, request))
+        else:
+            _wait_for_pause_to_end(collection_name, request._filter)
+            collection_iterator = _create_collection_iterator(
+                collection_name, request._filter, with_options)
+            for _, query, location in collection_iterator:
+                requests_by_location.setdefault(location, []).append(
+                    (index, _with_filter(request, query)))
+
+    def _write_to_location(location):
+        indexed_requests = requests_by_location[location]
+        collection = _get_collection_for_location(
+            location, collection_name, with_options)
+        try:
+            result = collection.bulk_write(
+                [request for _, request in indexed_requests],
+                ordered=ordered, **kwargs)
+        except BulkWriteError as e:
+            return indexed_requests, e.details, False
+        if not result.acknowledged:
+            return indexed_requests, {}, False
+        return indexed_requests, result.bulk_api_result, True
+
+    outcomes = run_in_parallel(_write_to_location, list(requests_by_location))
+    raise_first_failure(outcomes)
+
+    merged = {
+        'writeErrors': [],
+        'writeConcernErrors': [],
+        'nInserted': 0,
+        'nUpserted': 0,
+        'nMatched': 0,
+        'nModified': 0,
+        'nRemoved': 0,
+        'upserted': [],
+    }
+    acknowledged = True
+    for outcome in outcomes:
+        indexed_requests, result, location_acknowledged = outcome.result
+        acknowledged = acknowledged and location_acknowledged
+        for key in ('nInserted', 'nUpserted', 'nMatched', 'nModified',
+                    'nRemoved'):
+            merged[key] += result.get(key, 0) or 0
+        for key in ('writeErrors', 'upserted'):
+            for entry in result.get(key, []):
+                entry = dict(entry)
+                entry['index'] = indexed_requests[entry['index']][0]
+                merged[key].append(entry)
+        merged['writeConcernErrors'].extend(
+            result.get('writeConcernErrors', []))
+
+    merged['writeErrors'].sort(key=lambda error: error['index'])
+    merged['upserted'].sort(key=lambda upsert: upsert['index'])
+    if merged['writeErrors'] or merged['writeConcernErrors']:
+        raise BulkWriteError(merged)
+    return BulkWriteResult(merged, acknowledged)
 
-    # To avoid aggregation needing to be recreated in this client we limit
-    # aggregation to only one cluster.
-    match_query = pipeline[0]['$match']
-    (collection, _, _), = _create_collection_iterator(
-        collection_name, match_query, with_options)
 
-    return collection.aggregate(pipeline, *args, **kwargs)
+def multishard_aggregate(
+        collection_name, pipeline, with_options={}, *args, **kwargs):
+    """Runs an aggregation. If the leading $match targets a single shard key
+    the pipeline is run as is in that shard's location. Otherwise, the
+    pipeline is split (see shardmonster.aggregation) and run in every location
+    concurrently with the results merged here.
+    """
+    realm = _get_realm_for_collection(collection_name)
+    shard_field = realm['shard_field']
 
+    if '$match' in pipeline[0] and _get_targeted_shard_key_value(
+            shard_field, pipeline[0]['$match']) is not None:
+        match_query = pipeline[0]['$match']
+        (collection, _, _), = _create_collection_iterator(
+            collection_name, match_query, with_options)
+        return collection.aggregate(pipeline, *args, **kwargs)
 
-def _ensure_aggregate_hits_shard_key(pipeline, shard_field):
-    first_node = pipeline[0]
+    if '$match' in pipeline[0]:
+        match_query, pipeline = pipeline[0]['$match'], pipeline[1:]
+    else:
+        match_query = {}
+    split = split_pipeline(pipeline)
 
-    if '$match' not in first_node:
-        raise Exception(
-            'Sharded aggregation needs match in the first part of the pipeline'
-        )
+    def _aggregate(target):
+        collection, query, _ = target
+        # The leading $match carries the exclusions for shards that are
+        # moving
+        location_pipeline = [{'$match': query}] + split.shard_pipeline
+        return list(
+            collection.aggregate(location_pipeline, *args, **kwargs))
 
-    target_value = _get_targeted_shard_key_value(
-        shard_field, first_node['$match']
-    )
-    if target_value is None:
-        raise Exception(
-            'Cannot perform aggregation if leading $match query does not '
-            'guarantee to filter by exactly one shard key value.'
-            'the shard field (%s) present' % shard_field
-        )
+    outcomes = run_in_parallel(
+        _aggregate,
+        list(_create_collection_iterator(
+            collection_name, match_query, with_options)))
+    raise_first_failure(outcomes)
+    return iter(split.merge(outcome.result for outcome in outcomes))
 
 
 def multishard_save(collection_name, doc, with_options={}, *args, **kwargs):
@@ -529,21 +1534,78 @@ def multishard_save(collection_name, doc, with_options={}, *args, **kwargs):
     return collection.save(doc, *args, **kwargs)
 
 
-def multishard_ensure_index(collection_name, *args, **kwargs):
-    # !!!! ensure_index deprecated
+def _build_index_everywhere(collection_name, build, max_per_cluster):
+    """Calls build(collection) for the collection in every location at once,
+    running at most max_per_cluster builds against any one cluster. Returns
+    the result from the locations, which is the name of the index.
+    """
     collection_iterator = _create_collection_iterator(
         collection_name, {}, log_untargetted_queries=False)
+    by_cluster = OrderedDict()
+    for collection, _, location in collection_iterator:
+        cluster_name, _ = parse_location(location)
+        by_cluster.setdefault(cluster_name, []).append((collection, location))
+    # The builds run on their own threads rather than the shared pool as they
+    # can take hours
+    outcomes = run_in_dedicated_threads(
+        lambda target: build(target[0]), list(by_cluster.values()),
+        max_per_cluster)
+    failed = {
+        outcome.item[1]: outcome.error for outcome in outcomes
+        if outcome.failed}
+    if failed:
+        raise MultishardIndexError(
+            [outcome.item[1] for outcome in outcomes if not outcome.failed],
+            failed)
+    return outcomes[0].result if outcomes else None
+
 
-    for collection, _, _ in collection_iterator:
-        collection.ensure_index(*args, **kwargs)
+def multishard_ensure_index(collection_name, *args, **kwargs):
+    # !!!! ensure_index deprecated
+    max_per_cluster = kwargs.pop('max_concurrency_per_cluster', None)
+    return _build_index_everywhere(
+        collection_name,
+        lambda collection: collection.ensure_index(*args, **kwargs),
+        max_per_cluster)
 
 
 def multishard_create_index(collection_name, *args, **kwargs):
-    collection_iterator = _create_collection_iterator(
-        collection_name, {}, log_untargetted_queries=False)
+    """Builds the index in every location at once. Pass
+    max_concurrency_per_cluster to limit the number of builds run against
+    each cluster at a time. Raises a MultishardIndexError if the build fails
+    anywhere.
+    """
+    max_per_cluster = kwargs.pop('max_concurrency_per_cluster', None)
+    return _build_index_everywhere(
+        collection_name,
+        lambda collection: collection.create_index(*args, **kwargs),
+        max_per_cluster)
+
 
-    for collection, _, _ in collection_iterator:
-        collection.create_index(*args, **kwargs)
+def multishard_index_build_progress(collection_name):
+    """Returns the index builds in progress for the collection in each
+    location, as reported by currentOp:
+
+        {location: [{'msg': ..., 'progress': {'done': ..., 'total': ...},
+                     'secs_running': ..., 'command': ...}, ...]}
+    """
+    realm = _get_realm_for_collection(collection_name)
+    locations = list(_get_all_locations_for_realm(realm))
+
+    def _progress(location):
+        cluster_name, database_name = parse_location(location)
+        in_progress = get_connection(cluster_name).admin.command(
+            'currentOp', 1, **{'command.createIndexes': collection_name})
+        return [
+            {key: op.get(key) for key in (
+                'msg', 'progress', 'secs_running', 'command')}
+            for op in in_progress.get('inprog', [])
+            if op.get('command', {}).get('$db', database_name) ==
+            database_name]
+
+    outcomes = run_in_parallel(_progress, locations)
+    raise_first_failure(outcomes)
+    return {outcome.item: outcome.result for outcome in outcomes}
 
 
 def multishard_find_and_modify(collection_name, query, update, **kwargs):
@@ -0,0 +1,145 @@
+"""Runs work against several locations at the same time.
+
+A single pool of worker threads is shared by everything in shardmonster. As
+connections are cached per thread (see connection.get_connection) this keeps
+the number of connections to each cluster bounded by the size of the pool.
+"""
+from __future__ import absolute_import
+
+import sys
+import threading
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+import six
+
+# The number of threads in the shared pool
+MAX_WORKERS = 16
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(MAX_WORKERS, initializer=_mark_as_worker)
+    return _pool
+
+
+def _mark_as_worker():
+    _local.is_worker = True
+
+
+def _in_worker():
+    return getattr(_local, 'is_worker', False)
+
+
+class Outcome(object):
+    """The outcome of running a function against a single item. Exactly one of
+    result and exc_info is meaningful.
+    """
+    def __init__(self, item, result=None, exc_info=None):
+        self.item = item
+        self.result = result
+        self.exc_info = exc_info
+
+    @property
+    def failed(self):
+        return self.exc_info is not None
+
+    @property
+    def error(self):
+        return self.exc_info[1] if self.exc_info else None
+
+    def get(self):
+        """Returns the result or re-raises the exception from the item."""
+        if self.exc_info:
+            six.reraise(*self.exc_info)
+        return self.result
+
+    def __repr__(self):
+        if self.failed:
+            return "Outcome(%r, error=%r)" % (self.item, self.error)
+        return "Outcome(%r, result=%r)" % (self.item, self.result)
+
+
+def _run_one(fn, item):
+    try:
+        return Outcome(item, result=fn(item))
+    except Exception:
+        return Outcome(item, exc_info=sys.exc_info())
+
+
+def run_in_parallel(fn, items, max_concurrency=None):
+    """Calls fn(item) for each item concurrently and returns a list of Outcome
+    objects in the same order as items. Exceptions are captured rather than
+    raised so that callers can report partial failures.
+
+    At most max_concurrency items are run at once (and never more than the
+    size of the pool). A single item, or a call made from inside the pool, is
+    run in the calling thread. The latter avoids the pool deadlocking on
+    itself.
+    """
+    items = list(items)
+    if len(items) <= 1 or max_concurrency == 1 or _in_worker():
+        return [_run_one(fn, item) for item in items]
+
+    pool = _get_pool()
+    slots = threading.BoundedSemaphore(max_concurrency or MAX_WORKERS)
+
+    def _run_in_slot(item):
+        try:
+            return _run_one(fn, item)
+        finally:
+            slots.release()
+
+    pending = []
+    for item in items:
+        slots.acquire()
+        pending.append(pool.apply_async(_run_in_slot, (item,)))
+    return [result.get() for result in pending]
+
+
+def run_in_dedicated_threads(fn, groups, max_concurrency_per_group=None):
+    """Like run_in_parallel but for long running work, such as index builds,
+    that mustn't hold up the shared pool. groups is a list of lists of items.
+    Threads are started for this call, at most max_concurrency_per_group for
+    each group, and each one works through its group's items in turn.
+    Returns the outcomes in the same order as the items across the groups.
+    """
+    outcomes = {}
+
+    def _work(queue):
+        while True:
+            try:
+                index, item = queue.popleft()
+            except IndexError:
+                return
+            outcomes[index] = _run_one(fn, item)
+
+    threads = []
+    index = 0
+    for items in groups:
+        queue = deque()
+        for item in items:
+            queue.append((index, item))
+            index += 1
+        for _ in range(min(max_concurrency_per_group or len(queue),
+                           len(queue))):
+            thread = threading.Thread(target=_work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return [outcomes[i] for i in range(index)]
+
+
+def raise_first_failure(outcomes):
+    """Re-raises the first exception found in the given outcomes, if any."""
+    for outcome in outcomes:
+        if outcome.failed:
+            outcome.get()
@@ -0,0 +1,126 @@
+"""Helpers for reading RawBSONDocuments without decoding them.
+
+When a collection is read with a codec_options whose document_class is
+RawBSONDocument (passed through with_options), documents are handed back as
+the BSON that the server sent. The few fields that a MultishardCursor has to
+look at itself (to sort on or to drop excluded shards) are found by walking
+the element headers and only that element is decoded.
+"""
+from __future__ import absolute_import
+
+import struct
+
+import bson
+from bson.raw_bson import RawBSONDocument
+
+_INT32 = struct.Struct('<i')
+
+# The size of the value of each fixed size BSON type
+_FIXED_SIZES = {
+    b'\x01': 8,   # double
+    b'\x06': 0,   # undefined
+    b'\x07': 12,  # ObjectId
+    b'\x08': 1,   # boolean
+    b'\x09': 8,   # UTC datetime
+    b'\x0a': 0,   # null
+    b'\x10': 4,   # int32
+    b'\x11': 8,   # timestamp
+    b'\x12': 8,   # int64
+    b'\x13': 16,  # decimal128
+    b'\x7f': 0,   # max key
+    b'\xff': 0,   # min key
+}
+# Types whose value starts with the length of the rest of the value
+_LENGTH_PREFIXED = {
+    b'\x02': 4,   # string
+    b'\x0d': 4,   # code
+    b'\x0e': 4,   # symbol
+    b'\x05': 5,   # binary (the subtype follows the length)
+    b'\x0c': 16,  # DBPointer (the ObjectId follows the string)
+}
+# Types whose value is its own length
+_SELF_SIZED = (b'\x03', b'\x04', b'\x0f')
+_DOCUMENT = b'\x03'
+
+
+def uses_raw_documents(with_options):
+    """Returns True if the options given to with_options read documents as
+    RawBSONDocuments.
+    """
+    codec_options = (with_options or {}).get('codec_options')
+    if codec_options is None:
+        return False
+    return issubclass(codec_options.document_class, RawBSONDocument)
+
+
+def _value_size(data, element_type, position):
+    if element_type in _FIXED_SIZES:
+        return _FIXED_SIZES[element_type]
+    if element_type in _SELF_SIZED:
+        return _INT32.unpack_from(data, position)[0]
+    if element_type in _LENGTH_PREFIXED:
+        return (_LENGTH_PREFIXED[element_type] +
+                _INT32.unpack_from(data, position)[0])
+    if element_type == b'\x0b':
+        # A regular expression is a pattern and options as two cstrings
+        end = data.index(b'\x00', data.index(b'\x00', position) + 1)
+        return end + 1 - position
+    raise bson.errors.InvalidBSON(
+        'Unknown element type %r' % element_type)
+
+
+def _find_element(data, start, name):
+    """Finds the element with the given name in the document that starts at
+    the given offset. Returns (element start, value start, element end) or
+    None if there is no such element.
+    """
+    end = start + _INT32.unpack_from(data, start)[0] - 1
+    position = start + 4
+    while position < end:
+        element_type = data[position:position + 1]
+        name_end = data.index(b'\x00', position + 1)
+        value_start = name_end + 1
+        element_end = value_start + _value_size(
+            data, element_type, value_start)
+        if data[position + 1:name_end] == name:
+            return position, value_start, element_end
+        position = element_end
+    return None
+
+
+def get_raw_value(raw, key):
+    """Decodes just the value at the given (dotted) key of a BSON document.
+    Raises KeyError if it isn't there and TypeError if part of the way along
+    the key isn't a document, as looking it up in a dictionary would.
+    """
+    parts = key.split('.')
+    start = 0
+    for index, part in enumerate(parts):
+        found = _find_element(raw, start, part.encode('utf-8'))
+        if found is None:
+            raise KeyError(key)
+        element_start, value_start, element_end = found
+        if index == len(parts) - 1:
+            element = raw[element_start:element_end]
+            return bson.BSON(
+                _INT32.pack(len(element) + 5) + element + b'\x00').decode()[
+                    part]
+        if raw[element_start:element_start + 1] != _DOCUMENT:
+            raise TypeError('%s is not a document' % '.'.join(
+                parts[:index + 1]))
+        start = value_start
+
+
+def remove_raw_field(doc, field, codec_options):
+    """Returns a copy of the RawBSONDocument without the given top level
+    field.
+    """
+    raw = doc.raw
+    found = _find_element(raw, 0, field.encode('utf-8'))
+    if found is None:
+        return doc
+    element_start, _, element_end = found
+    size = len(raw) - (element_end - element_start)
+    return RawBSONDocument(
+        _INT32.pack(size) + raw[4:element_start] + raw[element_end:],
+        codec_options)
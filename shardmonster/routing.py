@@ -0,0 +1,223 @@
+"""Works out which shard keys a query can possibly match.
+
+A query is analysed into a plan for its shape (the operators used and where
+the shard field appears, ignoring the values) and the plan is cached. The
+plan is then evaluated against the values in each query. For example, the
+queries {'x': 1} and {'x': 2} share a plan, as do {'x': {'$in': [1, 2]}} and
+{'x': {'$in': [3]}}.
+
+Understood are bare equality, $eq and $in on the shard field, and $and and
+$or of queries. Anything else (such as $gt on the shard field, $nor or
+conditions on other fields) is treated as being able to match any shard.
+"""
+from __future__ import absolute_import
+
+import bson
+import numbers
+import threading
+from collections import OrderedDict
+
+import six
+
+from shardmonster import stats
+
+# The number of query shapes to keep plans for
+MAX_CACHED_PLANS = 1000
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def _is_valid_type_for_sharding(value):
+    return isinstance(
+        value, six.string_types + (numbers.Integral, bson.ObjectId))
+
+
+class RoutePlan(object):
+    """The shard keys a query can match. shard_keys is None if the query can
+    match documents in any shard, otherwise it is a list of the shard keys (it
+    is empty if the query can't match anything). reasons describes how that
+    was worked out.
+    """
+    def __init__(self, shard_keys, reasons):
+        self.shard_keys = shard_keys
+        self.reasons = reasons
+
+    @property
+    def targetted(self):
+        return self.shard_keys is not None
+
+    def __repr__(self):
+        return "RoutePlan(%r, reasons=%r)" % (self.shard_keys, self.reasons)
+
+
+def _is_operator_dict(value):
+    return (isinstance(value, dict) and bool(value) and
+            all(key.startswith('$') for key in value))
+
+
+def _shape(shard_field, query):
+    shape = []
+    for key, value in sorted(six.iteritems(query), key=lambda kv: kv[0]):
+        if key in ('$and', '$or') and isinstance(value, list):
+            shape.append((key, tuple(
+                _shape(shard_field, subquery)
+                if isinstance(subquery, dict) else None
+                for subquery in value)))
+        elif key == shard_field:
+            if _is_operator_dict(value):
+                shape.append((key, tuple(sorted(value))))
+            else:
+                shape.append((key, '='))
+    return tuple(shape)
+
+
+# Plans are trees of the following nodes:
+#   (ANY, reason)
+#   (EQUALS, path)           the value at path is the only possible key
+#   (IN, path)               the list at path holds the possible keys
+#   (AND, [nodes])
+#   (OR, [nodes])
+# where a path is the list of keys and indexes that leads to a value.
+ANY = 'any'
+EQUALS = 'equals'
+IN = 'in'
+AND = 'and'
+OR = 'or'
+
+
+def _compile(shard_field, query, path=()):
+    nodes = []
+    for key, value in six.iteritems(query):
+        if key in ('$and', '$or') and isinstance(value, list):
+            children = []
+            for i, subquery in enumerate(value):
+                if isinstance(subquery, dict):
+                    children.append(
+                        _compile(shard_field, subquery, path + (key, i)))
+                else:
+                    children.append((ANY, 'malformed %s' % key))
+            nodes.append((AND if key == '$and' else OR, children))
+        elif key == shard_field:
+            if not _is_operator_dict(value):
+                nodes.append((EQUALS, path + (key,)))
+                continue
+            for operator in value:
+                if operator == '$eq':
+                    nodes.append((EQUALS, path + (key, '$eq')))
+                elif operator == '$in':
+                    nodes.append((IN, path + (key, '$in')))
+    if not nodes:
+        return (ANY, 'no condition on %s' % shard_field)
+    if len(nodes) == 1:
+        return nodes[0]
+    return (AND, nodes)
+
+
+def _get_by_path(query, path):
+    for part in path:
+        query = query[part]
+    return query
+
+
+def _describe_path(path):
+    return '.'.join(str(part) for part in path)
+
+
+def _evaluate(node, query, reasons):
+    """Returns the set of possible shard keys or None for any shard."""
+    kind = node[0]
+    if kind == ANY:
+        reasons.append(node[1])
+        return None
+
+    if kind == EQUALS:
+        value = _get_by_path(query, node[1])
+        if not _is_valid_type_for_sharding(value):
+            reasons.append(
+                '%s is %r which cannot be a shard key' % (
+                    _describe_path(node[1]), value))
+            return None
+        reasons.append('%s = %r' % (_describe_path(node[1]), value))
+        return {value}
+
+    if kind == IN:
+        values = _get_by_path(query, node[1])
+        if not isinstance(values, (list, tuple)) or not all(
+                _is_valid_type_for_sharding(value) for value in values):
+            reasons.append(
+                '%s includes values that cannot be shard keys'
+                % _describe_path(node[1]))
+            return None
+        reasons.append(
+            '%s lists %d shard keys' % (_describe_path(node[1]), len(values)))
+        return set(values)
+
+    results = [_evaluate(child, query, reasons) for child in node[1]]
+    if kind == AND:
+        keys = None
+        for result in results:
+            if result is not None:
+                keys = result if keys is None else keys & result
+        return keys
+
+    # OR: every branch must be targetted for the whole to be targetted
+    if any(result is None for result in results):
+        reasons.append('a branch of $or can match any shard')
+        return None
+    keys = set()
+    for result in results:
+        keys |= result
+    return keys
+
+
+def _get_plan(shard_field, query):
+    key = (shard_field, _shape(shard_field, query))
+    with _plans_lock:
+        plan = _plans.get(key)
+        if plan is not None:
+            _plans[key] = _plans.pop(key)
+    if plan is not None:
+        stats.record_cache_hit(stats.ROUTE_PLAN_CACHE, shard_field)
+        return plan
+
+    stats.record_cache_miss(stats.ROUTE_PLAN_CACHE, shard_field)
+    plan = _compile(shard_field, query)
+    with _plans_lock:
+        _plans[key] = plan
+        while len(_plans) > MAX_CACHED_PLANS:
+            _plans.popitem(last=False)
+    return plan
+
+
+def analyse_query(shard_field, query):
+    """Works out which shard keys the given query can match. Returns a
+    RoutePlan.
+    """
+    reasons = []
+    keys = _evaluate(_get_plan(shard_field, query or {}), query or {}, reasons)
+    if keys is None:
+        return RoutePlan(None, reasons)
+    if not keys:
+        reasons.append('the conditions on %s contradict' % shard_field)
+    return RoutePlan(_sorted_keys(keys), reasons)
+
+
+def _sorted_keys(keys):
+    # Shard keys can be of mixed types which can't be compared in Python 3
+    return sorted(keys, key=lambda key: (type(key).__name__, key))
+
+
+def get_single_target(shard_field, query):
+    """Returns the shard key if the query can only match a single shard.
+    Otherwise, returns None.
+    """
+    plan = analyse_query(shard_field, query)
+    if plan.shard_keys and len(plan.shard_keys) == 1:
+        return plan.shard_keys[0]
+    return None
+
+
+def clear_plan_cache():
+    with _plans_lock:
+        _plans.clear()
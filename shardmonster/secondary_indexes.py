@@ -0,0 +1,547 @@
+"""Global secondary indexes map the values of a field other than the shard
+field to the shard keys of the documents that have them. Queries that would
+otherwise go to every location, such as a lookup by email address, can then
+be routed to the locations of just those shards.
+
+An index is described in its realm's document:
+
+    secondary_indexes: [
+        {field: 'email', status: 'building' | 'ready', location: ...},
+    ]
+
+Its entries are documents of the form:
+
+    {realm: ..., field: ..., value: ..., shard_key: ..., updated: ...}
+
+kept in the controller or, if a location is given, in that cluster/database.
+
+Entries are added before documents are written through shard aware
+collections so an index never misses a document, although it can hold entries
+for values that are no longer used. Those only cost a visit to a location
+that has nothing to return. Queries are only routed using an index once it is
+ready, which is when the backfill of existing documents has finished.
+check_secondary_index finds (and can repair) entries that are missing or
+stale.
+"""
+from __future__ import absolute_import
+
+import logging
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import bson
+import six
+from bson.decimal128 import Decimal128
+from pymongo.errors import BulkWriteError
+from pymongo.operations import DeleteOne, UpdateOne
+
+from shardmonster import stats
+from shardmonster.connection import (
+    close_thread_connections, get_connection, get_controlling_db,
+    parse_location)
+from shardmonster.metadata import (
+    _get_all_locations_for_realm, _get_location_for_shard, _get_realm_by_name,
+    _get_realm_coll, _get_realm_for_collection, get_in_flux_caching_duration,
+    get_longest_caching_duration, realm_policy_changed)
+from shardmonster.routing import _is_valid_type_for_sharding, analyse_query
+
+INDEX_BUILDING = 'building'
+INDEX_READY = 'ready'
+
+# The collection that entries are kept in on a dedicated location
+ENTRIES_COLLECTION = 'shardmonster_secondary_index_entries'
+
+DEFAULT_BATCH_SIZE = 1000
+
+_DUPLICATE_KEY_ERROR_CODES = {11000, 11001, 12582}
+
+logger = logging.getLogger("shardmonster")
+
+_MIN_INT64 = -2 ** 63
+_MAX_INT64 = 2 ** 63 - 1
+
+
+def _get_entries_coll(index):
+    location = index.get('location')
+    if not location:
+        return get_controlling_db().secondary_index_entries
+    cluster_name, database_name = parse_location(location)
+    return get_connection(cluster_name)[database_name][ENTRIES_COLLECTION]
+
+
+def get_secondary_indexes(realm, ready_only=False):
+    return [
+        index for index in realm.get('secondary_indexes') or []
+        if not ready_only or index['status'] == INDEX_READY]
+
+
+def _get_index(realm, field):
+    for index in get_secondary_indexes(realm):
+        if index['field'] == field:
+            return index
+    raise Exception(
+        'Realm %s has no secondary index on %s' % (realm['name'], field))
+
+
+def _set_secondary_indexes(realm, indexes):
+    _get_realm_coll().update(
+        {'name': realm['name']}, {'$set': {'secondary_indexes': indexes}})
+    realm_policy_changed(_get_realm_by_name(realm['name']))
+
+
+def _values(value):
+    # Documents with an array match a query for any of its elements
+    values = value if isinstance(value, list) else [value]
+    indexed = [_index_value(value) for value in values]
+    return [value for value in indexed if value is not None]
+
+
+def _index_value(value):
+    """Returns the value to add an entry for or None if no query that is
+    routed by an index can match it. Those only have integers, strings and
+    ObjectIds in them, but Mongo matches an integer against other numbers of
+    the same value so those are indexed as integers.
+    """
+    if isinstance(value, Decimal128):
+        value = value.to_decimal()
+        if not value.is_finite() or value != value.to_integral_value():
+            return None
+    elif isinstance(value, float):
+        if not value.is_integer():
+            return None
+    elif _is_valid_type_for_sharding(value):
+        return value
+    else:
+        return None
+    value = int(value)
+    return value if _MIN_INT64 <= value <= _MAX_INT64 else None
+
+
+def _get_values(doc, field):
+    """Returns the values in the document that a query on the (possibly
+    dotted) field can match. As in Mongo, arrays along the way are looked
+    into.
+    """
+    found = [doc]
+    for part in field.split('.'):
+        next_found = []
+        for value in found:
+            if isinstance(value, dict):
+                if part in value:
+                    next_found.append(value[part])
+            elif isinstance(value, list):
+                if part.isdigit() and int(part) < len(value):
+                    next_found.append(value[int(part)])
+                next_found.extend(
+                    item[part] for item in value
+                    if isinstance(item, dict) and part in item)
+        found = next_found
+    return [value for item in found for value in _values(item)]
+
+
+def add_entries(realm, field, pairs):
+    """Adds (value, shard_key) entries to the index on field."""
+    pairs = set(pairs)
+    if not pairs:
+        return
+    now = time.time()
+    requests = [
+        UpdateOne(
+            {'realm': realm['name'], 'field': field, 'value': value,
+             'shard_key': shard_key},
+            {'$set': {'updated': now}}, upsert=True)
+        for value, shard_key in pairs]
+    try:
+        _get_entries_coll(_get_index(realm, field)).bulk_write(
+            requests, ordered=False)
+    except BulkWriteError as e:
+        # Concurrent upserts of the same entry can collide
+        if any(error.get('code') not in _DUPLICATE_KEY_ERROR_CODES
+               for error in e.details.get('writeErrors', [])):
+            raise
+
+
+def lookup_shard_keys(realm, field, values):
+    """Returns the shard keys of documents that can have any of the values in
+    field.
+    """
+    coll = _get_entries_coll(_get_index(realm, field))
+    with stats.timed_round_trip(stats.SECONDARY_INDEX_LOOKUP):
+        entries = list(coll.find(
+            {'realm': realm['name'], 'field': field,
+             'value': {'$in': list(values)}},
+            {'shard_key': 1}))
+    return set(entry['shard_key'] for entry in entries)
+
+
+def find_index_target(realm, query):
+    """Uses the realm's ready secondary indexes to work out the shard keys
+    that the query can match. Returns None if no index can be used.
+    """
+    return find_index_route(realm, query)[1]
+
+
+def find_index_route(realm, query):
+    """As find_index_target but returns (field, shard keys) where field is
+    the field of the secondary index that was used. Returns (None, None) if
+    no index can be used.
+    """
+    for index in get_secondary_indexes(realm, ready_only=True):
+        values = analyse_query(index['field'], query).shard_keys
+        if values is not None:
+            return index['field'], sorted(
+                lookup_shard_keys(realm, index['field'], values),
+                key=lambda key: (type(key).__name__, key))
+    return None, None
+
+
+def index_documents(collection_name, docs):
+    """Adds entries for documents that are about to be written."""
+    realm = _get_realm_for_collection(collection_name)
+    indexes = get_secondary_indexes(realm)
+    if not indexes:
+        return
+    if isinstance(docs, dict):
+        docs = [docs]
+    shard_field = realm['shard_field']
+    for index in indexes:
+        if index['field'] == '_id':
+            # Give the documents the _id that pymongo would have so that it
+            # can be indexed before the insert
+            for doc in docs:
+                if '_id' not in doc:
+                    doc['_id'] = bson.ObjectId()
+        field = index['field']
+        add_entries(realm, field, [
+            (value, doc[shard_field])
+            for doc in docs if shard_field in doc
+            for value in _get_values(doc, field)])
+
+
+def _is_operator_update(update):
+    return any(key.startswith('$') for key in update)
+
+
+def _touches(update, field):
+    if not _is_operator_update(update):
+        return field in update
+    for fields in six.itervalues(update):
+        if isinstance(fields, dict) and any(
+                key == field or key.startswith(field + '.') or
+                field.startswith(key + '.') for key in fields):
+            return True
+    return False
+
+
+class _PendingReindex(object):
+    """Fields of documents that can only be indexed once an update has been
+    made. The documents are found before the update as it can stop them
+    matching its query. Their _ids are kept in a temporary file and the
+    documents are reindexed batch_size at a time.
+    """
+    def __init__(self, collection_name, query, fields, upsert,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        self.collection_name = collection_name
+        self.query = query
+        self.fields = fields
+        self.upsert = upsert
+        self.batch_size = batch_size
+        realm = _get_realm_for_collection(collection_name)
+        locations = _get_locations_for_query(realm, query)
+        self._ids = tempfile.TemporaryFile()
+        try:
+            for location in locations:
+                cluster_name, database_name = parse_location(location)
+                collection = get_connection(cluster_name)[database_name][
+                    collection_name]
+                for doc in collection.find(query, {'_id': 1}):
+                    self._ids.write(bson.BSON.encode(doc))
+        except Exception:
+            self._ids.close()
+            raise
+
+    def finish(self):
+        try:
+            self._ids.seek(0)
+            ids = []
+            for doc in bson.decode_file_iter(self._ids):
+                ids.append(doc['_id'])
+                if len(ids) >= self.batch_size:
+                    self._reindex({'_id': {'$in': ids}})
+                    ids = []
+            if ids:
+                self._reindex({'_id': {'$in': ids}})
+            if self.upsert:
+                self._reindex(self.query)
+        finally:
+            self._ids.close()
+
+    def _reindex(self, query):
+        reindex_matching(self.collection_name, query, self.fields)
+
+
+def prepare_index_update(collection_name, query, update, upsert=False):
+    """Adds entries for an update that is about to be made. If some values
+    can't be worked out from the update, returns a pending reindex that must
+    be passed to finish_index_update once the update has been made.
+    """
+    fields = _index_update(collection_name, query, update, upsert)
+    if fields:
+        return _PendingReindex(collection_name, query, fields, upsert)
+    return None
+
+
+def finish_index_update(pending):
+    if pending is not None:
+        pending.finish()
+
+
+@contextmanager
+def finishing_index_updates(pending):
+    """Finishes the pending reindexes (as returned by prepare_index_update)
+    once the body of the with statement has run, even if it fails. An error
+    while reindexing after the body failed is logged rather than raised so
+    that it doesn't hide the body's error.
+    """
+    try:
+        yield
+    except Exception:
+        exc_info = sys.exc_info()
+        for reindex in pending:
+            try:
+                finish_index_update(reindex)
+            except Exception:
+                logger.exception('Failed to reindex after a failed write')
+        six.reraise(*exc_info)
+    for reindex in pending:
+        finish_index_update(reindex)
+
+
+def _index_update(collection_name, query, update, upsert):
+    realm = _get_realm_for_collection(collection_name)
+    indexes = get_secondary_indexes(realm)
+    touched = [
+        index['field'] for index in indexes
+        if _touches(update, index['field'])]
+    if not touched:
+        return []
+
+    shard_field = realm['shard_field']
+    shard_keys = analyse_query(shard_field, query).shard_keys
+    if upsert:
+        new_doc = update
+        if _is_operator_update(update):
+            new_doc = update.get('$set', {})
+        upsert_keys = analyse_query(shard_field, new_doc).shard_keys
+        if shard_keys is not None and upsert_keys is not None:
+            shard_keys = shard_keys + upsert_keys
+        else:
+            shard_keys = None
+
+    unknown = []
+    for field in touched:
+        if not _is_operator_update(update):
+            values = _get_values(update, field)
+        elif set(update) <= {'$set', '$setOnInsert'} and all(
+                field in update.get(operator, {}) or
+                not _touches({operator: update.get(operator, {})}, field)
+                for operator in ('$set', '$setOnInsert')):
+            values = []
+            for operator in ('$set', '$setOnInsert'):
+                if field in update.get(operator, {}):
+                    values.extend(_values(update[operator][field]))
+        else:
+            values = None
+
+        if values is None or shard_keys is None:
+            unknown.append(field)
+        else:
+            add_entries(realm, field, [
+                (value, shard_key)
+                for value in values for shard_key in shard_keys])
+    return unknown
+
+
+def _get_locations_for_query(realm, query):
+    shard_keys = analyse_query(realm['shard_field'], query).shard_keys
+    if shard_keys is None:
+        return list(_get_all_locations_for_realm(realm))
+    return list(set(
+        _get_location_for_shard(realm, shard_key).location
+        for shard_key in shard_keys))
+
+
+def _scan(realm, fields, query=None, locations=None):
+    """Yields (field, value, shard_key) for the documents in each location
+    that match the query.
+    """
+    shard_field = realm['shard_field']
+    projection = {field: 1 for field in fields}
+    projection[shard_field] = 1
+    if locations is None:
+        locations = _get_all_locations_for_realm(realm)
+    for location in locations:
+        cluster_name, database_name = parse_location(location)
+        collection = get_connection(cluster_name)[database_name][
+            realm['collection']]
+        # Stale copies of shards mid-migration are scanned too. They have
+        # the same shard keys so at worst they add entries for old values.
+        for doc in collection.find(query or {}, projection):
+            if shard_field not in doc:
+                continue
+            for field in fields:
+                for value in _get_values(doc, field):
+                    yield field, value, doc[shard_field]
+
+
+def reindex_matching(collection_name, query, fields):
+    """Adds entries for the documents matching the query, such as those
+    changed by an update whose new values couldn't be worked out beforehand.
+    """
+    if not fields:
+        return
+    realm = _get_realm_for_collection(collection_name)
+    pairs = {field: set() for field in fields}
+    locations = _get_locations_for_query(realm, query)
+    for field, value, shard_key in _scan(realm, fields, query, locations):
+        pairs[field].add((value, shard_key))
+    for field, field_pairs in six.iteritems(pairs):
+        add_entries(realm, field, field_pairs)
+
+
+def create_secondary_index(collection_name, field, location=None,
+                           backfill=True):
+    """Creates a global secondary index on the given field. Writes made
+    through shard aware collections start adding entries to it straight
+    away. Queries are only routed using it once it is ready.
+
+    :param str collection_name: The collection to index.
+    :param str field: The field to index.
+    :param str location: A cluster/database to keep the entries in. They are
+        kept in the controller by default.
+    :param bool backfill: Start backfilling the existing documents in the
+        background. The backfill marks the index as ready once done.
+    :return: The SecondaryIndexBackfill thread if backfilling, or None.
+    """
+    realm = _get_realm_for_collection(collection_name)
+    if field == realm['shard_field']:
+        raise Exception('Cannot index the shard field')
+    indexes = get_secondary_indexes(realm)
+    if any(index['field'] == field for index in indexes):
+        raise Exception('Secondary index on %s already exists' % field)
+
+    index = {'field': field, 'status': INDEX_BUILDING}
+    if location:
+        index['location'] = location
+    _get_entries_coll(index).create_index(
+        [('realm', 1), ('field', 1), ('value', 1), ('shard_key', 1)],
+        unique=True)
+    _set_secondary_indexes(realm, indexes + [index])
+
+    if backfill:
+        thread = SecondaryIndexBackfill(collection_name, field)
+        thread.start()
+        return thread
+    return None
+
+
+def drop_secondary_index(collection_name, field):
+    realm = _get_realm_for_collection(collection_name)
+    index = _get_index(realm, field)
+    _set_secondary_indexes(realm, [
+        other for other in get_secondary_indexes(realm)
+        if other['field'] != field])
+    _get_entries_coll(index).remove({'realm': realm['name'], 'field': field})
+
+
+def backfill_secondary_index(collection_name, field,
+                             batch_size=DEFAULT_BATCH_SIZE, wait=True):
+    """Adds entries for every existing document and marks the index as
+    ready.
+
+    Processes that haven't noticed the index yet don't add entries for their
+    writes, so unless wait is False the backfill first waits for every cached
+    copy of the realm to expire and then, as a migration does, for writes
+    that were already under way to finish.
+    """
+    realm = _get_realm_for_collection(collection_name)
+    _get_index(realm, field)
+    if wait:
+        time.sleep(
+            get_longest_caching_duration(realm) + 0.1 +
+            get_in_flux_caching_duration(realm))
+
+    batch = set()
+    for _, value, shard_key in _scan(realm, [field]):
+        batch.add((value, shard_key))
+        if len(batch) >= batch_size:
+            add_entries(realm, field, batch)
+            batch = set()
+    add_entries(realm, field, batch)
+
+    realm = _get_realm_for_collection(collection_name)
+    indexes = get_secondary_indexes(realm)
+    for index in indexes:
+        if index['field'] == field:
+            index['status'] = INDEX_READY
+    _set_secondary_indexes(realm, indexes)
+
+
+class SecondaryIndexBackfill(threading.Thread):
+    def __init__(self, collection_name, field, batch_size=DEFAULT_BATCH_SIZE):
+        self.collection_name = collection_name
+        self.field = field
+        self.batch_size = batch_size
+        self.exception = None
+        super(SecondaryIndexBackfill, self).__init__()
+
+    def run(self):
+        try:
+            backfill_secondary_index(
+                self.collection_name, self.field, self.batch_size)
+        except Exception:
+            self.exception = sys.exc_info()
+            raise
+        finally:
+            close_thread_connections(threading.current_thread())
+
+
+def check_secondary_index(collection_name, field, repair=False):
+    """Compares the index on field with the documents in every location.
+    Returns the entries that are missing and stale:
+
+        {'missing': [(value, shard_key), ...],
+         'stale': [(value, shard_key), ...]}
+
+    If repair is set, missing entries are added and stale entries removed.
+    Only entries last written before the check started are treated as stale
+    so that entries for documents being written meanwhile are left alone.
+    """
+    realm = _get_realm_for_collection(collection_name)
+    coll = _get_entries_coll(_get_index(realm, field))
+    started = time.time()
+
+    actual = set(
+        (value, shard_key)
+        for _, value, shard_key in _scan(realm, [field]))
+    stored = {}
+    for entry in coll.find({'realm': realm['name'], 'field': field}):
+        stored[(entry['value'], entry['shard_key'])] = entry
+
+    missing = [pair for pair in actual if pair not in stored]
+    stale = [
+        pair for pair, entry in six.iteritems(stored)
+        if pair not in actual and entry.get('updated', 0) < started]
+
+    if repair:
+        add_entries(realm, field, missing)
+        if stale:
+            coll.bulk_write([
+                DeleteOne({
+                    '_id': stored[pair]['_id'],
+                    'updated': {'$lt': started}})
+                for pair in stale], ordered=False)
+    return {'missing': missing, 'stale': stale}
@@ -349,6 +349,7 @@ class ShardMovementThread(threading.Thread):
 
             # Sync phase
             self.manager.set_phase('sync')
+            realm = metadata._get_realm_for_collection(self.collection_name)
             start_sync_time = time.time()
             api.set_shard_to_migration_status(
                 self.collection_name,
@@ -356,23 +357,25 @@ class ShardMovementThread(threading.Thread):
             oplog_pos = _sync_from_oplog(
                 self.collection_name, self.shard_key, oplog_pos)
 
-            # Ensure that the sync has taken at least as long as our caching
-            # time to ensure that all writes will get paused at approximately
-            # the same time.
-            while time.time() < start_sync_time + api.get_caching_duration():
+            # Ensure that the sync has taken at least as long as the realm's
+            # caching time to ensure that all writes will get paused at
+            # approximately the same time. If the caching time was just
+            # lowered other processes may still be on the old one.
+            caching_duration = api.get_longest_caching_duration(realm)
+            while time.time() < start_sync_time + caching_duration:
                 time.sleep(0.05)
                 oplog_pos = _sync_from_oplog(
                     self.collection_name, self.shard_key, oplog_pos)
 
-            # Now all the caching of metadata should be stopped for this shard.
-            # We can flip to being paused at destination and wait ~100ms for any
-            # pending updates/inserts to be performed. If these are taking
-            # longer than 100ms then you are in a bad place and should rethink
-            # sharding.
+            # Now the metadata for this shard is only cached for a few
+            # milliseconds. We can flip to being paused at destination and wait
+            # ~100ms (plus that staleness bound) for any pending updates/inserts
+            # to be performed. If these are taking longer than 100ms then you
+            # are in a bad place and should rethink sharding.
             api.set_shard_to_migration_status(
                 self.collection_name, self.shard_key,
                 metadata.ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION)
-            time.sleep(0.1)
+            time.sleep(0.1 + api.get_in_flux_caching_duration(realm))
 
             # Sync the oplog one final time to catch any writes that were
             # performed during the pause
@@ -486,9 +489,10 @@ def _begin_migration(
         collection_name, shard_key, new_location,
         delete_throttle=None, insert_throttle=None,
         delete_batch_size=1000, insert_batch_size=1000):
-    if metadata.are_migrations_happening():
+    realm = metadata._get_realm_for_collection(collection_name)
+    if metadata.are_migrations_happening(realm['name'], shard_key):
         raise Exception(
-            'Cannot start migration when another migration is in progress')
+            'Cannot start migration when the shard is already being migrated')
     manager = ShardMovementManager(
         collection_name, shard_key, new_location,
         delete_throttle=delete_throttle, insert_throttle=insert_throttle,
@@ -0,0 +1,136 @@
+"""Counters and latency histograms for the metadata caches and for every round
+trip made to the controller.
+
+Everything in here is process wide and thread safe. Use
+:func:`shardmonster.api.get_metadata_stats` to read the numbers out.
+"""
+from __future__ import absolute_import
+
+import threading
+import time
+from contextlib import contextmanager
+
+import six
+
+# Call sites that result in a round trip to the controller
+SINGLE_SHARD_REFRESH = 'single-shard-refresh'
+MULTI_SHARD_REFRESH = 'multi-shard-refresh'
+FULL_REFRESH = 'full-refresh'
+REALM_LOOKUP = 'realm-lookup'
+PAUSE_CHECK = 'pause-check'
+CLUSTER_URI = 'cluster-uri'
+SECONDARY_INDEX_LOOKUP = 'secondary-index-lookup'
+
+# Caches that hits and misses are recorded against
+SHARD_METADATA_CACHE = 'shard_metadata'
+REALM_CACHE = 'realm'
+CLUSTER_URI_CACHE = 'cluster_uri'
+ROUTE_PLAN_CACHE = 'route_plan'
+
+# Upper bounds (in seconds) of the latency histogram buckets. Anything slower
+# than the last bound lands in the overflow bucket.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+_lock = threading.Lock()
+_round_trips = {}
+_cache_lookups = {}
+
+
+class RoundTripStats(object):
+    """Count, total time and latency histogram for a single call site."""
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, duration):
+        self.count += 1
+        self.total_time += duration
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def as_dict(self):
+        # Buckets are cumulative, in the same way as Prometheus histograms
+        cumulative = []
+        running = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), self.buckets):
+            running += count
+            cumulative.append((bound, running))
+        return {
+            'count': self.count,
+            'total_time': self.total_time,
+            'buckets': cumulative,
+        }
+
+
+def record_round_trip(call_site, duration):
+    with _lock:
+        if call_site not in _round_trips:
+            _round_trips[call_site] = RoundTripStats()
+        _round_trips[call_site].record(duration)
+
+
+@contextmanager
+def timed_round_trip(call_site):
+    """Times the body of the with statement as a controller round trip for
+    the given call site.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        record_round_trip(call_site, time.time() - start)
+
+
+def record_cache_hit(cache_name, key):
+    _record_cache_lookup(cache_name, key, 0)
+
+
+def record_cache_miss(cache_name, key):
+    _record_cache_lookup(cache_name, key, 1)
+
+
+def _record_cache_lookup(cache_name, key, index):
+    with _lock:
+        per_cache = _cache_lookups.setdefault(cache_name, {})
+        counts = per_cache.setdefault(key, [0, 0])
+        counts[index] += 1
+
+
+def get_round_trip_stats():
+    with _lock:
+        return {
+            call_site: round_trip.as_dict()
+            for call_site, round_trip in six.iteritems(_round_trips)
+        }
+
+
+def get_cache_stats():
+    """Returns hits, misses and hit ratio for each key of each cache of the
+    form:
+
+        {cache_name: {key: {'hits': ..., 'misses': ..., 'hit_ratio': ...}}}
+    """
+    with _lock:
+        result = {}
+        for cache_name, per_cache in six.iteritems(_cache_lookups):
+            result[cache_name] = {}
+            for key, (hits, misses) in six.iteritems(per_cache):
+                total = hits + misses
+                result[cache_name][key] = {
+                    'hits': hits,
+                    'misses': misses,
+                    'hit_ratio': float(hits) / total if total else 0.0,
+                }
+        return result
+
+
+def reset_stats():
+    with _lock:
+        _round_trips.clear()
+        _cache_lookups.clear()
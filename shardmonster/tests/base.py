@@ -5,7 +5,8 @@ import time
 import pymongo
 import unittest
 
-from shardmonster import api, connection as connection_module, metadata
+from shardmonster import (
+    api, connection as connection_module, metadata, operations)
 from shardmonster.hidden_secondaries import configure_hidden_secondary, \
     close_connections_to_hidden_secondaries
 from shardmonster.tests import settings as test_settings
@@ -87,7 +88,7 @@ class ShardingTestCase(unittest.TestCase):
             connection.close()
         connection_module._connection_cache = {}
         connection_module._cluster_uri_cache = {}
-        api._collection_cache = {}
+        operations._collection_cache.clear()
         metadata._metadata_stores = {}
 
     def _clean_data_before_tests(self):
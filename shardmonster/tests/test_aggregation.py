@@ -0,0 +1,129 @@
+from __future__ import absolute_import
+
+import datetime
+import unittest
+
+from bson.decimal128 import Decimal128
+from bson.objectid import ObjectId
+
+from shardmonster import aggregation
+
+
+class TestSplitPipeline(unittest.TestCase):
+    def test_group_is_split(self):
+        split = aggregation.split_pipeline([
+            {'$match': {'y': 1}},
+            {'$group': {
+                '_id': '$x',
+                'total': {'$sum': '$y'},
+                'mean': {'$avg': '$y'},
+            }},
+            {'$sort': {'total': -1}},
+            {'$limit': 1},
+        ])
+        self.assertEqual({'y': 1}, split.shard_pipeline[0]['$match'])
+        partial = split.shard_pipeline[1]['$group']
+        self.assertEqual({'$sum': '$y'}, partial['total'])
+        self.assertEqual(
+            {'$sum': '$y'}, partial['__shardmonster_avg_mean_sum'])
+        self.assertEqual(2, len(split.shard_pipeline))
+
+        result = split.merge([
+            [
+                {'_id': 1, 'total': 3, '__shardmonster_avg_mean_sum': 3,
+                 '__shardmonster_avg_mean_count': 2},
+                {'_id': 2, 'total': 1, '__shardmonster_avg_mean_sum': 1,
+                 '__shardmonster_avg_mean_count': 1},
+            ],
+            [
+                {'_id': 2, 'total': 5, '__shardmonster_avg_mean_sum': 5,
+                 '__shardmonster_avg_mean_count': 1},
+            ],
+        ])
+        self.assertEqual([{'_id': 2, 'total': 6, 'mean': 3.0}], result)
+
+    def test_min_max_ignore_missing(self):
+        split = aggregation.split_pipeline([{'$group': {
+            '_id': None, 'lo': {'$min': '$y'}, 'hi': {'$max': '$y'}}}])
+        result = split.merge([
+            [{'_id': None, 'lo': None, 'hi': None}],
+            [{'_id': None, 'lo': 3, 'hi': 7}],
+            [{'_id': None, 'lo': 1, 'hi': 5}],
+        ])
+        self.assertEqual([{'_id': None, 'lo': 1, 'hi': 7}], result)
+
+    def test_decimal_partials(self):
+        split = aggregation.split_pipeline([{'$group': {
+            '_id': None, 'total': {'$sum': '$y'}, 'mean': {'$avg': '$y'}}}])
+        result = split.merge([
+            [{'_id': None, 'total': Decimal128('1.1'),
+              '__shardmonster_avg_mean_sum': Decimal128('1.1'),
+              '__shardmonster_avg_mean_count': 1}],
+            [{'_id': None, 'total': 2,
+              '__shardmonster_avg_mean_sum': 2.5,
+              '__shardmonster_avg_mean_count': 2}],
+        ])
+        self.assertEqual([{
+            '_id': None, 'total': Decimal128('3.1'),
+            'mean': Decimal128('1.2')}], result)
+
+    def test_dates_and_object_ids_compare_natively(self):
+        sep = datetime.datetime(2020, 9, 1)
+        oct_ = datetime.datetime(2020, 10, 1)
+        jan = datetime.datetime(2021, 1, 15)
+        split = aggregation.split_pipeline([
+            {'$group': {
+                '_id': '$x', 'lo': {'$min': '$d'}, 'hi': {'$max': '$d'}}},
+            {'$sort': {'hi': 1}},
+        ])
+        result = split.merge([
+            [{'_id': 1, 'lo': sep, 'hi': oct_},
+             {'_id': 2, 'lo': jan, 'hi': jan}],
+            [{'_id': 1, 'lo': oct_, 'hi': sep},
+             {'_id': 3, 'lo': sep, 'hi': sep}],
+        ])
+        self.assertEqual([
+            {'_id': 3, 'lo': sep, 'hi': sep},
+            {'_id': 1, 'lo': sep, 'hi': oct_},
+            {'_id': 2, 'lo': jan, 'hi': jan},
+        ], result)
+
+        ids = [ObjectId.from_datetime(date) for date in [jan, sep, oct_]]
+        self.assertEqual(
+            [{'_id': ids[1]}, {'_id': ids[2]}, {'_id': ids[0]}],
+            aggregation.apply_merge_stages(
+                [{'_id': ids[0]}, {'_id': ids[1]}, {'_id': ids[2]}],
+                [{'$sort': {'_id': 1}}]))
+
+    def test_bson_type_order(self):
+        values = [
+            True, ObjectId(), [1], {'a': 1}, 'a', 2.5, 1, None,
+            datetime.datetime(2020, 1, 1)]
+        self.assertEqual(
+            [None, 1, 2.5, 'a', {'a': 1}, [1], values[1], True, values[8]],
+            sorted(values, key=aggregation._sort_key))
+
+    def test_sort_and_limit_are_pushed_down_without_group(self):
+        split = aggregation.split_pipeline([
+            {'$project': {'y': 1}},
+            {'$sort': {'y': 1}},
+            {'$skip': 2},
+            {'$limit': 3},
+        ])
+        self.assertEqual([
+            {'$project': {'y': 1}},
+            {'$sort': {'y': 1}},
+            {'$limit': 5},
+        ], split.shard_pipeline)
+        result = split.merge([
+            [{'y': 1}, {'y': 4}, {'y': 5}],
+            [{'y': 2}, {'y': 3}, {'y': 6}],
+        ])
+        self.assertEqual([{'y': 3}, {'y': 4}, {'y': 5}], result)
+
+    def test_unsupported_pipelines(self):
+        with self.assertRaises(Exception):
+            aggregation.split_pipeline([{'$lookup': {}}])
+        with self.assertRaises(Exception):
+            aggregation.split_pipeline(
+                [{'$group': {'_id': None, 'x': {'$push': '$x'}}}])
@@ -1,8 +1,12 @@
 from __future__ import absolute_import
 
 from shardmonster.api import (
-    ensure_realm_exists, set_shard_at_rest, start_migration, where_is)
-from shardmonster.metadata import _get_realm_for_collection, _get_realm_coll
+    ensure_realm_exists, ensure_realms_exist, route_explain,
+    set_shard_at_rest, set_shard_to_migration_status, set_shards_at_rest,
+    start_migration, where_are, where_is)
+from shardmonster.metadata import (
+    _get_realm_for_collection, _get_realm_coll, _get_shards_coll,
+    ShardStatus)
 from shardmonster.tests.base import ShardingTestCase
 
 
@@ -31,6 +35,34 @@ class TestRealm(ShardingTestCase):
         self.assertEqual(2, coll.count()) # One realm exists due to test base
 
 
+    def test_ensure_realms_exist(self):
+        ensure_realms_exist([
+            ('realm_1', 'some_field', 'collection_1', 'cluster-1/db'),
+            ('realm_2', 'some_field', 'collection_2', 'cluster-1/db'),
+        ])
+        self.assertEqual(
+            'realm_2', _get_realm_for_collection('collection_2')['name'])
+
+        # Only the missing realm is created
+        ensure_realms_exist([
+            ('realm_1', 'some_field', 'collection_1', 'cluster-1/db'),
+            ('realm_3', 'some_field', 'collection_3', 'cluster-1/db'),
+            ('realm_3', 'some_field', 'collection_3', 'cluster-1/db'),
+        ])
+        self.assertEqual(4, _get_realm_coll().count())
+
+        # Nothing is created if any realm conflicts
+        with self.assertRaises(Exception) as catcher:
+            ensure_realms_exist([
+                ('realm_4', 'some_field', 'collection_4', 'cluster-1/db'),
+                ('realm_5', 'some_field', 'collection_1', 'cluster-1/db'),
+            ])
+        self.assertEqual(
+            str(catcher.exception),
+            'Realm for collection collection_1 already exists')
+        self.assertEqual(4, _get_realm_coll().count())
+
+
     def test_ensure_changing_realm_breaks(self):
         ensure_realm_exists(
             'some_realm', 'some_field', 'some_collection', 'cluster-1/db')
@@ -95,6 +127,40 @@ class TestRealm(ShardingTestCase):
         set_shard_at_rest('some_realm', 1, 'dest2/db', force=True)
 
 
+    def test_set_shards_at_rest(self):
+        ensure_realm_exists(
+            'some_realm', 'some_field', 'some_collection', 'dest1/db')
+        set_shards_at_rest('some_realm', {1: 'dest1/db', 2: 'dest2/db'})
+        self.assertEqual('dest1/db', where_is('some_collection', 1))
+        self.assertEqual('dest2/db', where_is('some_collection', 2))
+
+        with self.assertRaises(Exception) as catcher:
+            set_shards_at_rest('some_realm', [(3, 'dest1/db'), (4, 'bad/db')])
+        self.assertEqual(
+            str(catcher.exception), 'Cluster bad has not been configured')
+
+        with self.assertRaises(Exception) as catcher:
+            set_shards_at_rest(
+                'some_realm', [(3, 'dest1/db'), (2, 'dest1/db')])
+        self.assertEqual(
+            str(catcher.exception),
+            'Shard with key 2 has already been placed. Use force=true if '
+            'you really want to do this')
+        # Nothing was written
+        self.assertEqual(
+            2, _get_shards_coll().find({'realm': 'some_realm'}).count())
+
+        start_migration('some_realm', 2, 'dest1/db')
+        set_shards_at_rest(
+            'some_realm', [(3, 'dest1/db'), (2, 'dest1/db')], force=True)
+        self.assertEqual(
+            {'dest1/db': [1, 2, 3]}, where_are('some_collection', [1, 2, 3]))
+        shard = _get_shards_coll().find_one(
+            {'realm': 'some_realm', 'shard_key': 2})
+        self.assertEqual(ShardStatus.AT_REST, shard['status'])
+        self.assertFalse('new_location' in shard)
+
+
     def test_where_is(self):
         ensure_realm_exists(
             'some_realm', 'some_field', 'some_collection', 'dest1/db')
@@ -104,3 +170,46 @@ class TestRealm(ShardingTestCase):
         self.assertEqual('dest2/db', where_is('some_collection', 1))
         # Default location
         self.assertEqual('dest1/db', where_is('some_collection', 2))
+
+    def test_where_are(self):
+        ensure_realm_exists(
+            'some_realm', 'some_field', 'some_collection', 'dest1/db')
+        set_shard_at_rest('some_realm', 1, 'dest2/db')
+        set_shard_at_rest('some_realm', 3, 'dest2/db')
+        set_shard_at_rest('some_realm', 4, 'dest2/db')
+        start_migration('some_realm', 4, 'dest3/db')
+        set_shard_to_migration_status(
+            'some_realm', 4, ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION)
+
+        self.assertEqual(
+            {'dest1/db': [2, 5], 'dest2/db': [1, 3], 'dest3/db': [4]},
+            where_are('some_collection', [1, 2, 3, 4, 5]))
+        self.assertEqual({}, where_are('some_collection', []))
+        self.assertEqual(
+            {'dest2/db': [1, 3]}, where_are('some_collection', iter([1, 3])))
+
+    def test_route_explain(self):
+        ensure_realm_exists(
+            'some_realm', 'some_field', 'some_collection', 'dest1/db')
+        set_shard_at_rest('some_realm', 1, 'dest2/db')
+
+        explanation = route_explain(
+            'some_collection', {'$or': [{'some_field': 1}, {'some_field': 2}]})
+        self.assertEqual([1, 2], explanation['shard_keys'])
+        self.assertEqual({
+            'dest1/db': {'$and': [
+                {'$or': [{'some_field': 1}, {'some_field': 2}]},
+                {'some_field': {'$in': [2]}}]},
+            'dest2/db': {'$and': [
+                {'$or': [{'some_field': 1}, {'some_field': 2}]},
+                {'some_field': {'$in': [1]}}]},
+        }, explanation['locations'])
+
+        explanation = route_explain('some_collection', {'other': 1})
+        self.assertEqual(None, explanation['shard_keys'])
+        self.assertEqual(
+            ['no condition on some_field'], explanation['reasons'])
+        self.assertEqual(None, explanation['index'])
+        self.assertEqual(
+            {'dest1/db': {'other': 1}, 'dest2/db': {'other': 1}},
+            explanation['locations'])
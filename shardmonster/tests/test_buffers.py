@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+
+import random
+import unittest
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from shardmonster import buffers
+
+
+class TestSortBuffer(unittest.TestCase):
+    def test_sorts_in_memory(self):
+        buffer = buffers.SortBuffer(lambda doc: doc['x'])
+        for x in [3, 1, 2]:
+            buffer.add({'x': x})
+        results = buffer.results()
+        self.assertEqual(0, buffer.runs_spilled)
+        self.assertEqual([1, 2, 3], [doc['x'] for doc in results])
+
+    def test_spills_and_merges(self):
+        docs = [{'x': random.randint(0, 100), 'i': i} for i in range(200)]
+        buffer = buffers.SortBuffer(lambda doc: doc['x'], memory_budget=500)
+        for doc in docs:
+            buffer.add(doc)
+        results = buffer.results()
+
+        self.assertTrue(buffer.runs_spilled > 1)
+        # The merge is stable so ties keep the order they were added in
+        self.assertEqual(
+            sorted(docs, key=lambda doc: doc['x']), list(results))
+
+    def test_spilled_raw_documents_stay_raw(self):
+        codec_options = CodecOptions(document_class=RawBSONDocument)
+        buffer = buffers.SortBuffer(
+            lambda doc: doc['x'], memory_budget=1, codec_options=codec_options)
+        for x in [2, 0, 1]:
+            buffer.add(RawBSONDocument(bson.BSON.encode({'x': x})))
+        results = list(buffer.results())
+        self.assertTrue(buffer.runs_spilled > 1)
+        self.assertTrue(
+            all(isinstance(doc, RawBSONDocument) for doc in results))
+        self.assertEqual([0, 1, 2], [doc['x'] for doc in results])
+
+    def test_sizes_are_estimated_from_a_sample(self):
+        buffer = buffers.SortBuffer(lambda doc: doc['x'])
+        small = {'x': 1}
+        buffer.add(small)
+        for x in range(buffers.SIZE_SAMPLE_INTERVAL - 1):
+            buffer.add({'x': x, 'padding': 'a' * 1000})
+        self.assertEqual(
+            buffers.SIZE_SAMPLE_INTERVAL * len(bson.BSON.encode(small)),
+            buffer._in_memory_bytes)
+
+        # The next document is measured and moves the average
+        buffer.add({'x': 0, 'padding': 'a' * 1000})
+        self.assertTrue(
+            buffer._in_memory_bytes >
+            (buffers.SIZE_SAMPLE_INTERVAL + 1) * len(bson.BSON.encode(small)))
+
+    def test_buffered_results(self):
+        results = buffers.BufferedResults([1, 2])
+        self.assertTrue(results)
+        self.assertEqual(1, next(results))
+        self.assertTrue(results)
+        self.assertEqual(2, next(results))
+        self.assertFalse(results)
+        with self.assertRaises(StopIteration):
+            next(results)
+
+    def test_close_releases_runs(self):
+        buffer = buffers.SortBuffer(lambda doc: doc['x'], memory_budget=1)
+        for x in range(3):
+            buffer.add({'x': x})
+        results = buffer.results()
+        files = list(results._files)
+        self.assertEqual(0, next(results)['x'])
+        results.close()
+        self.assertTrue(all(f.closed for f in files))
+        self.assertFalse(results)
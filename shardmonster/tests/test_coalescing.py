@@ -0,0 +1,219 @@
+from __future__ import absolute_import
+
+import threading
+import unittest
+
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.operations import InsertOne
+
+from shardmonster import api, coalescing
+from shardmonster.tests.base import ShardingTestCase
+
+
+class _FakeResult(object):
+    def __init__(self, bulk_api_result):
+        self.bulk_api_result = bulk_api_result
+
+
+class _FakeCoalescer(coalescing.WriteCoalescer):
+    def __init__(self, *args, **kwargs):
+        self.bulk_write_fn = kwargs.pop('bulk_write_fn')
+        self.requests_seen = []
+        super(_FakeCoalescer, self).__init__(*args, **kwargs)
+
+    def _get_collection(self):
+        return self
+
+    def bulk_write(self, requests, ordered=True):
+        self.requests_seen.append(requests)
+        return self.bulk_write_fn(requests)
+
+
+def _run_concurrently(fn, items):
+    results = [None] * len(items)
+
+    def _run(index, item):
+        try:
+            results[index] = fn(item)
+        except Exception as e:
+            results[index] = e
+
+    threads = [
+        threading.Thread(target=_run, args=(index, item))
+        for index, item in enumerate(items)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class TestWriteCoalescer(unittest.TestCase):
+    def test_concurrent_writes_share_a_batch(self):
+        coalescer = _FakeCoalescer(
+            'dest1/db', 'dummy', window=0.5, max_batch_size=4,
+            bulk_write_fn=lambda requests: _FakeResult({}))
+
+        results = _run_concurrently(
+            lambda x: coalescer.submit(InsertOne({'_id': x})), [1, 2, 3, 4])
+
+        self.assertEqual([1, 2, 3, 4], results)
+        self.assertEqual(1, len(coalescer.requests_seen))
+        self.assertEqual(1, coalescer.batches)
+        self.assertEqual(4, coalescer.writes)
+
+    def test_errors_go_to_their_callers(self):
+        def _bulk_write(requests):
+            index = [r._doc['_id'] for r in requests].index(2)
+            raise BulkWriteError({
+                'writeErrors': [
+                    {'index': index, 'code': 11000, 'errmsg': 'dup'}],
+                'upserted': [],
+            })
+
+        coalescer = _FakeCoalescer(
+            'dest1/db', 'dummy', window=0.5, max_batch_size=3,
+            bulk_write_fn=_bulk_write)
+
+        results = _run_concurrently(
+            lambda x: coalescer.submit(InsertOne({'_id': x})), [1, 2, 3])
+
+        self.assertEqual(1, results[0])
+        self.assertTrue(isinstance(results[1], DuplicateKeyError))
+        self.assertEqual(3, results[2])
+
+    def test_window_is_capped(self):
+        with self.assertRaises(Exception):
+            api.activate_write_coalescing(window=coalescing.MAX_WINDOW * 2)
+        self.assertFalse(coalescing.is_write_coalescing_active())
+
+    def test_failures_reach_everyone(self):
+        def _bulk_write(requests):
+            raise ValueError('down')
+
+        coalescer = _FakeCoalescer(
+            'dest1/db', 'dummy', window=0.5, max_batch_size=2,
+            bulk_write_fn=_bulk_write)
+
+        results = _run_concurrently(
+            lambda x: coalescer.submit(InsertOne({'_id': x})), [1, 2])
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+class TestCoalescedWrites(ShardingTestCase):
+    def setUp(self):
+        super(TestCoalescedWrites, self).setUp()
+        api.set_shard_at_rest('dummy', 1, 'dest1/test_sharding')
+        api.set_shard_at_rest('dummy', 2, 'dest2/test_sharding')
+        api.activate_write_coalescing(window=0.05, max_batch_size=4)
+
+    def tearDown(self):
+        api.deactivate_write_coalescing()
+        super(TestCoalescedWrites, self).tearDown()
+
+    def test_inserts_are_coalesced_but_upserts_are_not(self):
+        dummy = api.make_collection_shard_aware('dummy')
+
+        def _insert(n):
+            return dummy.insert({'x': n % 2 + 1, 'n': n})
+
+        ids = _run_concurrently(_insert, list(range(8)))
+        self.assertEqual(8, len(set(ids)))
+        self.assertEqual(4, self.db1.dummy.find().count())
+        self.assertEqual(4, self.db2.dummy.find().count())
+
+        result = dummy.update(
+            {'n': 100}, {'$set': {'x': 2, 'n': 100}}, upsert=True)
+        self.assertFalse(result['updatedExisting'])
+        self.assertEqual(0, result['nModified'])
+        self.assertEqual(1, self.db2.dummy.find({'n': 100}).count())
+
+        result = dummy.update(
+            {'n': 100}, {'$set': {'x': 2, 'n': 101}}, upsert=True)
+        self.assertTrue(result['updatedExisting'])
+        self.assertEqual(1, result['nModified'])
+
+        stats = api.get_write_coalescing_stats()
+        self.assertEqual(
+            4, stats[('dest1/test_sharding', 'dummy')]['writes'])
+        self.assertEqual(
+            4, stats[('dest2/test_sharding', 'dummy')]['writes'])
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        coalescing.reset_read_coalescing_stats()
+
+    def test_query_normalisation(self):
+        def _key(query):
+            return coalescing.make_read_key(
+                'dummy', 'dest1/db', query, (), {}, {})
+
+        self.assertEqual(
+            _key({'x': 1, 'y': {'$gt': 1, '$lt': 5}}),
+            _key({'y': {'$lt': 5, '$gt': 1}, 'x': 1}))
+        self.assertEqual(
+            _key({'$or': [{'a': 1, 'b': 2}]}),
+            _key({'$or': [{'b': 2, 'a': 1}]}))
+        # Embedded documents are matched in order so must not be merged
+        self.assertNotEqual(
+            _key({'x': {'a': 1, 'b': 2}}),
+            _key({'x': {'b': 2, 'a': 1}}))
+        self.assertNotEqual(_key({'x': 1}), _key({'x': '1'}))
+
+    def test_concurrent_reads_share_a_result(self):
+        arrived = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def _fetch():
+            calls.append(1)
+            arrived.set()
+            release.wait(5)
+            return [{'x': 1}]
+
+        results = []
+
+        def _read():
+            results.append(
+                coalescing.single_flight('dummy', 'key', _fetch))
+
+        threads = [threading.Thread(target=_read) for _ in range(4)]
+        threads[0].start()
+        arrived.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        # Wait for the followers to join the flight before it lands
+        while coalescing.get_read_coalescing_stats()['dummy'][
+                'requests'] < 4:
+            release.wait(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual([[{'x': 1}]] * 4, results)
+        self.assertFalse(results[0] is results[1])
+        self.assertEqual(
+            {'dummy': {'requests': 4, 'coalesced': 3}},
+            coalescing.get_read_coalescing_stats())
+
+
+class TestCoalescedReads(ShardingTestCase):
+    def setUp(self):
+        super(TestCoalescedReads, self).setUp()
+        api.set_shard_at_rest('dummy', 1, 'dest1/test_sharding')
+        api.activate_read_coalescing()
+
+    def tearDown(self):
+        api.deactivate_read_coalescing()
+        super(TestCoalescedReads, self).tearDown()
+
+    def test_targetted_reads(self):
+        doc = {'x': 1, 'y': 1}
+        self.db1.dummy.insert(doc)
+        dummy = api.make_collection_shard_aware('dummy')
+
+        self.assertEqual(doc, dummy.find_one({'x': 1, 'y': 1}))
+        self.assertEqual([doc], list(dummy.find({'x': 1})))
+        self.assertEqual([], list(dummy.find({'x': 1, 'y': 2})))
@@ -7,6 +7,7 @@ from .mock import Mock, call
 import shardmonster.connection
 from shardmonster.connection import (
     get_cluster_uri, _get_cluster_coll, ensure_cluster_exists,
+    ensure_clusters_exist,
     register_post_connect, connect_to_controller,
     configure_controller, get_controlling_db
 )
@@ -76,4 +77,22 @@ class TestCluster(ShardingTestCase):
         # Two clusters exist due to the base class
         self.assertEqual(3, coll.count())
 
+    def test_ensure_clusters_exist(self):
+        ensure_clusters_exist({
+            'cluster-a': 'mongodb://localhost:27017',
+            'cluster-b': 'mongodb://localhost:27018',
+        })
+        ensure_clusters_exist({
+            'cluster-b': 'mongodb://localhost:27018',
+            'cluster-c': 'mongodb://localhost:27019',
+        })
+        self.assertEqual(
+            'mongodb://localhost:27018', get_cluster_uri('cluster-b'))
+        self.assertEqual(
+            'mongodb://localhost:27019', get_cluster_uri('cluster-c'))
+
+        coll = _get_cluster_coll()
+        # Two clusters exist due to the base class
+        self.assertEqual(5, coll.count())
+
     # TODO Changing clusters
@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+
+import time
+import unittest
+
+from .mock import Mock
+
+from shardmonster import api, document_cache
+from shardmonster.cache_invalidation import (
+    DocumentCacheInvalidator, start_document_cache_invalidation)
+from shardmonster.tests.base import ShardingTestCase
+
+
+class TestDocumentCache(unittest.TestCase):
+    def test_get_and_put(self):
+        cache = document_cache.DocumentCache('dummy')
+        self.assertEqual((False, None), cache.get('a'))
+
+        doc = {'_id': 1, 'x': 1}
+        cache.put('a', 1, doc, cache.generation)
+        found, cached = cache.get('a')
+        self.assertTrue(found)
+        self.assertEqual(doc, cached)
+        # Callers get their own copy
+        cached['y'] = 2
+        self.assertEqual(doc, cache.get('a')[1])
+
+        # Misses are cached too
+        cache.put('b', 2, None, cache.generation)
+        self.assertEqual((True, None), cache.get('b'))
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_invalidation(self):
+        cache = document_cache.DocumentCache('dummy')
+        cache.put('a', 1, {'_id': 'doc-a', 'x': 1}, cache.generation)
+        cache.put('b', 1, {'_id': 'doc-b', 'x': 1}, cache.generation)
+        cache.put('c', 2, {'_id': 'doc-c', 'x': 2}, cache.generation)
+
+        cache.invalidate(doc_ids=['doc-a'])
+        self.assertEqual(2, len(cache))
+        cache.invalidate(shard_keys=[1])
+        self.assertEqual(1, len(cache))
+        self.assertTrue(cache.get('c')[0])
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.memory_usage)
+
+    def test_reads_that_race_an_invalidation_are_not_cached(self):
+        cache = document_cache.DocumentCache('dummy')
+        generation = cache.generation
+        cache.invalidate(shard_keys=[1])
+        cache.put('a', 1, {'_id': 1, 'x': 1}, generation)
+        self.assertEqual((False, None), cache.get('a'))
+
+    def test_bounds(self):
+        cache = document_cache.DocumentCache('dummy', max_entries=2)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, 1, {'_id': key}, cache.generation)
+        self.assertEqual(2, len(cache))
+        self.assertEqual(1, cache.evictions)
+        self.assertFalse(cache.get('a')[0])
+
+        doc = {'_id': 1, 'padding': 'x' * 100}
+        cache = document_cache.DocumentCache('dummy', max_bytes=300)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, 1, doc, cache.generation)
+        self.assertEqual(2, len(cache))
+        self.assertTrue(cache.memory_usage <= 300)
+
+        cache = document_cache.DocumentCache('dummy', ttl=0)
+        cache.put('a', 1, doc, cache.generation)
+        self.assertEqual((False, None), cache.get('a'))
+        self.assertEqual(0, len(cache))
+
+    def test_invalidate_for_oplog_entry(self):
+        document_cache.activate_document_cache('dummy')
+        self.addCleanup(document_cache.deactivate_document_cache, 'dummy')
+        cache = document_cache.get_document_cache('dummy')
+        invalidator = DocumentCacheInvalidator('dummy')
+
+        def _fill():
+            cache.clear()
+            cache.put('a', 1, {'_id': 'doc-a', 'x': 1}, cache.generation)
+            cache.put('b', 2, {'_id': 'doc-b', 'x': 2}, cache.generation)
+
+        _fill()
+        invalidator.invalidate_for_entry(
+            'x', {'op': 'i', 'o': {'_id': 'doc-c', 'x': 1}})
+        self.assertEqual(['b'], list(cache._entries))
+
+        _fill()
+        invalidator.invalidate_for_entry(
+            'x', {'op': 'u', 'o2': {'_id': 'doc-b'}, 'o': {'$set': {'y': 1}}})
+        # Without the document's shard key everything has to go
+        self.assertEqual([], list(cache._entries))
+
+        # An update can make a document match a query that cached a miss, so
+        # the whole shard is invalidated
+        _fill()
+        cache.put('miss', 1, None, cache.generation)
+        collection = Mock()
+        collection.find_one.return_value = {'_id': 'doc-d', 'x': 1}
+        invalidator.invalidate_for_entry(
+            'x', {'op': 'u', 'o2': {'_id': 'doc-d'}, 'o': {'$set': {'y': 1}}},
+            collection)
+        self.assertEqual(['b'], list(cache._entries))
+        collection.find_one.assert_called_once_with({'_id': 'doc-d'}, {'x': 1})
+
+        _fill()
+        invalidator.invalidate_for_entry(
+            'x', {'op': 'u', 'o2': {'_id': 'doc-e', 'x': 2},
+                  'o': {'$set': {'y': 1}}})
+        self.assertEqual(['a'], list(cache._entries))
+
+        _fill()
+        invalidator.invalidate_for_entry(
+            'x', {'op': 'd', 'o': {'_id': 'doc-a'}})
+        self.assertEqual(['b'], list(cache._entries))
+
+        _fill()
+        invalidator.invalidate_for_entry('x', {'op': 'n', 'o': {}})
+        self.assertEqual(2, len(cache))
+        invalidator.invalidate_for_entry('x', {'op': 'c', 'o': {'drop': 1}})
+        self.assertEqual(0, len(cache))
+
+
+class TestCachedReads(ShardingTestCase):
+    def setUp(self):
+        super(TestCachedReads, self).setUp()
+        api.set_shard_at_rest('dummy', 1, 'dest1/test_sharding')
+        api.set_shard_at_rest('dummy', 2, 'dest2/test_sharding')
+        api.activate_document_cache('dummy')
+
+    def tearDown(self):
+        api.deactivate_document_cache('dummy')
+        super(TestCachedReads, self).tearDown()
+
+    def test_read_through_and_invalidate_on_write(self):
+        collection = api.make_collection_shard_aware('dummy')
+        collection.insert({'_id': 'a', 'x': 1, 'y': 1})
+
+        self.assertEqual(
+            {'_id': 'a', 'x': 1, 'y': 1}, collection.find_one({'x': 1}))
+        # Written behind the cache's back so the cached copy is returned
+        self.db1.dummy.update({'_id': 'a'}, {'$set': {'y': 2}})
+        self.assertEqual(
+            {'_id': 'a', 'x': 1, 'y': 1}, collection.find_one({'x': 1}))
+
+        collection.update({'x': 1}, {'$set': {'z': 1}})
+        self.assertEqual(
+            {'_id': 'a', 'x': 1, 'y': 2, 'z': 1},
+            collection.find_one({'x': 1}))
+
+        # Untargetted reads aren't cached
+        self.assertEqual(
+            {'_id': 'a', 'x': 1, 'y': 2, 'z': 1},
+            collection.find_one({'y': 2}))
+
+        stats = api.get_document_cache_stats()['dummy']
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['entries'])
+
+        collection.remove({'x': 1})
+        self.assertEqual(None, collection.find_one({'x': 1}))
+
+    def test_oplog_invalidation(self):
+        collection = api.make_collection_shard_aware('dummy')
+        collection.insert({'_id': 'a', 'x': 2, 'y': 1})
+        invalidator = start_document_cache_invalidation(
+            'dummy', poll_interval=0.01)
+        self.addCleanup(invalidator.stop)
+
+        self.assertEqual(1, collection.find_one({'x': 2})['y'])
+        time.sleep(0.1)
+        self.db2.dummy.update({'_id': 'a'}, {'$set': {'y': 2}})
+
+        give_up_at = time.time() + 5
+        while collection.find_one({'x': 2})['y'] != 2:
+            self.assertTrue(time.time() < give_up_at)
+            time.sleep(0.01)
+        self.assertEqual(None, invalidator.exception)
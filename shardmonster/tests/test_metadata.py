@@ -1,10 +1,11 @@
 from __future__ import absolute_import
 
+import threading
 import time
 from .mock import patch
 from unittest import TestCase
 
-from shardmonster import api, metadata
+from shardmonster import api, metadata, stats
 from shardmonster.tests import settings as test_settings
 from shardmonster.tests.base import ShardingTestCase
 
@@ -54,7 +55,13 @@ class TestShardMetadataStore(ShardingTestCase):
         self.assertEqual(expected_shard_metadata, actual_shard_metadata)
         self.assertEqual(1, mock_query.call_count)
 
-        # Do another query and ensure we have NOT used a cached value
+        # An immediate query is served from the tiny in flux cache
+        actual_shard_metadata = store.get_single_shard_metadata(1)
+        self.assertEqual(expected_shard_metadata, actual_shard_metadata)
+        self.assertEqual(1, mock_query.call_count)
+
+        # Once that has expired we should NOT use a cached value
+        time.sleep(metadata.get_in_flux_caching_duration() * 2)
         actual_shard_metadata = store.get_single_shard_metadata(1)
         self.assertEqual(expected_shard_metadata, actual_shard_metadata)
         self.assertEqual(2, mock_query.call_count)
@@ -125,6 +132,7 @@ class TestShardMetadataStore(ShardingTestCase):
         # Do another query and we should end up refrshing just a single shard
         mock_query.return_value = [expected_metadata_1.copy()]
 
+        time.sleep(metadata.get_in_flux_caching_duration() * 2)
         actual_metadata = store.get_all_shard_metadata()
         self.assertEqual(
             {1: expected_metadata_1, 2: expected_metadata_2},
@@ -133,12 +141,172 @@ class TestShardMetadataStore(ShardingTestCase):
         mock_query.assert_called_with(1)
 
         # Another full query should skip the cache
+        time.sleep(metadata.get_in_flux_caching_duration() * 2)
         actual_metadata = store.get_all_shard_metadata()
         self.assertEqual(
             {1: expected_metadata_1, 2: expected_metadata_2},
             actual_metadata)
         self.assertEqual(3, mock_query.call_count)
 
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_cache_all_shards_multiple_in_flux(self, mock_query):
+        expected_metadata_1 = {
+            'status': metadata.ShardStatus.MIGRATING_SYNC, 'shard_key': 1}
+        expected_metadata_2 = {
+            'status': metadata.ShardStatus.AT_REST, 'shard_key': 2}
+        expected_metadata_3 = {
+            'status': metadata.ShardStatus.POST_MIGRATION_PAUSED_AT_SOURCE,
+            'shard_key': 3}
+        mock_query.return_value = [
+            expected_metadata_1.copy(), expected_metadata_2.copy(),
+            expected_metadata_3.copy()]
+
+        store = metadata.ShardMetadataStore('dummy-realm')
+        store.get_all_shard_metadata()
+        self.assertEqual(1, mock_query.call_count)
+
+        # Each shard in flux is refreshed on its own
+        def _single_shard(shard_key):
+            return [{1: expected_metadata_1, 3: expected_metadata_3}[
+                shard_key].copy()]
+        mock_query.side_effect = _single_shard
+
+        time.sleep(metadata.get_in_flux_caching_duration() * 2)
+        actual_metadata = store.get_all_shard_metadata()
+        self.assertEqual(
+            {1: expected_metadata_1, 2: expected_metadata_2,
+             3: expected_metadata_3},
+            actual_metadata)
+        self.assertEqual(3, mock_query.call_count)
+
+        # Once a shard settles it stops being refreshed
+        expected_metadata_3['status'] = metadata.ShardStatus.AT_REST
+        time.sleep(metadata.get_in_flux_caching_duration() * 2)
+        store.get_single_shard_metadata(3)
+        self.assertEqual(4, mock_query.call_count)
+
+        store.get_all_shard_metadata()
+        self.assertEqual(5, mock_query.call_count)
+        mock_query.assert_called_with(1)
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_single_shard_entries_are_bounded(self, mock_query):
+        def _single_shard(shard_key=None):
+            return [{'status': metadata.ShardStatus.AT_REST,
+                     'shard_key': shard_key}]
+        mock_query.side_effect = _single_shard
+
+        store = metadata.ShardMetadataStore('dummy-realm', max_entries=2)
+        store.get_single_shard_metadata(1)
+        store.get_single_shard_metadata(2)
+        # Touch 1 so that 2 becomes the least recently used
+        store.get_single_shard_metadata(1)
+        store.get_single_shard_metadata(3)
+        self.assertEqual(3, mock_query.call_count)
+        self.assertEqual(2, store.entry_count())
+        self.assertEqual(1, store.evictions)
+
+        store.get_single_shard_metadata(1)
+        self.assertEqual(3, mock_query.call_count)
+        store.get_single_shard_metadata(2)
+        self.assertEqual(4, mock_query.call_count)
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_concurrent_lookups(self, mock_query):
+        def _single_shard(shard_key=None):
+            return [{'status': metadata.ShardStatus.AT_REST,
+                     'shard_key': shard_key}]
+        mock_query.side_effect = _single_shard
+        api.activate_caching(60)
+        self.addCleanup(api.activate_caching, 0)
+
+        store = metadata.ShardMetadataStore('dummy-realm', max_entries=5)
+        errors = []
+
+        def _look_up(offset):
+            try:
+                for i in range(2000):
+                    store.get_single_shard_metadata((i * 7 + offset) % 20)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=_look_up, args=(offset,))
+            for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(5, store.entry_count())
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_full_refresh_entries_are_not_evicted(self, mock_query):
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 1},
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 2}]
+
+        store = metadata.ShardMetadataStore('dummy-realm', max_entries=1)
+        store.get_all_shard_metadata()
+        self.assertEqual(2, store.entry_count())
+
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 3}]
+        store.get_single_shard_metadata(3)
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 4}]
+        store.get_single_shard_metadata(4)
+
+        self.assertEqual({1, 2, 4}, set(store.get_all_shard_metadata()))
+        self.assertEqual(1, store.evictions)
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_removed_full_refresh_entries_become_evictable(self, mock_query):
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 1},
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 2}]
+        store = metadata.ShardMetadataStore('dummy-realm', max_entries=1)
+        store.get_all_shard_metadata()
+
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 2}]
+        store._refresh_all_shard_metadata()
+        self.assertEqual(2, store.entry_count())
+
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 3}]
+        store.get_single_shard_metadata(3)
+        self.assertEqual({2, 3}, set(store._cache))
+        self.assertEqual(1, store.evictions)
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_realm_cache_policy_timeout(self, mock_query):
+        expected_shard_metadata = {
+            'status': metadata.ShardStatus.AT_REST, 'shard_key': 1}
+        mock_query.return_value = [expected_shard_metadata.copy()]
+
+        store = metadata.ShardMetadataStore('dummy-realm')
+        store.realm = {'name': 'dummy-realm', 'cache_policy': {'timeout': 60}}
+        store.get_single_shard_metadata(1)
+        time.sleep(self._cache_length * 2)
+        store.get_single_shard_metadata(1)
+        self.assertEqual(1, mock_query.call_count)
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_realm_cache_policy_full_refresh(self, mock_query):
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 1},
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 2}]
+
+        store = metadata.ShardMetadataStore('dummy-realm')
+        store.realm = {
+            'name': 'dummy-realm',
+            'cache_policy': {'refresh_mode': metadata.REFRESH_FULL}}
+        store.get_single_shard_metadata(1)
+        store.get_single_shard_metadata(2)
+        self.assertEqual(1, mock_query.call_count)
+        mock_query.assert_called_with()
+
     def test_fetch_all_shards_from_metadata(self):
         api.create_realm(
             'dummy-realm', 'some_field', 'dummy_collection',
@@ -213,6 +381,83 @@ class TestShardMetadataStore(ShardingTestCase):
         self.assertEqual([1], all_locations['dest2/some_db'].contains)
         self.assertEqual([], all_locations['dest2/some_db'].excludes)
 
+    def test_get_metadata_for_many_shards(self):
+        api.create_realm(
+            'dummy-realm', 'some_field', 'dummy_collection',
+            'cluster-1/some_db')
+        api.set_shard_at_rest('dummy-realm', 1, 'dest2/some_db')
+        api.set_shard_at_rest('dummy-realm', 3, 'dest1/some_db')
+        realm = metadata._get_realm_for_collection('dummy_collection')
+        stats.reset_stats()
+
+        shards = metadata._get_metadata_for_shards(realm, [1, 2, 3, 1])
+        self.assertEqual(
+            {1: 'dest2/some_db', 2: 'cluster-1/some_db', 3: 'dest1/some_db'},
+            {shard_key: shard['location']
+             for shard_key, shard in shards.items()})
+        round_trips = api.get_metadata_stats()['round_trips']
+        self.assertEqual(
+            1, round_trips[stats.MULTI_SHARD_REFRESH]['count'])
+        self.assertFalse(stats.SINGLE_SHARD_REFRESH in round_trips)
+
+
+class TestRealmCachePolicy(ShardingTestCase):
+    def setUp(self):
+        super(TestRealmCachePolicy, self).setUp()
+        api.activate_caching(0.05)
+
+    def tearDown(self):
+        super(TestRealmCachePolicy, self).tearDown()
+        api.activate_caching(0)
+
+    def test_set_policy_for_one_realm(self):
+        api.create_realm(
+            'other-realm', 'x', 'other', 'dest1/some_db')
+        api.set_realm_cache_policy('dummy', timeout=60, in_flux_timeout=0.005)
+
+        realm = metadata._get_realm_for_collection('dummy')
+        self.assertEqual(60, metadata.get_caching_duration(realm))
+        self.assertEqual(0.005, metadata.get_in_flux_caching_duration(realm))
+
+        other_realm = metadata._get_realm_for_collection('other')
+        self.assertEqual(0.05, metadata.get_caching_duration(other_realm))
+
+        # Clearing the policy falls back to the global settings
+        api.set_realm_cache_policy('dummy')
+        realm = metadata._get_realm_for_collection('dummy')
+        self.assertEqual(0.05, metadata.get_caching_duration(realm))
+
+    def test_lowered_timeout_is_waited_on_until_it_expires(self):
+        api.set_realm_cache_policy('dummy', timeout=60)
+        api.set_realm_cache_policy('dummy', timeout=1)
+
+        realm = metadata._get_realm_for_collection('dummy')
+        self.assertEqual(1, metadata.get_caching_duration(realm))
+        self.assertEqual(60, metadata.get_longest_caching_duration(realm))
+        self.assertEqual(1, metadata.get_longest_caching_duration(
+            realm, realm['previous_cache_timeout']['until']))
+
+        # Lowering it again still waits on the longest timeout
+        api.set_realm_cache_policy('dummy', timeout=0.5)
+        realm = metadata._get_realm_for_collection('dummy')
+        self.assertEqual(60, metadata.get_longest_caching_duration(realm))
+
+    def test_policy_change_does_not_flush_other_realms(self):
+        api.create_realm(
+            'other-realm', 'x', 'other', 'dest1/some_db')
+        other_realm = metadata._get_realm_for_collection('other')
+        other_store = metadata._get_metadata_store(other_realm)
+        other_store.get_single_shard_metadata(1)
+
+        api.set_realm_cache_policy('dummy', timeout=60)
+        self.assertEqual(1, other_store.entry_count())
+
+    def test_unknown_refresh_mode(self):
+        with self.assertRaises(Exception) as catcher:
+            api.set_realm_cache_policy('dummy', refresh_mode='sometimes')
+        self.assertEqual(
+            'Unknown refresh mode sometimes', str(catcher.exception))
+
 
 class TestGetRealm(ShardingTestCase):
     def setUp(self):
@@ -1,17 +1,23 @@
 from __future__ import absolute_import
 
 import bson
+import threading
+import time
 from .mock import Mock, patch
-from unittest import skipIf
+from unittest import skipIf, TestCase
 
 import six
 
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 from pymongo.cursor import Cursor
-from pymongo.errors import OperationFailure
+from pymongo.errors import ExecutionTimeout, OperationFailure
 from pymongo.read_preferences import ReadPreference
 from pymongo import ASCENDING
+from pymongo.operations import DeleteMany, InsertOne, UpdateMany, UpdateOne
 
-from shardmonster import api, operations
+from shardmonster import api, operations, stats
+from shardmonster.connection import close_thread_connections
 from shardmonster.tests.base import ShardingTestCase
 
 
@@ -203,6 +209,100 @@ class TestStandardMultishardOperations(ShardingTestCase):
         results = list(self.db2.dummy.find({'y': 1}))
         self.assertEqual([doc2], results)
 
+    def test_insert_list_returns_ids_in_order(self):
+        docs = [{'x': 2, 'y': 1}, {'x': 1, 'y': 2}, {'x': 2, 'y': 3}]
+        with patch.object(operations, 'MAX_INSERT_BATCH_DOCS', 1):
+            result = operations.multishard_insert('dummy', docs)
+
+        self.assertEqual([doc['_id'] for doc in docs], result)
+        self.assertEqual(1, self.db1.dummy.find().count())
+        self.assertEqual(2, self.db2.dummy.find().count())
+
+    def test_insert_list_fetches_metadata_once(self):
+        api.set_shard_at_rest('dummy', 3, 'dest2/test_sharding')
+        stats.reset_stats()
+        operations.multishard_insert(
+            'dummy', [{'x': 1}, {'x': 2}, {'x': 3}, {'x': 1}])
+
+        round_trips = stats.get_round_trip_stats()
+        self.assertEqual(
+            1, round_trips[stats.MULTI_SHARD_REFRESH]['count'])
+        self.assertNotIn(stats.SINGLE_SHARD_REFRESH, round_trips)
+        self.assertNotIn(stats.PAUSE_CHECK, round_trips)
+        self.assertEqual(2, self.db1.dummy.find().count())
+        self.assertEqual(2, self.db2.dummy.find().count())
+
+    def test_insert_list_reports_failures_per_document(self):
+        existing = {'_id': 'taken', 'x': 2, 'y': 0}
+        self.db2.dummy.insert(existing)
+
+        docs = [
+            {'x': 1, 'y': 1}, {'_id': 'taken', 'x': 2, 'y': 2},
+            {'x': 2, 'y': 3}]
+        with self.assertRaises(operations.MultishardInsertError) as catcher:
+            operations.multishard_insert('dummy', docs)
+
+        self.assertEqual(
+            [docs[0]['_id'], None, docs[2]['_id']],
+            catcher.exception.inserted_ids)
+        self.assertEqual([1], list(catcher.exception.errors))
+        # Unordered inserts carry on after a failure
+        self.assertEqual(2, self.db2.dummy.find().count())
+
+    def test_bulk_write(self):
+        doc1 = {'x': 1, 'y': 1}
+        doc2 = {'x': 2, 'y': 1}
+        self.db1.dummy.insert(doc1)
+        self.db2.dummy.insert(doc2)
+
+        result = operations.multishard_bulk_write('dummy', [
+            InsertOne({'x': 1, 'y': 2}),
+            InsertOne({'x': 2, 'y': 2}),
+            UpdateOne({'x': 1, 'y': 1}, {'$set': {'z': 1}}),
+            UpdateMany({'y': 2}, {'$set': {'z': 2}}),
+            UpdateOne(
+                {'_id': 'alpha'}, {'$set': {'x': 2, 'y': 3}}, upsert=True),
+            DeleteMany({'x': 2, 'y': 1}),
+        ])
+
+        self.assertEqual(2, result.inserted_count)
+        self.assertEqual(3, result.matched_count)
+        self.assertEqual(1, result.deleted_count)
+        self.assertEqual({4: 'alpha'}, result.upserted_ids)
+        self.assertEqual(
+            [1, 2], sorted(d['y'] for d in self.db1.dummy.find()))
+        self.assertEqual(
+            [2, 3], sorted(d['y'] for d in self.db2.dummy.find()))
+        self.assertEqual(
+            [1, 2], sorted(d['z'] for d in self.db1.dummy.find()))
+        self.assertEqual(1, self.db2.dummy.find({'z': 2}).count())
+
+    def test_bulk_write_fetches_metadata_once(self):
+        api.set_shard_at_rest('dummy', 3, 'dest2/test_sharding')
+        stats.reset_stats()
+        operations.multishard_bulk_write('dummy', [
+            InsertOne({'x': 1, 'y': 1}),
+            InsertOne({'x': 2, 'y': 1}),
+            UpdateOne({'x': 3}, {'$set': {'y': 2}}, upsert=True),
+            InsertOne({'x': 1, 'y': 3}),
+        ])
+
+        round_trips = stats.get_round_trip_stats()
+        self.assertEqual(
+            1, round_trips[stats.MULTI_SHARD_REFRESH]['count'])
+        self.assertNotIn(stats.SINGLE_SHARD_REFRESH, round_trips)
+        self.assertNotIn(stats.PAUSE_CHECK, round_trips)
+        self.assertEqual(2, self.db1.dummy.find().count())
+        self.assertEqual(2, self.db2.dummy.find().count())
+
+    def test_bulk_write_untargetted_single_document_op_raises(self):
+        with self.assertRaises(Exception) as catcher:
+            operations.multishard_bulk_write(
+                'dummy', [UpdateOne({'y': 1}, {'$set': {'z': 1}})])
+        self.assertEqual(
+            'UpdateOne in a bulk write must target a single shard',
+            str(catcher.exception))
+
     @skipIf(six.PY3, 'Python 3 does not have longs')
     def test_insert_with_longs(self):
         # Perform an insert using longs. This tests a specific bug we found
@@ -236,6 +336,40 @@ class TestStandardMultishardOperations(ShardingTestCase):
         result, = operations.multishard_find('dummy', {'x': 2})
         self.assertEqual(2, result['y'])
 
+    def test_multi_update_in_parallel(self):
+        doc1 = {'x': 1, 'y': 1}
+        doc2 = {'x': 2, 'y': 1}
+        self.db1.dummy.insert(doc1)
+        self.db2.dummy.insert(doc2)
+
+        result = operations.multishard_update(
+            'dummy', {}, {'$inc': {'y': 1}}, multi=True, parallel=True)
+        self.assertEqual(2, result['n'])
+        self.assertEqual(
+            [2, 2], [d['y'] for d in operations.multishard_find('dummy', {})])
+
+    def test_parallel_update_reports_partial_failure(self):
+        self.db1.dummy.insert({'x': 1, 'y': 1})
+        self.db2.dummy.insert({'x': 2, 'y': 'not a number'})
+
+        with self.assertRaises(operations.MultishardWriteError) as catcher:
+            operations.multishard_update(
+                'dummy', {}, {'$inc': {'y': 1}}, parallel=True)
+        self.assertEqual(
+            ['dest1/test_sharding'], list(catcher.exception.succeeded))
+        self.assertEqual(
+            ['dest2/test_sharding'], list(catcher.exception.failed))
+
+    def test_multi_remove_in_parallel(self):
+        self.db1.dummy.insert({'x': 1, 'y': 1})
+        self.db2.dummy.insert({'x': 2, 'y': 1})
+
+        result = operations.multishard_remove('dummy', {'y': 1}, parallel=True)
+
+        self.assertEqual(2, result['n'])
+        self.assertEqual(0, self.db1.dummy.find({}).count())
+        self.assertEqual(0, self.db2.dummy.find({}).count())
+
     def test_remove(self):
         # Perform removes with shards set to specific locations.
         doc1 = {'x': 1, 'y': 1}
@@ -289,7 +423,7 @@ class TestStandardMultishardOperations(ShardingTestCase):
         result = list(operations.multishard_aggregate('dummy', pipeline))
         self.assertEqual([{'_id': 'total', 's': 45}], result)
 
-    def test_aggregate_with_match_or_and_multiple_shard_keys_raises_error(self):
+    def test_aggregate_with_match_or_and_multiple_shard_keys(self):
         for y in range(10):
             doc1 = {'x': 1, 'y': y}
             doc2 = {'x': 2, 'y': y}
@@ -300,10 +434,10 @@ class TestStandardMultishardOperations(ShardingTestCase):
             {'$match': {'$or': [{'x': 1}, {'x': 2}]}},
             {'$group': {'_id': 'total', 's': {'$sum': '$y'}}},
         ]
-        with self.assertRaises(Exception):
-            list(operations.multishard_aggregate('dummy', pipeline))
+        result = list(operations.multishard_aggregate('dummy', pipeline))
+        self.assertEqual([{'_id': 'total', 's': 90}], result)
 
-    def test_aggregate_with_match_or_with_no_shard_keys_raises_error(self):
+    def test_aggregate_with_match_or_with_no_shard_keys(self):
         for y in range(10):
             doc1 = {'x': 1, 'y': y}
             doc2 = {'x': 2, 'y': y}
@@ -314,10 +448,10 @@ class TestStandardMultishardOperations(ShardingTestCase):
             {'$match': {'$or': [{'y': 1}, {'y': 2}]}},
             {'$group': {'_id': 'total', 's': {'$sum': '$y'}}},
         ]
-        with self.assertRaises(Exception):
-            list(operations.multishard_aggregate('dummy', pipeline))
+        result = list(operations.multishard_aggregate('dummy', pipeline))
+        self.assertEqual([{'_id': 'total', 's': 6}], result)
 
-    def test_aggregate_with_match_or_with_not_all_shard_keys_raises_error(self):
+    def test_aggregate_with_match_or_with_not_all_shard_keys(self):
         for y in range(10):
             doc1 = {'x': 1, 'y': y}
             doc2 = {'x': 2, 'y': y}
@@ -328,6 +462,55 @@ class TestStandardMultishardOperations(ShardingTestCase):
             {'$match': {'$or': [{'x': 1}, {'y': 2}]}},
             {'$group': {'_id': 'total', 's': {'$sum': '$y'}}},
         ]
+        result = list(operations.multishard_aggregate('dummy', pipeline))
+        self.assertEqual([{'_id': 'total', 's': 47}], result)
+
+    def test_aggregate_across_shards(self):
+        api.start_migration('dummy', 2, 'dest1/test_sharding')
+        for y in range(10):
+            self.db1.dummy.insert({'x': 1, 'y': y})
+            self.db2.dummy.insert({'x': 2, 'y': y})
+            # A partial copy of shard 2 that must be excluded
+            self.db1.dummy.insert({'x': 2, 'y': y})
+
+        pipeline = [
+            {'$project': {'x': 1, 'y': 1, 'big': {'$gte': ['$y', 5]}}},
+            {'$group': {
+                '_id': '$big',
+                'total': {'$sum': '$y'},
+                'lowest': {'$min': '$y'},
+                'highest': {'$max': '$y'},
+                'mean': {'$avg': '$y'},
+                'n': {'$count': {}},
+            }},
+            {'$sort': {'_id': -1}},
+            {'$limit': 1},
+        ]
+        result = list(operations.multishard_aggregate('dummy', pipeline))
+        self.assertEqual([{
+            '_id': True, 'total': 70, 'lowest': 5, 'highest': 9,
+            'mean': 7.0, 'n': 10,
+        }], result)
+
+    def test_aggregate_across_shards_without_group(self):
+        for y in range(10):
+            self.db1.dummy.insert({'x': 1, 'y': y})
+            self.db2.dummy.insert({'x': 2, 'y': y + 10})
+
+        pipeline = [
+            {'$project': {'_id': 0, 'y': 1}},
+            {'$sort': {'y': -1}},
+            {'$skip': 1},
+            {'$limit': 2},
+        ]
+        result = list(operations.multishard_aggregate('dummy', pipeline))
+        self.assertEqual([{'y': 18}, {'y': 17}], result)
+
+    def test_aggregate_across_shards_with_unsupported_stage(self):
+        pipeline = [
+            {'$group': {'_id': '$x', 'n': {'$sum': 1}}},
+            {'$project': {'n': 1}},
+        ]
         with self.assertRaises(Exception):
             list(operations.multishard_aggregate('dummy', pipeline))
 
@@ -452,6 +635,37 @@ class TestStandardMultishardOperations(ShardingTestCase):
             c.explain()
             self.assertTrue(explain_mock.called)
 
+    def test_close(self):
+        for i in range(5):
+            self.db1.dummy.insert({'x': 1, 'y': i})
+            self.db2.dummy.insert({'x': 2, 'y': i})
+
+        c = operations.multishard_find('dummy', {}).batch_size(2)
+        next(c)
+        underlying = c._current_cursor
+        self.assertFalse(underlying._Cursor__killed)
+
+        c.close()
+        self.assertTrue(underlying._Cursor__killed)
+        self.assertFalse(c.alive)
+        self.assertEqual([], [doc for doc in c])
+        # The cursors used for the results aren't referenced after closing
+        self.assertEqual([], c._open_cursors)
+        self.assertEqual(1, len(c.explain()))
+
+        c.rewind()
+        self.assertEqual(10, len([doc for doc in c]))
+
+    def test_cursor_as_context_manager(self):
+        for i in range(5):
+            self.db1.dummy.insert({'x': 1, 'y': i})
+
+        with operations.multishard_find('dummy', {}).batch_size(2) as c:
+            next(c)
+            underlying = c._current_cursor
+        self.assertTrue(underlying._Cursor__killed)
+        self.assertEqual([], [doc for doc in c])
+
     def test_indexed_read(self):
         doc1 = {'x': 1, 'y': 1}
         doc2 = {'x': 2, 'y': 1}
@@ -706,6 +920,52 @@ class TestStandardMultishardOperations(ShardingTestCase):
 
         _callback.assert_not_called()
 
+    def test_multishard_create_index_in_every_location(self):
+        name = operations.multishard_create_index('dummy', [('x', ASCENDING)])
+        self.assertEqual('x_1', name)
+        self.assertTrue('x_1' in self.db1.dummy.index_information())
+        self.assertTrue('x_1' in self.db2.dummy.index_information())
+        self.assertEqual(
+            {'dest1/test_sharding': [], 'dest2/test_sharding': []},
+            api.get_index_build_progress('dummy'))
+
+    def test_multishard_create_index_failure(self):
+        # The same keys with different options can't be built in dest2
+        self.db2.dummy.create_index([('x', ASCENDING)], unique=True)
+        with self.assertRaises(operations.MultishardIndexError) as catcher:
+            operations.multishard_create_index('dummy', [('x', ASCENDING)])
+        self.assertEqual(['dest1/test_sharding'], catcher.exception.succeeded)
+        self.assertEqual(
+            ['dest2/test_sharding'], list(catcher.exception.failed))
+        self.assertTrue('x_1' in self.db1.dummy.index_information())
+
+    def test_multishard_create_index_concurrency_per_cluster(self):
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def _create_index(*args, **kwargs):
+            with lock:
+                running.append(1)
+                most_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+            return 'x_1'
+
+        collection = Mock(create_index=_create_index)
+        targets = [
+            (collection, {}, 'dest1/db%d' % i) for i in range(4)] + [
+            (collection, {}, 'dest2/db')]
+        with patch.object(
+                operations, '_create_collection_iterator',
+                return_value=iter(targets)):
+            operations.multishard_create_index(
+                'dummy', [('x', ASCENDING)], max_concurrency_per_cluster=1)
+        # Only one build runs on dest1 at a time, with dest2 alongside
+        self.assertEqual(5, len(most_running))
+        self.assertTrue(max(most_running) <= 2)
+
     def test_multishard_batch_size_paging(self):
         for i in range(10):
             self.db1.dummy.insert({'x': 1, 'y': i})
@@ -725,6 +985,176 @@ class TestStandardMultishardOperations(ShardingTestCase):
         qs._prepare_for_iteration()
         self.assertEqual(qs._current_cursor._Cursor__batch_size, 5)
 
+    def test_in_queries_are_routed_per_location(self):
+        api.set_shard_at_rest('dummy', 3, 'dest1/test_sharding')
+        doc1 = {'x': 1, 'y': 1}
+        doc2 = {'x': 2, 'y': 1}
+        doc3 = {'x': 3, 'y': 1}
+        self.db1.dummy.insert(doc1)
+        self.db2.dummy.insert(doc2)
+        self.db1.dummy.insert(doc3)
+        # Not the source of truth for shard 2 so must not be returned
+        self.db1.dummy.insert({'x': 2, 'y': 1})
+
+        _callback = Mock()
+        api.set_untargetted_query_callback(_callback)
+
+        query = {'x': {'$in': [1, 2, 3]}, 'y': 1}
+        targets = sorted(
+            (location, q['x']['$in']) for _, q, location in
+            operations._create_collection_iterator('dummy', query))
+        self.assertEqual([
+            ('dest1/test_sharding', [1, 3]),
+            ('dest2/test_sharding', [2]),
+        ], targets)
+
+        results = operations.multishard_find('dummy', query, sort=[('x', 1)])
+        self.assertEqual([doc1, doc2, doc3], list(results))
+
+        operations.multishard_update(
+            'dummy', {'x': {'$in': [1, 2]}}, {'$set': {'z': 1}}, multi=True)
+        self.assertEqual(1, self.db1.dummy.find({'z': 1}).count())
+        self.assertEqual(1, self.db2.dummy.find({'z': 1}).count())
+        _callback.assert_not_called()
+
+    def test_multishard_count_documents(self):
+        for y in range(3):
+            self.db1.dummy.insert({'x': 1, 'y': y})
+            self.db2.dummy.insert({'x': 2, 'y': y})
+
+        dummy = api.make_collection_shard_aware('dummy')
+        self.assertEqual(6, dummy.count_documents({}))
+        self.assertEqual(2, dummy.count_documents({'y': 1}))
+        self.assertEqual(3, dummy.count_documents({'x': 2}))
+        self.assertEqual(4, dummy.count_documents({}, skip=2))
+        self.assertEqual(3, dummy.count_documents({}, skip=2, limit=3))
+        self.assertEqual(1, dummy.count_documents({}, skip=5, limit=3))
+
+    def test_multishard_counts_and_distinct_during_migration(self):
+        api.start_migration('dummy', 2, 'dest1/test_sharding')
+        for y in range(3):
+            self.db1.dummy.insert({'x': 1, 'y': y})
+            self.db2.dummy.insert({'x': 2, 'y': y + 10})
+            # Partially copied documents that must not be counted
+            self.db1.dummy.insert({'x': 2, 'y': y + 10})
+        self.db1.dummy.insert({'x': 2, 'y': 100})
+
+        dummy = api.make_collection_shard_aware('dummy')
+        self.assertEqual(6, dummy.count_documents({}))
+        self.assertEqual(6, dummy.estimated_document_count())
+        self.assertEqual(6, dummy.find({}).count())
+        self.assertEqual(
+            [0, 1, 2, 10, 11, 12], sorted(dummy.distinct('y')))
+        self.assertEqual([1], dummy.distinct('x', {'y': 1}))
+        self.assertEqual([2], dummy.distinct('x', {'y': 11}))
+
+    def test_multishard_sort_spills_to_disk(self):
+        for y in range(50):
+            self.db1.dummy.insert({'x': 1, 'y': y * 2})
+            self.db2.dummy.insert({'x': 2, 'y': y * 2 + 1})
+
+        cursor = operations.multishard_find(
+            'dummy', {}, {'_id': 0}, sort=[('y', -1)]).sort_memory_budget(100)
+        results = [doc['y'] for doc in cursor]
+        self.assertEqual(list(reversed(range(100))), results)
+
+    def test_multishard_find_deadline(self):
+        self.db1.dummy.insert({'x': 1, 'y': 1})
+        self.db2.dummy.insert({'x': 2, 'y': 1})
+
+        cursor = operations.multishard_find(
+            'dummy', {}, deadline=time.time() + 10)
+        cursor._prepare_for_iteration()
+        max_time_ms = cursor._current_cursor.cursor._Cursor__max_time_ms
+        self.assertTrue(0 < max_time_ms <= 10000)
+        self.assertEqual(2, len([doc for doc in cursor]))
+
+        cursor = operations.multishard_find(
+            'dummy', {}, deadline=time.time() - 1)
+        with self.assertRaises(ExecutionTimeout):
+            [doc for doc in cursor]
+
+    def test_multishard_find_deadline_with_partial_results(self):
+        self.db1.dummy.insert({'x': 1, 'y': 1})
+        self.db2.dummy.insert({'x': 2, 'y': 1})
+
+        cursor = operations.multishard_find('dummy', {}).set_deadline(
+            time.time() - 1, partial_results=True)
+        self.assertEqual([], [doc for doc in cursor])
+        self.assertEqual(
+            ['dest1/test_sharding', 'dest2/test_sharding'],
+            sorted(cursor.skipped_locations))
+
+
+class _SlowCursor(object):
+    """A cursor whose query takes longer than the deadline."""
+    alive = True
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        time.sleep(self.delay)
+        raise ExecutionTimeout('operation exceeded time limit')
+
+    next = __next__
+
+    def close(self):
+        pass
+
+
+class TestDeadlines(TestCase):
+    def _find(self, partial_results):
+        targets = [
+            ('slow', {}, 'slow/db', None),
+            ('fast', {}, 'fast/db', None),
+        ]
+
+        def _find(collection, query, args, kwargs, hint):
+            self.assertTrue(0 < kwargs['max_time_ms'] <= 200)
+            if collection == 'slow':
+                return _SlowCursor(0.2)
+            return operations._ListCursor([{'x': 1}, {'x': 2}])
+
+        cursor = operations.MultishardCursor(
+            'dummy', {}, deadline=time.time() + 0.2,
+            partial_results=partial_results)
+        with patch.object(
+                operations.MultishardCursor, '_create_query_targets',
+                lambda self: targets), \
+                patch.object(operations, '_find', _find):
+            return cursor, [doc for doc in cursor]
+
+    def test_slow_location_does_not_hold_up_the_others(self):
+        cursor, results = self._find(partial_results=True)
+        self.assertEqual([{'x': 1}, {'x': 2}], results)
+        self.assertEqual(['slow/db'], cursor.skipped_locations)
+
+    def test_slow_location_times_out(self):
+        with self.assertRaises(ExecutionTimeout):
+            self._find(partial_results=False)
+
+
+class TestDistinct(TestCase):
+    def test_values_are_merged_by_bson_type(self):
+        first = Mock()
+        first.distinct.return_value = [True, 1, {'a': 1}, 'x']
+        second = Mock()
+        second.distinct.return_value = [1.0, 1, False, 0, {'a': 1}, 'x']
+        with patch.object(
+                operations, '_create_collection_iterator',
+                return_value=[(first, {}), (second, {})]):
+            values = operations.multishard_distinct('dummy', 'x')
+
+        self.assertEqual(
+            [True, 1, {'a': 1}, 'x', 1.0, False, 0], values)
+        self.assertEqual(
+            [bool, int, dict, str, float, bool, int],
+            [type(value) for value in values])
+
 
 class TestOtherOperations(ShardingTestCase):
     def test_multishard_find_during_migration(self):
@@ -749,6 +1179,158 @@ class TestOtherOperations(ShardingTestCase):
         results = sorted(list(c), key=lambda d: d['x'])
         self.assertEqual([doc1, doc2_fresh], results)
 
+    def test_multishard_find_during_multiple_migrations(self):
+        # Two shards are moving between the same pair of locations at once.
+        # The stale copies of both need to be excluded from the results.
+        api.set_shard_at_rest('dummy', 1, "dest1/test_sharding")
+        api.set_shard_at_rest('dummy', 2, "dest1/test_sharding")
+        api.set_shard_at_rest('dummy', 3, "dest2/test_sharding")
+        api.set_shard_at_rest('dummy', 4, "dest2/test_sharding")
+        api.start_migration('dummy', 2, "dest2/test_sharding")
+        api.start_migration('dummy', 4, "dest1/test_sharding")
+        api.set_shard_to_migration_status(
+            'dummy', 4, api.ShardStatus.POST_MIGRATION_PAUSED_AT_DESTINATION)
+        doc1 = {'x': 1, 'y': 1}
+        doc2 = {'x': 2, 'y': 1, 'is_fresh': True}
+        doc2_stale = {'x': 2, 'y': 1, 'is_fresh': False}
+        doc3 = {'x': 3, 'y': 1}
+        doc4 = {'x': 4, 'y': 1, 'is_fresh': True}
+        doc4_stale = {'x': 4, 'y': 1, 'is_fresh': False}
+        self.db1.dummy.insert(doc1)
+        self.db1.dummy.insert(doc2)
+        self.db2.dummy.insert(doc2_stale)
+        self.db2.dummy.insert(doc3)
+        self.db1.dummy.insert(doc4)
+        self.db2.dummy.insert(doc4_stale)
+
+        c = operations.multishard_find('dummy', {'y': 1})
+        results = sorted(list(c), key=lambda d: d['x'])
+        self.assertEqual([doc1, doc2, doc3, doc4], results)
+
+    def test_multishard_find_excluding_on_client(self):
+        api.set_shard_at_rest('dummy', 1, "dest1/test_sharding")
+        api.set_shard_at_rest('dummy', 2, "dest1/test_sharding")
+        api.set_shard_at_rest('dummy', 3, "dest2/test_sharding")
+        api.start_migration('dummy', 2, "dest2/test_sharding")
+        api.set_realm_exclusion_mode('dummy', 'client')
+        doc1 = {'x': 1, 'y': 1}
+        doc2 = {'x': 2, 'y': 1, 'is_fresh': True}
+        doc2_stale = {'x': 2, 'y': 1, 'is_fresh': False}
+        doc3 = {'x': 3, 'y': 1}
+        self.db1.dummy.insert(doc1)
+        self.db1.dummy.insert(doc2)
+        self.db2.dummy.insert(doc2_stale)
+        self.db2.dummy.insert(doc3)
+
+        targets = list(operations._create_query_targets(
+            'dummy', {'y': 1}, allow_client_exclusion=True))
+        self.assertEqual(
+            {'dest1/test_sharding': None, 'dest2/test_sharding': [2]},
+            {location: excludes for _, _, location, excludes in targets})
+        self.assertEqual(
+            [{'y': 1}, {'y': 1}], [query for _, query, _, _ in targets])
+
+        c = operations.multishard_find('dummy', {'y': 1})
+        results = sorted([doc for doc in c], key=lambda d: d['x'])
+        self.assertEqual([doc1, doc2, doc3], results)
+
+        # The shard field is only returned if it was asked for
+        c = operations.multishard_find(
+            'dummy', {'y': 1}, {'_id': 0, 'is_fresh': 1})
+        results = [doc for doc in c]
+        self.assertEqual(
+            [{}, {}, {'is_fresh': True}],
+            sorted(results, key=lambda d: len(d)))
+
+        # Limits are applied once the excluded shards are dropped
+        c = operations.multishard_find(
+            'dummy', {'y': 1}, sort=[('x', 1)], limit=2)
+        self.assertEqual([doc1, doc2], [doc for doc in c])
+
+        # Counts still exclude on the server
+        self.assertEqual(
+            3, operations.multishard_find('dummy', {'y': 1}).count())
+
+    def test_multishard_find_raw_documents(self):
+        api.set_shard_at_rest('dummy', 1, "dest1/test_sharding")
+        api.set_shard_at_rest('dummy', 2, "dest1/test_sharding")
+        api.set_shard_at_rest('dummy', 3, "dest2/test_sharding")
+        api.start_migration('dummy', 2, "dest2/test_sharding")
+        api.set_realm_exclusion_mode('dummy', 'client')
+        self.db1.dummy.insert({'x': 1, 'y': 3})
+        self.db1.dummy.insert({'x': 2, 'y': 2, 'is_fresh': True})
+        self.db2.dummy.insert({'x': 2, 'y': 2, 'is_fresh': False})
+        self.db2.dummy.insert({'x': 3, 'y': 1})
+        with_options = {
+            'codec_options': CodecOptions(document_class=RawBSONDocument)}
+
+        c = operations.multishard_find(
+            'dummy', {}, {'_id': 0, 'y': 1, 'is_fresh': 1},
+            sort=[('y', 1)], with_options=with_options)
+        results = [doc for doc in c]
+        self.assertTrue(
+            all(isinstance(doc, RawBSONDocument) for doc in results))
+        self.assertEqual(
+            [{'y': 1}, {'y': 2, 'is_fresh': True}, {'y': 3}],
+            [bson.BSON(doc.raw).decode() for doc in results])
+
+        # Spilled results are read back raw too
+        c = operations.multishard_find(
+            'dummy', {}, sort=[('y', -1)],
+            with_options=with_options).sort_memory_budget(1)
+        results = [doc for doc in c]
+        self.assertTrue(
+            all(isinstance(doc, RawBSONDocument) for doc in results))
+        self.assertEqual([3, 2, 1], [doc['y'] for doc in results])
+
+    def test_exclusion_mode_auto(self):
+        self.assertFalse(operations._should_exclude_on_client(
+            'server', 'x', {'y': 1}, [2]))
+        self.assertTrue(operations._should_exclude_on_client(
+            'client', 'x', {'x': {'$gt': 1}}, [2]))
+        self.assertTrue(operations._should_exclude_on_client(
+            'auto', 'x', {'y': 1}, [2]))
+        self.assertFalse(operations._should_exclude_on_client(
+            'auto', 'x', {'$or': [{'x': {'$gt': 1}}, {'y': 1}]}, [2]))
+        self.assertFalse(operations._should_exclude_on_client(
+            'auto', 'x', {'y': 1},
+            list(range(operations.MAX_CLIENT_SIDE_EXCLUDES + 1))))
+
+    def test_include_field_in_projection(self):
+        include = operations._include_field_in_projection
+        self.assertEqual(((), {}, False), include((), {}, 'x'))
+        self.assertEqual(
+            (({'y': 1, 'x': 1},), {}, True), include(({'y': 1},), {}, 'x'))
+        self.assertEqual(
+            ((), {'projection': {'x': 1}}, False),
+            include((), {'projection': {'x': 1}}, 'x'))
+        self.assertEqual(
+            ((), {'projection': {'y': 0}}, True),
+            include((), {'projection': {'x': 0, 'y': 0}}, 'x'))
+        self.assertEqual(
+            ((), {'projection': None}, True),
+            include((), {'projection': {'x': 0}}, 'x'))
+        self.assertEqual(
+            ((['y', 'x'],), {}, True), include((['y'],), {}, 'x'))
+        # Just _id is an inclusion but _id: 0 is not
+        self.assertEqual(
+            (({'_id': 1, 'x': 1},), {}, True), include(({'_id': 1},), {}, 'x'))
+        self.assertEqual(
+            (({'_id': True, 'x': 1},), {}, True),
+            include(({'_id': True},), {}, 'x'))
+        self.assertEqual(
+            (({'_id': 0},), {}, False), include(({'_id': 0},), {}, 'x'))
+        self.assertEqual(
+            (({'_id': 1, 'y': 0},), {}, False),
+            include(({'_id': 1, 'y': 0},), {}, 'x'))
+        # $slice and $elemMatch don't make a projection an inclusion
+        self.assertEqual(
+            ((), {'projection': {'y': 0, 'z': {'$slice': 2}}}, False),
+            include((), {'projection': {'y': 0, 'z': {'$slice': 2}}}, 'x'))
+        self.assertEqual(
+            (({'y': 1, 'z': {'$elemMatch': {'a': 1}}, 'x': 1},), {}, True),
+            include(({'y': 1, 'z': {'$elemMatch': {'a': 1}}},), {}, 'x'))
+
     def test_multishard_find_during_post_migration(self):
         # Indiciate a migration has started on shard #2 and insert a document
         # with the same ID into both databases with slightly different data in
@@ -856,3 +1438,59 @@ class TestOtherOperations(ShardingTestCase):
 
         results = operations.multishard_find('dummy', {}).count()
         self.assertEqual(4, results)
+
+
+class TestRouteCache(ShardingTestCase):
+    def setUp(self):
+        super(TestRouteCache, self).setUp()
+        api.activate_caching(5)
+        api.set_shard_at_rest('dummy', 1, 'dest1/test_sharding')
+
+    def tearDown(self):
+        super(TestRouteCache, self).tearDown()
+        api.activate_caching(0)
+
+    def test_targetted_operations_reuse_the_routed_collection(self):
+        doc = {'x': 1, 'y': 1}
+        self.db1.dummy.insert(doc)
+
+        self.assertEqual(
+            doc, operations.multishard_find_one('dummy', {'x': 1}))
+        self.assertEqual(1, len(operations._collection_cache))
+        (_, _, collection, location), = operations._collection_cache.values()
+        self.assertEqual('dest1/test_sharding', location)
+
+        operations.multishard_update('dummy', {'x': 1}, {'$set': {'y': 2}})
+        self.assertEqual([doc['_id']], [
+            d['_id'] for d in operations.multishard_find('dummy', {'x': 1})])
+        self.assertEqual(1, len(operations._collection_cache))
+        (_, _, cached, _), = operations._collection_cache.values()
+        self.assertTrue(cached is collection)
+
+    def test_route_cache_follows_metadata_changes(self):
+        self.db2.dummy.insert({'x': 1, 'y': 2})
+        operations.multishard_find_one('dummy', {'x': 1})
+
+        api.set_shard_at_rest('dummy', 1, 'dest2/test_sharding', force=True)
+
+        doc = operations.multishard_find_one('dummy', {'x': 1})
+        self.assertEqual(2, doc['y'])
+
+    def test_filling_the_cache_keeps_other_routes(self):
+        operations.multishard_find_one('dummy', {'x': 1})
+        realm = operations._get_realm_for_collection('dummy')
+        version = operations._get_metadata_store(realm).version
+
+        # Looking up other shards doesn't throw away the existing routes
+        operations.multishard_find_one('dummy', {'x': 2})
+        operations.multishard_find_one('dummy', {'x': {'$in': [3, 4]}})
+        self.assertEqual(
+            version, operations._get_metadata_store(realm).version)
+        self.assertEqual(4, len(operations._collection_cache))
+
+    def test_closing_connections_forgets_routes(self):
+        operations.multishard_find_one('dummy', {'x': 1})
+        self.assertEqual(1, len(operations._collection_cache))
+        close_thread_connections(threading.current_thread())
+        self.assertEqual(0, len(operations._collection_cache))
+        operations.multishard_find_one('dummy', {'x': 1})
@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+
+import threading
+import time
+import unittest
+
+from shardmonster import parallel
+
+
+class TestRunInParallel(unittest.TestCase):
+    def test_results_are_in_order(self):
+        outcomes = parallel.run_in_parallel(lambda x: x * 2, [1, 2, 3])
+        self.assertEqual([2, 4, 6], [outcome.result for outcome in outcomes])
+        self.assertEqual([1, 2, 3], [outcome.item for outcome in outcomes])
+
+    def test_failures_are_captured(self):
+        def _fn(x):
+            if x == 2:
+                raise ValueError('bad %s' % x)
+            return x
+
+        outcomes = parallel.run_in_parallel(_fn, [1, 2, 3])
+        self.assertEqual([False, True, False], [o.failed for o in outcomes])
+        self.assertEqual('bad 2', str(outcomes[1].error))
+        with self.assertRaises(ValueError):
+            parallel.raise_first_failure(outcomes)
+
+    def test_runs_concurrently(self):
+        barrier = threading.Event()
+        arrived = []
+
+        def _fn(x):
+            arrived.append(x)
+            if len(arrived) == 2:
+                barrier.set()
+            # Would time out if the items were run one after another
+            return barrier.wait(5)
+
+        outcomes = parallel.run_in_parallel(_fn, [1, 2])
+        self.assertEqual([True, True], [o.result for o in outcomes])
+
+    def test_nested_calls_run_inline(self):
+        def _outer(x):
+            return [o.result for o in parallel.run_in_parallel(
+                lambda y: x + y, [10, 20])]
+
+        outcomes = parallel.run_in_parallel(_outer, [1, 2])
+        self.assertEqual([[11, 21], [12, 22]], [o.result for o in outcomes])
+
+    def test_max_concurrency(self):
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def _fn(x):
+            with lock:
+                running.append(x)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(x)
+            return x
+
+        outcomes = parallel.run_in_parallel(
+            _fn, range(8), max_concurrency=2)
+        self.assertEqual(list(range(8)), [o.result for o in outcomes])
+        self.assertTrue(max(peak) <= 2)
+
+    def test_dedicated_threads_per_group(self):
+        lock = threading.Lock()
+        running = {'a': [], 'b': []}
+        peak = {'a': [], 'b': []}
+
+        def _fn(item):
+            group, x = item
+            with lock:
+                running[group].append(x)
+                peak[group].append(len(running[group]))
+            time.sleep(0.01)
+            with lock:
+                running[group].remove(x)
+            if x == 3:
+                raise Exception('boom')
+            return x
+
+        groups = [[('a', x) for x in range(4)], [('b', x) for x in range(2)]]
+        outcomes = parallel.run_in_dedicated_threads(
+            _fn, groups, max_concurrency_per_group=1)
+        self.assertEqual(
+            [0, 1, 2, None, 0, 1], [o.result for o in outcomes])
+        self.assertTrue(outcomes[3].failed)
+        self.assertEqual([1] * 4, peak['a'])
+        self.assertEqual([1] * 2, peak['b'])
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+
+import datetime
+import re
+import unittest
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from shardmonster import raw_documents
+
+RAW_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def _raw(doc):
+    return RawBSONDocument(bson.BSON.encode(doc), RAW_OPTIONS)
+
+
+class TestRawDocuments(unittest.TestCase):
+    def test_uses_raw_documents(self):
+        uses_raw = raw_documents.uses_raw_documents
+        self.assertFalse(uses_raw({}))
+        self.assertFalse(uses_raw(None))
+        self.assertFalse(uses_raw({'codec_options': CodecOptions()}))
+        self.assertTrue(uses_raw({'codec_options': RAW_OPTIONS}))
+
+    def test_get_raw_value(self):
+        when = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        doc = _raw(bson.SON([
+            ('_id', bson.ObjectId()), ('f', 1.5), ('s', u'caf\xe9'),
+            ('b', bson.Binary(b'xyz')), ('r', re.compile('a.*')),
+            ('t', True), ('n', None), ('d', when), ('l', [1, 2]),
+            ('big', bson.Int64(2 ** 40)), ('sub', {'x': {'y': 3}}),
+            ('x', 7)]))
+        get = raw_documents.get_raw_value
+        self.assertEqual(7, get(doc.raw, 'x'))
+        self.assertEqual(u'caf\xe9', get(doc.raw, 's'))
+        self.assertEqual(when, get(doc.raw, 'd'))
+        self.assertEqual([1, 2], get(doc.raw, 'l'))
+        self.assertEqual(3, get(doc.raw, 'sub.x.y'))
+        self.assertEqual({'y': 3}, get(doc.raw, 'sub.x'))
+        with self.assertRaises(KeyError):
+            get(doc.raw, 'missing')
+        with self.assertRaises(KeyError):
+            get(doc.raw, 'sub.missing')
+        with self.assertRaises(TypeError):
+            get(doc.raw, 'x.y')
+
+    def test_remove_raw_field(self):
+        doc = _raw(bson.SON([('a', 1), ('x', 2), ('b', {'c': 3})]))
+        removed = raw_documents.remove_raw_field(doc, 'x', RAW_OPTIONS)
+        self.assertTrue(isinstance(removed, RawBSONDocument))
+        self.assertEqual(
+            {'a': 1, 'b': {'c': 3}}, bson.BSON(removed.raw).decode())
+        self.assertTrue(
+            raw_documents.remove_raw_field(doc, 'y', RAW_OPTIONS) is doc)
@@ -0,0 +1,73 @@
+from __future__ import absolute_import
+
+import unittest
+
+from shardmonster import routing, stats
+
+
+class TestAnalyseQuery(unittest.TestCase):
+    def setUp(self):
+        routing.clear_plan_cache()
+        stats.reset_stats()
+
+    def _keys(self, query):
+        return routing.analyse_query('x', query).shard_keys
+
+    def test_equality(self):
+        self.assertEqual([1], self._keys({'x': 1, 'y': 2}))
+        self.assertEqual([1], self._keys({'x': {'$eq': 1}}))
+        self.assertEqual(None, self._keys({'y': 2}))
+        self.assertEqual(None, self._keys({'x': {'$gt': 1}}))
+        self.assertEqual(None, self._keys({'x': {'a': 1}}))
+
+    def test_in(self):
+        self.assertEqual([1, 2], self._keys({'x': {'$in': [2, 1, 2]}}))
+        self.assertEqual([2], self._keys({'x': {'$in': [1, 2], '$eq': 2}}))
+        self.assertEqual(None, self._keys({'x': {'$in': [1, None]}}))
+
+    def test_and(self):
+        self.assertEqual(
+            [2], self._keys({'$and': [{'x': {'$in': [1, 2]}}, {'x': 2}]}))
+        self.assertEqual(
+            [1], self._keys({'$and': [{'x': 1}, {'y': {'$gt': 3}}]}))
+        self.assertEqual([], self._keys({'x': 1, '$and': [{'x': 2}]}))
+
+    def test_or(self):
+        self.assertEqual(
+            [1, 2, 3],
+            self._keys({'$or': [{'x': 1}, {'x': {'$in': [2, 3]}}]}))
+        self.assertEqual(None, self._keys({'$or': [{'x': 1}, {'y': 2}]}))
+        self.assertEqual(
+            [1], self._keys({'x': 1, '$or': [{'y': 1}, {'y': 2}]}))
+
+    def test_nested(self):
+        query = {'$and': [
+            {'$or': [{'x': 1}, {'x': 2}, {'x': 3}]},
+            {'$or': [{'x': {'$in': [2, 3, 4]}}, {'x': {'$eq': 5}}]},
+        ]}
+        self.assertEqual([2, 3], self._keys(query))
+
+    def test_get_single_target(self):
+        self.assertEqual(1, routing.get_single_target('x', {'x': 1}))
+        self.assertEqual(
+            1, routing.get_single_target('x', {'$or': [{'x': 1}, {'x': 1}]}))
+        self.assertEqual(
+            None, routing.get_single_target('x', {'x': {'$in': [1, 2]}}))
+
+    def test_reasons(self):
+        plan = routing.analyse_query('x', {'$or': [{'x': 1}, {'y': 2}]})
+        self.assertFalse(plan.targetted)
+        self.assertEqual([
+            '$or.0.x = 1',
+            'no condition on x',
+            'a branch of $or can match any shard',
+        ], plan.reasons)
+
+    def test_plans_are_cached_by_shape(self):
+        routing.analyse_query('x', {'x': 1, 'y': 1})
+        routing.analyse_query('x', {'y': 'other', 'x': 2})
+        routing.analyse_query('x', {'x': {'$in': [1, 2]}})
+
+        self.assertEqual(
+            {'hits': 1, 'misses': 2, 'hit_ratio': 1.0 / 3},
+            stats.get_cache_stats()[stats.ROUTE_PLAN_CACHE]['x'])
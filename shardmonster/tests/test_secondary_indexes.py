@@ -0,0 +1,202 @@
+from __future__ import absolute_import
+
+import unittest
+
+from bson.decimal128 import Decimal128
+from pymongo.operations import InsertOne, UpdateOne
+
+from shardmonster import api, operations, secondary_indexes
+from shardmonster.tests.base import ShardingTestCase
+from .mock import call, Mock, patch
+
+
+class TestTouches(unittest.TestCase):
+    def test_touches(self):
+        touches = secondary_indexes._touches
+        self.assertTrue(touches({'email': 'a'}, 'email'))
+        self.assertFalse(touches({'other': 'a'}, 'email'))
+        self.assertTrue(touches({'$set': {'email': 'a'}}, 'email'))
+        self.assertTrue(touches({'$set': {'email.domain': 'a'}}, 'email'))
+        self.assertTrue(touches({'$unset': {'contact': 1}}, 'contact.email'))
+        self.assertFalse(touches({'$set': {'emails': 'a'}}, 'email'))
+
+    def test_values(self):
+        values = secondary_indexes._values
+        self.assertEqual(['a'], values('a'))
+        self.assertEqual(['a', 1], values(['a', 1, None, {'b': 1}]))
+        self.assertEqual([], values(1.5))
+        # Numbers that a query for an integer matches are indexed as one
+        self.assertEqual([1, 2], values([1.0, Decimal128('2')]))
+        self.assertEqual(
+            [], values([Decimal128('2.5'), float('inf'), Decimal128('NaN')]))
+
+    def test_get_values(self):
+        get_values = secondary_indexes._get_values
+        self.assertEqual(['a'], get_values({'email': 'a'}, 'email'))
+        self.assertEqual([], get_values({'other': 'a'}, 'email'))
+        self.assertEqual(
+            ['a'], get_values({'profile': {'email': 'a'}}, 'profile.email'))
+        self.assertEqual(['a', 'b', 'c'], get_values(
+            {'profile': [{'email': 'a'}, {'email': ['b', 'c']}, {}]},
+            'profile.email'))
+        self.assertEqual(
+            ['b'], get_values({'emails': ['a', 'b']}, 'emails.1'))
+
+
+class TestPendingReindex(unittest.TestCase):
+    @patch('shardmonster.secondary_indexes.reindex_matching')
+    @patch('shardmonster.secondary_indexes.get_connection')
+    @patch('shardmonster.secondary_indexes._get_locations_for_query')
+    @patch('shardmonster.secondary_indexes._get_realm_for_collection')
+    def test_reindexes_in_batches(
+            self, mock_realm, mock_locations, mock_connection, mock_reindex):
+        mock_locations.return_value = ['dest1/db', 'dest2/db']
+        collection = mock_connection.return_value.__getitem__.return_value \
+            .__getitem__.return_value
+        collection.find.side_effect = [
+            [{'_id': 1}, {'_id': 2}], [{'_id': 3}]]
+
+        pending = secondary_indexes._PendingReindex(
+            'dummy', {'y': 1}, ['email'], True, batch_size=2)
+        pending.finish()
+        self.assertEqual([
+            call('dummy', {'_id': {'$in': [1, 2]}}, ['email']),
+            call('dummy', {'_id': {'$in': [3]}}, ['email']),
+            call('dummy', {'y': 1}, ['email']),
+        ], mock_reindex.call_args_list)
+
+    def test_reindex_errors_do_not_hide_the_write_error(self):
+        failing = Mock()
+        failing.finish.side_effect = ValueError('reindex failed')
+        other = Mock()
+        with self.assertRaises(KeyError):
+            with secondary_indexes.finishing_index_updates(
+                    [failing, None, other]):
+                raise KeyError('write failed')
+        self.assertTrue(other.finish.called)
+
+        with self.assertRaises(ValueError):
+            with secondary_indexes.finishing_index_updates([failing]):
+                pass
+
+
+class TestSecondaryIndexes(ShardingTestCase):
+    def setUp(self):
+        super(TestSecondaryIndexes, self).setUp()
+        api.set_shard_at_rest('dummy', 1, 'dest1/test_sharding')
+        api.set_shard_at_rest('dummy', 2, 'dest2/test_sharding')
+        self.untargetted = []
+        api.set_untargetted_query_callback(
+            lambda collection_name, query: self.untargetted.append(query))
+        self.collection = api.make_collection_shard_aware('dummy')
+
+    def tearDown(self):
+        api.set_untargetted_query_callback(None)
+        super(TestSecondaryIndexes, self).tearDown()
+
+    def _create_index(self):
+        api.create_secondary_index('dummy', 'email', backfill=False)
+        secondary_indexes.backfill_secondary_index(
+            'dummy', 'email', wait=False)
+
+    def test_backfill_and_routing(self):
+        self.db1.dummy.insert({'x': 1, 'email': 'one@example.com'})
+        self.db2.dummy.insert({'x': 2, 'email': 'two@example.com'})
+        self._create_index()
+
+        explanation = api.route_explain(
+            'dummy', {'email': 'two@example.com'})
+        self.assertEqual(
+            {'dest2/test_sharding': {'email': 'two@example.com'}},
+            explanation['locations'])
+        self.assertEqual([2], explanation['shard_keys'])
+        self.assertEqual('email', explanation['index'])
+        self.assertEqual([
+            'no condition on x', 'secondary index on email lists 1 shard keys',
+        ], explanation['reasons'])
+        doc = self.collection.find_one({'email': 'two@example.com'})
+        self.assertEqual(2, doc['x'])
+
+        # Nothing can match a value that isn't in the index
+        self.assertEqual(
+            None, self.collection.find_one({'email': 'three@example.com'}))
+        self.assertEqual([], self.untargetted)
+
+    def test_dotted_field(self):
+        self.db2.dummy.insert(
+            {'x': 2, 'profile': {'email': 'two@example.com'}})
+        api.create_secondary_index('dummy', 'profile.email', backfill=False)
+        secondary_indexes.backfill_secondary_index(
+            'dummy', 'profile.email', wait=False)
+        self.collection.insert(
+            {'x': 1, 'profile': [{'email': 'one@example.com'}]})
+
+        self.assertEqual(
+            {'dest2/test_sharding'},
+            set(api.route_explain(
+                'dummy', {'profile.email': 'two@example.com'})['locations']))
+        doc = self.collection.find_one({'profile.email': 'one@example.com'})
+        self.assertEqual(1, doc['x'])
+        self.assertEqual([], self.untargetted)
+
+    def test_numbers_match_integer_queries(self):
+        self._create_index()
+        self.collection.insert({'x': 2, 'email': 1.0})
+        self.collection.insert({'x': 1, 'email': Decimal128('3')})
+        self.assertEqual(2, self.collection.find_one({'email': 1})['x'])
+        self.assertEqual(1, self.collection.find_one({'email': 3})['x'])
+        self.assertEqual([], self.untargetted)
+
+    def test_writes_keep_the_index_up_to_date(self):
+        self._create_index()
+        self.collection.insert({'x': 1, 'email': 'one@example.com'})
+        self.collection.update(
+            {'x': 2}, {'$set': {'email': 'two@example.com'}}, upsert=True)
+        self.collection.bulk_write([
+            InsertOne({'x': 2, 'email': 'three@example.com'}),
+            UpdateOne({'x': 1}, {'$push': {'email': 'four@example.com'}}),
+        ])
+        self.collection.update(
+            {'email': 'two@example.com'},
+            {'$set': {'email': 'five@example.com'}})
+
+        for email, x in [
+                ('one@example.com', 1), ('four@example.com', 1),
+                ('three@example.com', 2), ('five@example.com', 2)]:
+            doc = self.collection.find_one({'email': email})
+            self.assertEqual(x, doc['x'])
+        self.assertEqual([], self.untargetted)
+
+        result = api.check_secondary_index('dummy', 'email')
+        self.assertEqual([], result['missing'])
+
+    def test_check_and_repair(self):
+        self._create_index()
+        self.collection.insert({'x': 1, 'email': 'one@example.com'})
+        # Written behind shardmonster's back
+        self.db2.dummy.insert({'x': 2, 'email': 'two@example.com'})
+        self.db1.dummy.remove({'x': 1})
+
+        result = api.check_secondary_index('dummy', 'email')
+        self.assertEqual([('two@example.com', 2)], result['missing'])
+        self.assertEqual([('one@example.com', 1)], result['stale'])
+
+        api.check_secondary_index('dummy', 'email', repair=True)
+        result = api.check_secondary_index('dummy', 'email')
+        self.assertEqual({'missing': [], 'stale': []}, result)
+        self.assertEqual(
+            2, self.collection.find_one({'email': 'two@example.com'})['x'])
+
+    def test_index_is_only_used_once_ready(self):
+        api.create_secondary_index('dummy', 'email', backfill=False)
+        [doc for doc in operations.multishard_find('dummy', {'email': 'a'})]
+        self.assertEqual([{'email': 'a'}], self.untargetted)
+
+        with self.assertRaises(Exception) as catcher:
+            api.create_secondary_index('dummy', 'email')
+        self.assertEqual(
+            'Secondary index on email already exists', str(catcher.exception))
+
+        api.drop_secondary_index('dummy', 'email')
+        realm = operations._get_realm_for_collection('dummy')
+        self.assertEqual([], secondary_indexes.get_secondary_indexes(realm))
@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+
+import unittest
+
+from .mock import patch
+
+from shardmonster import api, metadata, stats
+
+
+class TestRoundTripStats(unittest.TestCase):
+    def setUp(self):
+        stats.reset_stats()
+
+    def tearDown(self):
+        stats.reset_stats()
+
+    def test_histogram_buckets_are_cumulative(self):
+        stats.record_round_trip(stats.FULL_REFRESH, 0.0005)
+        stats.record_round_trip(stats.FULL_REFRESH, 0.003)
+        stats.record_round_trip(stats.FULL_REFRESH, 10)
+
+        result = stats.get_round_trip_stats()[stats.FULL_REFRESH]
+        self.assertEqual(3, result['count'])
+        self.assertAlmostEqual(10.0035, result['total_time'])
+        buckets = dict(result['buckets'])
+        self.assertEqual(1, buckets[0.001])
+        self.assertEqual(1, buckets[0.0025])
+        self.assertEqual(2, buckets[0.005])
+        self.assertEqual(2, buckets[5.0])
+        self.assertEqual(3, buckets['+Inf'])
+
+    @patch('shardmonster.stats.time.time')
+    def test_timed_round_trip(self, mock_time):
+        mock_time.side_effect = [10.0, 10.02]
+        with stats.timed_round_trip(stats.PAUSE_CHECK):
+            pass
+
+        result = stats.get_round_trip_stats()[stats.PAUSE_CHECK]
+        self.assertEqual(1, result['count'])
+        self.assertAlmostEqual(0.02, result['total_time'])
+
+    def test_cache_hit_ratio(self):
+        stats.record_cache_hit(stats.REALM_CACHE, 'dummy')
+        stats.record_cache_hit(stats.REALM_CACHE, 'dummy')
+        stats.record_cache_hit(stats.REALM_CACHE, 'dummy')
+        stats.record_cache_miss(stats.REALM_CACHE, 'dummy')
+
+        self.assertEqual(
+            {stats.REALM_CACHE: {
+                'dummy': {'hits': 3, 'misses': 1, 'hit_ratio': 0.75}}},
+            stats.get_cache_stats())
+
+
+class TestMetadataStats(unittest.TestCase):
+    def setUp(self):
+        stats.reset_stats()
+        api.activate_caching(10)
+
+    def tearDown(self):
+        stats.reset_stats()
+        api.activate_caching(0)
+
+    @patch('shardmonster.metadata.ShardMetadataStore._query_shards_collection')
+    def test_single_shard_lookups_are_recorded(self, mock_query):
+        mock_query.return_value = [
+            {'status': metadata.ShardStatus.AT_REST, 'shard_key': 1}]
+        metadata._metadata_stores['dummy-realm'] = \
+            metadata.ShardMetadataStore('dummy-realm')
+        realm = {'name': 'dummy-realm'}
+
+        metadata._get_metadata_for_shard(realm, 1)
+        metadata._get_metadata_for_shard(realm, 1)
+
+        result = api.get_metadata_stats()
+        self.assertEqual(
+            {'hits': 1, 'misses': 1, 'hit_ratio': 0.5},
+            result['caches'][stats.SHARD_METADATA_CACHE]['dummy-realm'])
+        self.assertEqual(
+            1, result['round_trips'][stats.SINGLE_SHARD_REFRESH]['count'])
+        self.assertEqual(1, result['entries']['dummy-realm']['entries'])
+        self.assertEqual(0, result['entries']['dummy-realm']['evictions'])
+        self.assertTrue(result['entries']['dummy-realm']['memory'] > 0)